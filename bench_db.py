@@ -0,0 +1,324 @@
+# bench_db.py
+"""
+Бенчмарк слоя БД (poker_stats_db): сколько раздач в секунду проходит через живой путь записи и чтения.
+
+Раздачи из директории истории парсятся и анализируются заранее (без All-In EV),
+после чего в свежую временную базу замеряются только обращения к БД — как их делает
+process_file_update на каждую раздачу:
+    update_stats_in_db + update_hand_stats_in_db (запись)
+    get_stats_for_players + get_player_extended_stats для Hero (чтение для HUD;
+    время get_stats_for_players выводится отдельно)
+
+Каждый режим прогоняется на своей базе:
+    legacy       — соединение открывается и закрывается на каждый запрос (как раньше)
+    persistent   — долгоживущее соединение потока с профилем прагм (db_connection.py)
+    batched_live — HandBatchWriter, flush после каждой раздачи, статистика оппонентов
+                   из памяти с отложенной записью (как process_file_update)
+    batched_bulk — HandBatchWriter пачками DB_BULK_BATCH_HANDS без чтения (как полная загрузка)
+
+С --synthetic-rows N вместо этого строится синтетический my_hand_log на N строк
+(одна сессия Hero в год) и замеряются запросы Hero (расширенная статистика,
+матрица рук, журнал раздач) без индексов HAND_LOG_INDEXES и с ними.
+
+Примеры:
+    python bench_db.py --dir test_history
+    python bench_db.py --dir test_history --repeat 3 --output bench_db.json
+    python bench_db.py --synthetic-rows 1000000 --output bench_db_index.json
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import random
+import datetime
+import platform
+import tempfile
+import warnings
+from typing import Dict, Any, List, Optional
+
+warnings.filterwarnings("ignore", message="The field 'time_zone_abbreviation' is an unexpected field")
+
+import poker_globals
+import poker_stats_db
+import db_schema
+from db_connection import get_connection, release_connection, close_connections
+from my_pokerkit_parser import CustomHandHistory
+from poker_globals import MY_PLAYER_NAME, ACTION_POSITIONS, get_table_name_segment
+from poker_monitor import is_tournament_file
+from bench_equity import git_revision
+
+# режим -> (долгоживущие соединения, размер пачки HandBatchWriter или None, чтение для HUD)
+MODES = {
+    "legacy": (False, None, True),
+    "persistent": (True, None, True),
+    "batched_live": (True, 1, True),
+    "batched_bulk": (True, poker_globals.DB_BULK_BATCH_HANDS, False),
+}
+
+
+def load_hands(directory: str) -> List[Dict[str, Any]]:
+    """Парсит и анализирует все раздачи кеш-игр из директории (вне замера)."""
+    hands = []
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if not filename.endswith('.txt') or is_tournament_file(filename):
+            continue
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            content = f.read()
+        for hh in CustomHandHistory.from_pokerstars(content, error_status=True):
+            try:
+                day = datetime.datetime(hh.year, hh.month, hh.day)
+                hands.append({
+                    "segment": get_table_name_segment(hh.min_bet, hh.seat_count),
+                    "day": day,
+                    "players": list(hh.players),
+                    "table_stats": poker_stats_db.analyze_hand_for_stats(hh),
+                    "hero_stats": poker_stats_db.analyze_player_stats(hh, MY_PLAYER_NAME, compute_ev=False),
+                })
+            except Exception as e:
+                print(f"⚠️ Пропуск раздачи в {filename}: {e}")
+    return hands
+
+
+def run_mode(hands: List[Dict[str, Any]], persistent: bool, batch_hands: Optional[int], with_reads: bool) -> Dict[str, float]:
+    """Прогоняет все раздачи через запись (и чтение) на свежей временной базе."""
+    hands = copy.deepcopy(hands)
+    poker_globals.DB_PERSISTENT_CONNECTIONS = persistent
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        poker_stats_db.DB_NAME = os.path.join(tmp_dir, "bench.db")
+        poker_stats_db.setup_database()
+        writer = None
+        if batch_hands:
+            writer = poker_stats_db.HandBatchWriter(batch_hands, poker_globals.DB_BULK_BATCH_MS)
+
+        write_s = 0.0
+        read_s = 0.0
+        table_read_s = 0.0
+        for hand in hands:
+            start = time.perf_counter()
+            if writer:
+                writer.add_hand(hand["segment"], hand["table_stats"], hand["hero_stats"])
+                poker_stats_db.flush_opponent_stats(only_if_due=True)
+            else:
+                poker_stats_db.update_stats_in_db(hand["table_stats"], hand["segment"])
+                poker_stats_db.update_hand_stats_in_db(hand["hero_stats"], hand["segment"])
+            middle = time.perf_counter()
+            if with_reads:
+                poker_stats_db.get_stats_for_players(hand["players"], hand["segment"])
+                table_read_s += time.perf_counter() - middle
+                if MY_PLAYER_NAME in hand["players"]:
+                    poker_stats_db.get_player_extended_stats(MY_PLAYER_NAME, "", min_time=hand["day"])
+            read_s += time.perf_counter() - middle
+            write_s += middle - start
+
+        if writer:
+            start = time.perf_counter()
+            writer.flush()
+            poker_stats_db.flush_opponent_stats()
+            write_s += time.perf_counter() - start
+        close_connections()
+
+    total_s = write_s + read_s
+    return {
+        "hands": len(hands),
+        "write_s": write_s,
+        "read_s": read_s,
+        "total_s": total_s,
+        "table_read_s": table_read_s,
+        "write_hands_per_s": len(hands) / write_s if write_s else 0.0,
+        "hands_per_s": len(hands) / total_s if total_s else 0.0,
+    }
+
+
+SYNTHETIC_DAYS = 365
+SYNTHETIC_POSITIONS = ACTION_POSITIONS + ["sb", "bb"]
+SYNTHETIC_RANKS = "AKQJT98765432"
+
+
+def _synthetic_hands() -> List[str]:
+    hands = []
+    for i, high in enumerate(SYNTHETIC_RANKS):
+        for low in SYNTHETIC_RANKS[i:]:
+            hands.append(high + low if high == low else high + low + "s")
+            if high != low:
+                hands.append(high + low + "o")
+    return hands
+
+
+def fill_synthetic_hand_log(rows: int, seed: int = 2024):
+    """Заполняет my_hand_log синтетическими раздачами Hero за SYNTHETIC_DAYS дней."""
+    rng = random.Random(seed)
+    hands = _synthetic_hands()
+    start = datetime.datetime.now() - datetime.timedelta(days=SYNTHETIC_DAYS)
+    step = SYNTHETIC_DAYS * 86400 / rows
+
+    # Позиция и класс руки хранятся кодами справочников (HAND_LOG_DIMENSIONS)
+    code = poker_stats_db._encode_hand_log_value
+
+    def generate():
+        for i in range(rows):
+            vpip = rng.random() < 0.25
+            pfr = vpip and rng.random() < 0.7
+            yield (
+                f"S{i}", "Synthetic", MY_PLAYER_NAME, poker_stats_db._to_epoch(start + datetime.timedelta(seconds=i * step)),
+                code('position', rng.choice(SYNTHETIC_POSITIONS)), "", code('normalized_hand', rng.choice(hands)), int(vpip), int(pfr),
+                int(pfr and rng.random() < 0.5), 0, rng.randint(-100, 100),
+            )
+
+    conn = get_connection(poker_stats_db.DB_NAME)
+    with conn:
+        conn.executemany(
+            "INSERT INTO my_hand_log (hand_id, table_part_name, player_name, time_logged, position, cards, "
+            "normalized_hand, is_vpip, is_pfr, is_rfi, is_steal_attempt, net_profit) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            generate()
+        )
+    release_connection(conn)
+
+
+def time_hero_queries(repeat: int) -> Dict[str, float]:
+    """Время (лучшее из repeat) запросов Hero к my_hand_log, в миллисекундах."""
+    now = datetime.datetime.now()
+    week = now - datetime.timedelta(days=7)
+    month = now - datetime.timedelta(days=30)
+    queries = {
+        "extended_stats_7d": lambda: poker_stats_db.get_player_extended_stats(MY_PLAYER_NAME, "", min_time=week),
+        "extended_stats_all": lambda: poker_stats_db.get_player_extended_stats(MY_PLAYER_NAME, ""),
+        "chart_vpip_co_30d": lambda: poker_stats_db.get_chart_hands_data(MY_PLAYER_NAME, "vpip", "co", min_time=month),
+        "chart_pfr_total": lambda: poker_stats_db.get_chart_hands_data(MY_PLAYER_NAME, "pfr", "total"),
+        "hand_log_df_7d": lambda: poker_stats_db.get_player_hand_log_df(MY_PLAYER_NAME, min_time=week),
+    }
+    timings = {}
+    for name, query in queries.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best * 1000
+    return timings
+
+
+def run_synthetic(rows: int, repeat: int) -> Dict[str, Any]:
+    """Запросы Hero на синтетическом журнале: без индексов HAND_LOG_INDEXES и с ними."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        poker_stats_db.DB_NAME = os.path.join(tmp_dir, "bench_index.db")
+        poker_stats_db.setup_database()
+        conn = get_connection(poker_stats_db.DB_NAME)
+        for index_name in db_schema.HAND_LOG_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+        start = time.perf_counter()
+        fill_synthetic_hand_log(rows)
+        print(f"Синтетический журнал: {rows} строк за {time.perf_counter() - start:.1f} с")
+
+        results["without_indexes"] = time_hero_queries(repeat)
+        start = time.perf_counter()
+        with conn:
+            db_schema._migrate_hand_log_v2(conn, "my_hand_log")
+        results["index_build_s"] = time.perf_counter() - start
+        results["with_indexes"] = time_hero_queries(repeat)
+        release_connection(conn)
+        close_connections()
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Database layer benchmark (hands per second).")
+    parser.add_argument('--dir', type=str, default='test_history', help='Директория с историей раздач.')
+    parser.add_argument('--repeat', type=int, default=1, help='Прогонов на режим (берется лучший).')
+    parser.add_argument('--output', type=str, default='bench_db.json', help='Файл с результатами (JSON).')
+    parser.add_argument('--synthetic-rows', type=int, default=0,
+                        help='Замер индексов my_hand_log на синтетическом журнале из N строк (вместо --dir).')
+    return parser.parse_args()
+
+
+def main_synthetic(args):
+    print(f"=== HAND LOG INDEX BENCHMARK: {args.synthetic_rows} строк ===")
+    db_name = poker_stats_db.DB_NAME
+    try:
+        results = run_synthetic(args.synthetic_rows, max(args.repeat, 3))
+    finally:
+        poker_stats_db.DB_NAME = db_name
+
+    print(f"Построение индексов: {results['index_build_s']:.1f} с")
+    for name, before in results["without_indexes"].items():
+        after = results["with_indexes"][name]
+        print(f"{name:<18} {before:9.1f} мс -> {after:8.1f} мс (x{before / after if after else 0:.1f})")
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "synthetic_rows": args.synthetic_rows,
+            "repeat": max(args.repeat, 3),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты записаны в {args.output}")
+
+
+def main():
+    args = parse_arguments()
+    if args.synthetic_rows:
+        main_synthetic(args)
+        return
+    if not os.path.isdir(args.dir):
+        print(f"❌ Директория {args.dir} не найдена.")
+        sys.exit(1)
+
+    print(f"=== DB BENCHMARK: {args.dir} ===")
+    hands = load_hands(args.dir)
+    if not hands:
+        print("❌ Раздачи не найдены.")
+        sys.exit(1)
+    print(f"Раздач: {len(hands)}")
+
+    db_name = poker_stats_db.DB_NAME
+    persistent = poker_globals.DB_PERSISTENT_CONNECTIONS
+    results = {}
+    try:
+        for mode, (mode_persistent, batch_hands, with_reads) in MODES.items():
+            runs = [run_mode(hands, mode_persistent, batch_hands, with_reads) for _ in range(args.repeat)]
+            results[mode] = max(runs, key=lambda r: r["hands_per_s"])
+            r = results[mode]
+            line = f"{mode:<13} запись {r['write_hands_per_s']:8.1f} раздач/с"
+            if with_reads:
+                line += (f" | запись+чтение {r['hands_per_s']:8.1f} раздач/с ({r['total_s']:.2f} с)"
+                         f" | статистика стола {r['table_read_s'] / r['hands'] * 1e6:7.1f} мкс")
+            print(line)
+    finally:
+        poker_stats_db.DB_NAME = db_name
+        poker_globals.DB_PERSISTENT_CONNECTIONS = persistent
+
+    # Ускорение записи относительно legacy (у batched_bulk чтения нет)
+    legacy_write = results["legacy"]["write_hands_per_s"]
+    speedup = {mode: r["write_hands_per_s"] / legacy_write for mode, r in results.items() if legacy_write}
+    print("\nУскорение записи относительно legacy: " + ", ".join(f"{m} x{v:.2f}" for m, v in speedup.items()))
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "dir": args.dir,
+            "repeat": args.repeat,
+        },
+        "results": results,
+        "speedup": speedup,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
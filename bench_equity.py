@@ -0,0 +1,270 @@
+# bench_equity.py
+"""
+Бенчмарк и проверка точности движка эквити (estimate_equity / calculate_equity_monte_carlo).
+
+Генерирует воспроизводимый набор All-In сценариев (префлоп/флоп/тёрн, HU и 3-way,
+плюс сценарии с дележом банка), замеряет время и число оценок рук в секунду,
+сравнивает результат с полным перебором и пишет всё в JSON для сравнения между коммитами.
+
+Примеры:
+    python bench_equity.py
+    python bench_equity.py --output new.json --compare old.json
+    python bench_equity.py --exact-preflop        # очень долго: ~1.7M раскладов на сценарий
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import warnings
+from itertools import combinations
+from typing import Dict, Any, List, Optional
+
+warnings.filterwarnings("ignore", message="The field 'time_zone_abbreviation' is an unexpected field")
+
+from pokerkit import Card, Deck, StandardHighHand
+import poker_globals
+from poker_stats_db import estimate_equity
+
+RANKS = "23456789TJQKA"
+SUITS = "cdhs"
+BOARD_SIZES = {"preflop": 0, "flop": 3, "turn": 4}
+
+# Сценарии с дележом банка (фиксированные, чтобы всегда были в наборе)
+CHOP_SCENARIOS = [
+    ("preflop_hu_chop", ["AsKd", "AhKc"], ""),
+    ("preflop_3way_chop", ["AcKc", "AdKd", "7h7s"], ""),
+    ("flop_3way_trips_chop", ["AcKd", "AdKc", "2c2d"], "7s7d7h"),
+    ("turn_hu_board_chop", ["2c3d", "4s5d"], "AhKhQhJh"),
+]
+
+
+def parse_cards(cards: str) -> list:
+    return list(Card.parse(cards)) if cards else []
+
+
+def generate_scenarios(seed: int, per_group: int) -> List[Dict[str, Any]]:
+    """Случайные раздачи по группам (улица x число игроков) + сценарии с дележом."""
+    scenarios = []
+    for street, board_size in BOARD_SIZES.items():
+        for players in (2, 3):
+            # Свой сид на группу: сценарий с тем же именем не зависит от --per-group
+            rng = random.Random(f"{seed}:{street}:{players}")
+            for i in range(per_group):
+                deck = [r + s for r in RANKS for s in SUITS]
+                rng.shuffle(deck)
+                holes = ["".join(deck.pop() for _ in range(2)) for _ in range(players)]
+                board = "".join(deck.pop() for _ in range(board_size))
+                scenarios.append({
+                    "name": f"{street}_{players}way_{i + 1}",
+                    "street": street,
+                    "holes": holes,
+                    "board": board,
+                })
+    for name, holes, board in CHOP_SCENARIOS:
+        street = {0: "preflop", 3: "flop", 4: "turn"}[len(board) // 2]
+        scenarios.append({"name": name, "street": street, "holes": holes, "board": board})
+    return scenarios
+
+
+def _hero_share(hands: list) -> float:
+    best = max(hands)
+    if hands[0] != best:
+        return 0.0
+    return 1.0 / sum(1 for h in hands if h == best)
+
+
+def _remaining_deck(holes: List[list], board: list) -> list:
+    known = {str(c) for c in board}
+    for h in holes:
+        known.update(str(c) for c in h)
+    return [c for c in Deck.STANDARD if str(c) not in known]
+
+
+def reference_equity(holes: List[list], board: list, exact: bool, samples: int, seed: int) -> Dict[str, Any]:
+    """
+    Эталонное эквити Hero (holes[0]) независимым кодом: StandardHighHand.from_game.
+    exact=True — полный перебор раскладов, иначе Монте-Карло с samples итерациями.
+    """
+    deck = _remaining_deck(holes, board)
+    need = 5 - len(board)
+
+    if exact:
+        runouts = combinations(deck, need)
+    else:
+        rng = random.Random(seed)
+        runouts = (rng.sample(deck, need) for _ in range(samples))
+
+    total = 0.0
+    total_sq = 0.0
+    n = 0
+    for runout in runouts:
+        full_board = board + list(runout)
+        hands = [StandardHighHand.from_game(h, full_board) for h in holes]
+        x = _hero_share(hands)
+        total += x
+        total_sq += x * x
+        n += 1
+
+    mean = total / n
+    std_err = 0.0
+    if not exact and n > 1:
+        std_err = max(0.0, (total_sq / n - mean * mean) * n / (n - 1) / n) ** 0.5
+    return {"equity": mean, "std_err": std_err, "runouts": n, "method": "exact" if exact else "monte_carlo"}
+
+
+def run_scenario(scenario: Dict[str, Any], args) -> Dict[str, Any]:
+    holes = [parse_cards(h) for h in scenario["holes"]]
+    board = parse_cards(scenario["board"])
+    seed = f"{args.seed}:{scenario['name']}"
+
+    start = time.perf_counter()
+    equity, std_err, samples = estimate_equity(
+        holes[0], holes[1:], board, list(Deck.STANDARD),
+        tolerance=args.tolerance, seed=seed,
+        min_samples=args.min_samples, max_samples=args.max_samples
+    )
+    wall = time.perf_counter() - start
+
+    exact_ref = scenario["street"] != "preflop" or args.exact_preflop
+    ref = reference_equity(holes, board, exact_ref, args.reference_samples, args.seed)
+    abs_error = abs(equity - ref["equity"])
+    # Разброс разницы с учетом погрешности обеих оценок
+    combined_se = (std_err ** 2 + ref["std_err"] ** 2) ** 0.5
+    evaluations = samples * len(holes)
+
+    return {
+        **scenario,
+        "players": len(holes),
+        "equity": equity,
+        "std_err": std_err,
+        "samples": samples,
+        "wall_s": wall,
+        "evals_per_s": evaluations / wall if wall > 0 else 0.0,
+        "reference": ref,
+        "abs_error": abs_error,
+        "within_3se": abs_error <= 3 * combined_se + 1e-9,
+    }
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    summary = {
+        "total_wall_s": sum(r["wall_s"] for r in results),
+        "total_evaluations": sum(r["samples"] * r["players"] for r in results),
+        "max_abs_error": max(r["abs_error"] for r in results),
+        "mean_abs_error": sum(r["abs_error"] for r in results) / len(results),
+        "outside_3se": [r["name"] for r in results if not r["within_3se"]],
+        "by_street": {},
+    }
+    summary["evals_per_s"] = summary["total_evaluations"] / summary["total_wall_s"] if summary["total_wall_s"] else 0.0
+    for street in BOARD_SIZES:
+        group = [r for r in results if r["street"] == street]
+        if group:
+            summary["by_street"][street] = {
+                "scenarios": len(group),
+                "wall_s": sum(r["wall_s"] for r in group),
+                "mean_abs_error": sum(r["abs_error"] for r in group) / len(group),
+                "mean_samples": sum(r["samples"] for r in group) / len(group),
+            }
+    return summary
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current: Dict[str, Any], previous_path: str):
+    """Печатает разницу с предыдущим прогоном (по имени сценария)."""
+    try:
+        with open(previous_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    except Exception as e:
+        print(f"❌ Не удалось прочитать {previous_path}: {e}")
+        return
+
+    prev_by_name = {r["name"]: r for r in previous.get("scenarios", [])}
+    print(f"\n--- Сравнение с {previous_path} (rev {previous.get('meta', {}).get('git_revision')}) ---")
+    print(f"{'scenario':<24} {'wall_s':>16} {'evals/s':>18} {'abs_err':>18}")
+    for r in current["scenarios"]:
+        p = prev_by_name.get(r["name"])
+        if not p:
+            print(f"{r['name']:<24} (нет в предыдущем прогоне)")
+            continue
+        print(f"{r['name']:<24} {p['wall_s']:>7.3f} -> {r['wall_s']:<7.3f}"
+              f" {p['evals_per_s']:>8.0f} -> {r['evals_per_s']:<8.0f}"
+              f" {p['abs_error']:>7.4f} -> {r['abs_error']:<7.4f}")
+    ps, cs = previous.get("summary", {}), current["summary"]
+    if ps:
+        print(f"{'TOTAL':<24} {ps['total_wall_s']:>7.3f} -> {cs['total_wall_s']:<7.3f}"
+              f" {ps['evals_per_s']:>8.0f} -> {cs['evals_per_s']:<8.0f}"
+              f" {ps['max_abs_error']:>7.4f} -> {cs['max_abs_error']:<7.4f}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Equity engine benchmark and accuracy suite.")
+    parser.add_argument('--seed', type=int, default=2024, help='Сид генерации сценариев и выборок.')
+    parser.add_argument('--per-group', type=int, default=2, help='Случайных сценариев на группу (улица x число игроков).')
+    parser.add_argument('--tolerance', type=float, default=poker_globals.EV_EQUITY_TOLERANCE, help='Целевая стандартная ошибка эквити.')
+    parser.add_argument('--min-samples', type=int, default=poker_globals.EV_MIN_SAMPLES)
+    parser.add_argument('--max-samples', type=int, default=poker_globals.EV_MAX_SAMPLES)
+    parser.add_argument('--reference-samples', type=int, default=20000,
+                        help='Итераций эталонного Монте-Карло для префлопа (если нет --exact-preflop).')
+    parser.add_argument('--exact-preflop', action='store_true', help='Полный перебор и для префлопа (очень долго).')
+    parser.add_argument('--output', type=str, default='bench_equity.json', help='Файл с результатами (JSON).')
+    parser.add_argument('--compare', type=str, default=None, help='JSON предыдущего прогона для сравнения.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    scenarios = generate_scenarios(args.seed, args.per_group)
+    print(f"=== EQUITY BENCHMARK: {len(scenarios)} сценариев (seed {args.seed}) ===")
+
+    results = []
+    for scenario in scenarios:
+        r = run_scenario(scenario, args)
+        results.append(r)
+        flag = "" if r["within_3se"] else "  ⚠️ вне 3σ"
+        print(f"{r['name']:<24} eq={r['equity']:.4f} ref={r['reference']['equity']:.4f} "
+              f"err={r['abs_error']:.4f} n={r['samples']:<5} {r['wall_s']:.3f}s "
+              f"{r['evals_per_s']:.0f} evals/s{flag}")
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "per_group": args.per_group,
+            "tolerance": args.tolerance,
+            "min_samples": args.min_samples,
+            "max_samples": args.max_samples,
+            "reference_samples": args.reference_samples,
+            "exact_preflop": args.exact_preflop,
+        },
+        "summary": summarize(results),
+        "scenarios": results,
+    }
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    s = report["summary"]
+    print(f"\nИтого: {s['total_wall_s']:.2f} с, {s['evals_per_s']:.0f} evals/s, "
+          f"max err {s['max_abs_error']:.4f}, mean err {s['mean_abs_error']:.4f}")
+    if s["outside_3se"]:
+        print(f"⚠️ Вне 3σ: {', '.join(s['outside_3se'])}")
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
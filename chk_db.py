@@ -80,7 +80,7 @@ try:
     cursor.execute("""
         SELECT hand_id, cards, net_profit, ev_adjusted 
         FROM my_hand_log 
-        WHERE ev_adjusted < -1.0
+        WHERE ev_adjusted < -100
         ORDER BY ev_adjusted ASC 
         LIMIT 10
     """)
@@ -92,7 +92,7 @@ try:
     cursor.execute("""
         SELECT hand_id, cards, net_profit, ev_adjusted 
         FROM my_hand_log 
-        WHERE ABS(ev_adjusted - net_profit) > 5
+        WHERE ABS(ev_adjusted - net_profit) > 500
         LIMIT 10
     """)
     rows = cursor.fetchall()
@@ -0,0 +1,262 @@
+# db_archive.py
+
+import os
+import glob
+import sqlite3
+import datetime
+from typing import Any, List, Optional, Tuple, Iterator
+from poker_globals import DB_ARCHIVE_HOT_MONTHS, DB_ARCHIVE_MAX_ATTACHED
+from db_connection import get_connection, release_connection
+from db_writer import ensure_no_writer
+from db_maintenance import checkpoint_wal
+from db_schema import (
+    CORE_TABLE_MIGRATIONS, MY_DAILY_STATS_COLUMNS, MY_DAILY_STATS_KEY, _READY_TABLES,
+    _daily_key_exprs, _daily_value_exprs, _ensure_core_tables, _ev_cents, _hand_log_columns,
+    _run_migrations, _to_epoch
+)
+
+# --- АРХИВ ЖУРНАЛА РАЗДАЧ ПО МЕСЯЦАМ ---
+# Старые месяцы my_hand_log переносятся в отдельные файлы (по одному на месяц),
+# в основной базе остаются последние DB_ARCHIVE_HOT_MONTHS месяцев, раздачи без
+# времени и раздачи с незавершенным расчетом EV. Дневные агрегаты my_daily_stats
+# остаются в основной базе за все время (триггеров на DELETE нет), поэтому
+# полные дни get_player_extended_stats архивы не читают. Запросы по журналу
+# подключают (ATTACH) только архивы месяцев, пересекающих период.
+# Функции получают файл основной базы (db_name): архивы лежат рядом с ним.
+
+ARCHIVE_SCHEMA_PREFIX = "archive_"
+
+
+def _archive_file_name(db_name: str, month: str) -> str:
+    base = os.path.splitext(os.path.basename(db_name))[0]
+    return f"{base}_archive_{month.replace('-', '_')}.db"
+
+
+def _archive_path(db_name: str, file_name: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(db_name)), file_name)
+
+
+def _archive_files(db_name: str) -> List[str]:
+    """Файлы всех месячных архивов базы (для удаления вместе с ней)."""
+    return glob.glob(_archive_path(db_name, _archive_file_name(db_name, "*")))
+
+
+def _prepare_archive(path: str):
+    """Создает файл архива или догоняет его схему my_hand_log миграциями основной базы."""
+    if (path, "my_hand_log") in _READY_TABLES:
+        return
+    _run_migrations(path, "my_hand_log", CORE_TABLE_MIGRATIONS["my_hand_log"])
+
+
+def _ensure_archives(conn: sqlite3.Connection, db_name: str):
+    for (file_name,) in conn.execute("SELECT file_name FROM hand_log_archives").fetchall():
+        _prepare_archive(_archive_path(db_name, file_name))
+
+
+def _archive_month_bounds(month: str) -> Tuple[int, int]:
+    first = datetime.datetime.strptime(month, "%Y-%m")
+    following = (first + datetime.timedelta(days=32)).replace(day=1)
+    return _to_epoch(first), _to_epoch(following)
+
+
+def archive_hand_log(db_name: str, hot_months: int = DB_ARCHIVE_HOT_MONTHS) -> int:
+    """
+    Переносит раздачи старше hot_months месяцев в месячные архивы. Вызывается при
+    старте (после setup_database и полной загрузки), до запуска потока записи:
+    пишет своим соединением (ATTACH, VACUUM), при запущенном потоке — ошибка (ensure_no_writer).
+    Возвращает число перенесенных строк.
+    """
+    month_start = datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(max(hot_months, 1) - 1):
+        month_start = (month_start - datetime.timedelta(days=1)).replace(day=1)
+    cutoff = _to_epoch(month_start)
+
+    moved = 0
+    conn = None
+    try:
+        ensure_no_writer("Архивация журнала раздач")
+        _ensure_core_tables(db_name)
+        conn = get_connection(db_name)
+        months = [month for (month,) in conn.execute(
+            "SELECT DISTINCT strftime('%Y-%m', time_logged, 'unixepoch') FROM my_hand_log "
+            "WHERE time_logged < ? AND COALESCE(ev_pending, 0) = 0 ORDER BY 1", (cutoff,)
+        )]
+        if not months:
+            return 0
+        columns = ", ".join(_hand_log_columns(conn))
+        key_exprs = _daily_key_exprs("o.")
+        value_columns = [col for col, _ in MY_DAILY_STATS_COLUMNS]
+
+        for month in months:
+            file_name = _archive_file_name(db_name, month)
+            _prepare_archive(_archive_path(db_name, file_name))
+            time_from, time_to = _archive_month_bounds(month)
+            condition = "time_logged >= ? AND time_logged < ? AND time_logged < ? AND COALESCE(ev_pending, 0) = 0"
+            params = (time_from, time_to, cutoff)
+
+            conn.execute("ATTACH DATABASE ? AS archive_move", (_archive_path(db_name, file_name),))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                # Раздача, которая уже есть в архиве, посчитана в my_daily_stats дважды:
+                # вычитаем архивную копию перед заменой
+                conn.execute(f"""
+                    UPDATE my_daily_stats
+                    SET {', '.join(f'{col} = my_daily_stats.{col} - d.{col}' for col in value_columns)}
+                    FROM (
+                        SELECT {', '.join(f'{expr} AS {key}' for key, expr in zip(MY_DAILY_STATS_KEY, key_exprs))},
+                               {', '.join(f'SUM({expr}) AS {col}' for col, expr in zip(value_columns, _daily_value_exprs('o.')))}
+                        FROM archive_move.my_hand_log AS o
+                        JOIN main.my_hand_log AS m ON m.hand_id = o.hand_id AND m.player_name = o.player_name
+                        WHERE {condition.replace('time_logged', 'm.time_logged').replace('ev_pending', 'm.ev_pending')}
+                        GROUP BY {', '.join(key_exprs)}
+                    ) AS d
+                    WHERE {' AND '.join(f'my_daily_stats.{key} = d.{key}' for key in MY_DAILY_STATS_KEY)}
+                """, params)
+                cursor = conn.execute(
+                    f"INSERT OR REPLACE INTO archive_move.my_hand_log ({columns}) "
+                    f"SELECT {columns} FROM main.my_hand_log WHERE {condition}", params
+                )
+                moved += cursor.rowcount
+                conn.execute(f"DELETE FROM main.my_hand_log WHERE {condition}", params)
+                conn.execute(
+                    "INSERT INTO hand_log_archives (month, file_name, hands) "
+                    "VALUES (?, ?, (SELECT COUNT(*) FROM archive_move.my_hand_log)) "
+                    "ON CONFLICT (month) DO UPDATE SET file_name = excluded.file_name, hands = excluded.hands",
+                    (month, file_name)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE archive_move")
+            print(f"   [DB] Журнал за {month} перенесен в архив {file_name}")
+
+        # Место освободившихся страниц возвращаем файлу основной базы; VACUUM в WAL
+        # переписывает всю базу через WAL — его переносим и усекаем
+        conn.execute("VACUUM")
+        checkpoint_wal(db_name, "TRUNCATE")
+    except Exception as e:
+        print(f"❌ Ошибка архивации журнала раздач: {e}")
+    finally:
+        if conn:
+            release_connection(conn)
+    return moved
+
+
+def _archive_months(conn: sqlite3.Connection, min_time: Optional[datetime.datetime], max_time: Optional[datetime.datetime]) -> List[Tuple[str, str]]:
+    """Архивы [(month, file_name)], месяцы которых пересекают период [min_time, max_time]."""
+    query = "SELECT month, file_name FROM hand_log_archives WHERE hands > 0"
+    params = []
+    if min_time:
+        query += " AND month >= ?"
+        params.append(min_time.strftime("%Y-%m"))
+    if max_time:
+        query += " AND month <= ?"
+        params.append(max_time.strftime("%Y-%m"))
+    return conn.execute(query + " ORDER BY month", params).fetchall()
+
+
+def _attach_archives(conn: sqlite3.Connection, db_name: str, archives: List[Tuple[str, str]]) -> List[str]:
+    """
+    Подключает архивы к соединению (если еще не подключены) и возвращает имена их
+    таблиц журнала. Если подключенных архивов больше DB_ARCHIVE_MAX_ATTACHED,
+    лишние (не нужные этому запросу) отключаются.
+    """
+    schemas = [ARCHIVE_SCHEMA_PREFIX + month.replace("-", "_") for month, _ in archives]
+    attached = [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith(ARCHIVE_SCHEMA_PREFIX)]
+    missing = [(schema, file_name) for schema, (_, file_name) in zip(schemas, archives) if schema not in attached]
+    if missing and len(attached) + len(missing) > DB_ARCHIVE_MAX_ATTACHED:
+        for schema in attached:
+            if schema not in schemas:
+                conn.execute(f"DETACH DATABASE {schema}")
+    for schema, file_name in missing:
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (_archive_path(db_name, file_name),))
+    return [f"{schema}.my_hand_log" for schema in schemas]
+
+
+def _hand_log_table_groups(conn: sqlite3.Connection, db_name: str, min_time: Optional[datetime.datetime], max_time: Optional[datetime.datetime]) -> Iterator[List[str]]:
+    """
+    Таблицы журнала, в которых могут быть раздачи периода, группами не больше
+    DB_ARCHIVE_MAX_ATTACHED архивов: группа подключается перед тем, как ее отдать,
+    последняя группа содержит основную таблицу my_hand_log.
+    """
+    archives = _archive_months(conn, min_time, max_time)
+    for i in range(0, len(archives), DB_ARCHIVE_MAX_ATTACHED):
+        tables = _attach_archives(conn, db_name, archives[i:i + DB_ARCHIVE_MAX_ATTACHED])
+        if i + DB_ARCHIVE_MAX_ATTACHED >= len(archives):
+            tables.append("my_hand_log")
+        yield tables
+    if not archives:
+        yield ["my_hand_log"]
+
+
+def _update_archived_hand_ev(db_name: str, month: str, results: List[Tuple[Any, str, Optional[float], Optional[float]]]):
+    """
+    Записывает результаты All-In EV в архив месяца. Триггеров my_daily_stats у архивов
+    нет, поэтому вклад строк в дневные агрегаты основной базы вычитается до UPDATE и
+    прибавляется после, в одной транзакции. Как и archive_hand_log, подключает архив
+    своим соединением (ATTACH вне транзакции) — до запуска потока записи (--recompute-ev).
+    """
+    ensure_no_writer(f"Запись EV в архив {month}")
+    conn = None
+    try:
+        conn = get_connection(db_name)
+        row = conn.execute("SELECT file_name FROM hand_log_archives WHERE month = ?", (month,)).fetchone()
+        if not row:
+            raise ValueError(f"архива за {month} нет")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS ev_updates "
+                     "(hand_id TEXT, player_name TEXT, ev_adjusted INTEGER, ev_std_err REAL, is_all_in INTEGER, "
+                     "PRIMARY KEY (hand_id, player_name))")
+        conn.execute("ATTACH DATABASE ? AS archive_ev", (_archive_path(db_name, row[0]),))
+        try:
+            key_exprs = _daily_key_exprs("o.")
+            value_columns = [col for col, _ in MY_DAILY_STATS_COLUMNS]
+            source = ("FROM archive_ev.my_hand_log AS o JOIN temp.ev_updates AS u "
+                      "ON u.hand_id = o.hand_id AND u.player_name = o.player_name")
+            grouped = f"""
+                SELECT {', '.join(f'{expr} AS {key}' for key, expr in zip(MY_DAILY_STATS_KEY, key_exprs))},
+                       {', '.join(f'SUM({expr}) AS {col}' for col, expr in zip(value_columns, _daily_value_exprs('o.')))}
+                {source}
+                WHERE true
+                GROUP BY {', '.join(key_exprs)}
+            """
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO temp.ev_updates VALUES (?, ?, ?, ?, ?)",
+                    [(hand_id, player, _ev_cents(ev), float(err) if err is not None else None,
+                      int(ev is not None))
+                     for hand_id, player, ev, err in results]
+                )
+                conn.execute(f"""
+                    UPDATE my_daily_stats
+                    SET {', '.join(f'{col} = my_daily_stats.{col} - d.{col}' for col in value_columns)}
+                    FROM ({grouped}) AS d
+                    WHERE {' AND '.join(f'my_daily_stats.{key} = d.{key}' for key in MY_DAILY_STATS_KEY)}
+                """)
+                conn.execute("""
+                    UPDATE archive_ev.my_hand_log
+                    SET ev_adjusted = CASE WHEN u.is_all_in = 1 THEN u.ev_adjusted ELSE NULLIF(net_profit, 0) END,
+                        ev_std_err = u.ev_std_err,
+                        is_all_in = u.is_all_in,
+                        ev_pending = 0
+                    FROM temp.ev_updates AS u
+                    WHERE u.hand_id = my_hand_log.hand_id AND u.player_name = my_hand_log.player_name
+                """)
+                conn.execute(f"""
+                    INSERT INTO my_daily_stats ({', '.join(MY_DAILY_STATS_KEY + value_columns)})
+                    {grouped}
+                    ON CONFLICT ({', '.join(MY_DAILY_STATS_KEY)}) DO UPDATE SET
+                        {', '.join(f'{col} = {col} + excluded.{col}' for col in value_columns)}
+                """)
+                conn.execute("DELETE FROM temp.ev_updates")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            conn.execute("DETACH DATABASE archive_ev")
+    finally:
+        if conn:
+            release_connection(conn)
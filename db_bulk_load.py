@@ -0,0 +1,165 @@
+# db_bulk_load.py
+
+import poker_globals
+from db_connection import get_connection, release_connection, DB_PRAGMAS
+from db_writer import ensure_no_writer, is_db_writer_running
+from db_maintenance import analyze_database, checkpoint_wal
+from db_schema import (
+    HAND_LOG_INSERT_SQL, HAND_LOG_INSERT_COLUMNS, HAND_LOG_INDEXES, MY_DAILY_STATS_TRIGGERS,
+    PLAYER_HAND_FACTS_COLUMNS, SEGMENT_COUNTER_COLUMNS, _SEGMENT_IDS,
+    _backfill_my_daily_stats, _create_my_daily_stats_triggers, _migrate_hand_log_v2, _ensure_core_tables
+)
+from stats_store import _opponent_stats, _merge_recent_hands
+
+# --- БЫСТРАЯ ПОЛНАЯ ЗАГРУЗКА (--load-all) ---
+# Полная загрузка идет в пустую базу, поэтому построчное обслуживание индексов,
+# триггеров my_daily_stats и UPSERT статистики оппонентов после каждого файла не
+# нужно. Между begin_bulk_load и finish_bulk_load строки журнала и фактов раздач
+# копятся в неиндексированных временных таблицах, дельты оппонентов — в памяти
+# (OpponentStatsStore), а finish_bulk_load переносит все несколькими
+# INSERT…SELECT в одной транзакции и строит индексы и дневные агрегаты в конце.
+# Порядок вставки тот же, что у пачек HandBatchWriter, поэтому содержимое базы
+# совпадает с обычной загрузкой.
+
+_BULK_LOADS = set()  # {файл базы} с активной быстрой загрузкой
+
+BULK_HAND_LOG_INSERT_SQL = HAND_LOG_INSERT_SQL.replace("INSERT OR REPLACE INTO my_hand_log", "INSERT INTO temp.bulk_hand_log")
+# Факты — с именем игрока вместо player_id (id раздаются при переносе)
+BULK_PLAYER_HAND_FACTS_COLUMNS = ["player_name"] + PLAYER_HAND_FACTS_COLUMNS[1:]
+BULK_PLAYER_HAND_FACTS_INSERT_SQL = (
+    f"INSERT INTO temp.bulk_player_hand_facts VALUES ({', '.join('?' * len(BULK_PLAYER_HAND_FACTS_COLUMNS))})"
+)
+
+
+def is_bulk_loading(db_name: str) -> bool:
+    """Идет ли быстрая загрузка в базу (пачки HandBatchWriter пишутся в буферы)."""
+    return db_name in _BULK_LOADS
+
+
+def begin_bulk_load(db_name: str) -> bool:
+    """
+    Включает быструю загрузку для базы db_name. Работает только для пустого журнала,
+    долгоживущих соединений и без потока записи (временная таблица живет в соединении
+    потока загрузки, пачки должны писаться в него же); иначе возвращает False,
+    и загрузка идет обычным путем.
+    """
+    if db_name in _BULK_LOADS:
+        return True
+    if not poker_globals.DB_PERSISTENT_CONNECTIONS:
+        return False
+    if is_db_writer_running():
+        print("⚠️ Поток записи запущен: быстрая загрузка отключена")
+        return False
+    conn = None
+    try:
+        _ensure_core_tables(db_name)
+        conn = get_connection(db_name)
+        if conn.execute("SELECT 1 FROM my_hand_log LIMIT 1").fetchone():
+            print("⚠️ Журнал раздач не пуст: быстрая загрузка отключена")
+            return False
+        # Буфер может быть больше памяти; сбрасывать на диск каждую транзакцию незачем.
+        # temp_store меняется до создания буфера: смена удаляет временные таблицы.
+        conn.execute("PRAGMA temp_store=FILE;")
+        conn.execute("PRAGMA synchronous=OFF;")
+        # Без типов колонок (affinity BLOB): значения приводятся один раз, при переносе
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS bulk_hand_log ({', '.join(HAND_LOG_INSERT_COLUMNS)})")
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS bulk_player_hand_facts ({', '.join(BULK_PLAYER_HAND_FACTS_COLUMNS)})")
+        _BULK_LOADS.add(db_name)
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка включения быстрой загрузки: {e}")
+        return False
+    finally:
+        if conn:
+            release_connection(conn)
+
+
+def finish_bulk_load(db_name: str) -> int:
+    """
+    Переносит накопленное в таблицы, строит индексы и агрегаты. Возвращает число строк журнала.
+    Если перенос не удался, транзакция откатывается, а буферы, дельты оппонентов и режим
+    быстрой загрузки остаются (можно повторить вызов); ошибка пробрасывается вызывающему.
+    """
+    if db_name not in _BULK_LOADS:
+        return 0
+    ensure_no_writer("Завершение быстрой загрузки")
+    columns = ", ".join(HAND_LOG_INSERT_COLUMNS)
+    counters = ", ".join(SEGMENT_COUNTER_COLUMNS)
+    rows = 0
+    conn = None
+    try:
+        conn = get_connection(db_name)
+        pending = _opponent_stats.get_pending(db_name)
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS bulk_player_stats (segment_id, player_name, {counters})")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                f"INSERT INTO temp.bulk_player_stats VALUES ({', '.join('?' * (len(SEGMENT_COUNTER_COLUMNS) + 2))})",
+                [(_SEGMENT_IDS[(db_name, table_segment)], player_name, *delta)
+                 for (_, table_segment, player_name), delta, _ in pending]
+            )
+
+            # Индексы и триггеры агрегатов — после вставки, одним проходом
+            for trigger_name in MY_DAILY_STATS_TRIGGERS:
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+            for index_name in HAND_LOG_INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+            rows = conn.execute(
+                f"INSERT OR REPLACE INTO my_hand_log ({columns}) "
+                f"SELECT {columns} FROM temp.bulk_hand_log ORDER BY rowid"
+            ).rowcount
+            _backfill_my_daily_stats(conn)
+            _create_my_daily_stats_triggers(conn)
+            _migrate_hand_log_v2(conn, "my_hand_log")
+
+            # Игроки получают player_id в порядке первого появления, как при сбросах по файлам
+            conn.execute("INSERT OR IGNORE INTO players (name) SELECT player_name FROM temp.bulk_player_hand_facts ORDER BY rowid")
+            conn.execute("INSERT OR IGNORE INTO players (name) SELECT player_name FROM temp.bulk_player_stats ORDER BY rowid")
+            # Факты — в порядке первичного ключа (повтор раздачи: побеждает последняя запись)
+            conn.execute(f"""
+                INSERT OR REPLACE INTO player_hand_facts ({', '.join(PLAYER_HAND_FACTS_COLUMNS)})
+                SELECT p.player_id, {', '.join(f'b.{col}' for col in PLAYER_HAND_FACTS_COLUMNS[1:])}
+                FROM temp.bulk_player_hand_facts b JOIN players p ON p.name = b.player_name
+                ORDER BY p.player_id, b.hand_id, b.rowid
+            """)
+            conn.execute(f"""
+                INSERT INTO player_stats (segment_id, player_id, {counters})
+                SELECT b.segment_id, p.player_id, {', '.join(f'b.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+                FROM temp.bulk_player_stats b JOIN players p ON p.name = b.player_name
+                WHERE true
+                ON CONFLICT(segment_id, player_id) DO UPDATE SET
+                    {', '.join(f'{col} = {col} + excluded.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+            """)
+            _merge_recent_hands(conn, [(_SEGMENT_IDS[(db_name, table_segment)], player_name, words)
+                                       for (_, table_segment, player_name), _, words in pending])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        _opponent_stats.discard_pending([key for key, _, _ in pending])
+        _BULK_LOADS.discard(db_name)
+        # Буферы больше не нужны только после успешного переноса
+        conn.execute("DROP TABLE IF EXISTS temp.bulk_hand_log")
+        conn.execute("DROP TABLE IF EXISTS temp.bulk_player_hand_facts")
+        for pragma, value in DB_PRAGMAS:
+            if pragma in ("synchronous", "temp_store"):
+                conn.execute(f"PRAGMA {pragma}={value};")
+    except Exception as e:
+        print(f"❌ Ошибка завершения быстрой загрузки: {e}")
+        raise
+    finally:
+        if conn:
+            try:
+                # Собирается заново из дельт при каждом вызове
+                conn.execute("DROP TABLE IF EXISTS temp.bulk_player_stats")
+            finally:
+                release_connection(conn)
+
+    # Таблицы переписаны целиком: свежая статистика планировщика, WAL — в базу и усечь
+    try:
+        if rows:
+            analyze_database(db_name)
+        checkpoint_wal(db_name, "TRUNCATE")
+    except Exception as e:
+        print(f"⚠️ Ошибка обслуживания БД после быстрой загрузки: {e}")
+    return rows
@@ -0,0 +1,143 @@
+# db_connection.py
+
+import sqlite3
+import threading
+import weakref
+from typing import Dict, List, Tuple
+import poker_globals
+
+# --- ДОЛГОЖИВУЩИЕ СОЕДИНЕНИЯ С БД ---
+# Каждый поток (GUI, монитор, загрузчик статистики, callback пула EV) получает
+# свое соединение, которое открывается один раз: прагмы применяются при открытии,
+# а кеш подготовленных запросов (cached_statements) живет вместе с соединением.
+
+# Профиль прагм для живого пути: WAL + synchronous=NORMAL (безопасно в WAL),
+# кеш страниц ~20 МБ, mmap 256 МБ, временные таблицы в памяти; после сброса
+# WAL его файл обрезается до 64 МБ (иначе остается размером с самый большой всплеск).
+DB_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("journal_size_limit", "67108864"),
+    ("cache_size", "-20000"),
+    ("mmap_size", "268435456"),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", "5000"),
+]
+DB_CACHED_STATEMENTS = 256
+
+_local = threading.local()
+_lock = threading.Lock()
+# Все открытые соединения (для close_connections) и поколение: после закрытия
+# потоки переоткрывают соединение при следующем обращении.
+_open_connections: Dict[int, Tuple[int, sqlite3.Connection]] = {}
+_generation = 0
+
+
+class _ThreadConnections(dict):
+    """(база, readonly) -> (поколение, соединение) одного потока; dict с поддержкой weakref."""
+
+
+def _close_thread_list(connections: List[sqlite3.Connection]):
+    with _lock:
+        for conn in connections:
+            entry = _open_connections.get(id(conn))
+            if entry is not None and entry[1] is conn:
+                del _open_connections[id(conn)]
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"⚠️ Ошибка закрытия соединения с БД: {e}")
+
+
+def _open_connection(db_name: str, readonly: bool) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_name, cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
+    for pragma, value in DB_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}={value};")
+    if readonly:
+        # Соединение читателя: любая запись через него — ошибка, а не скрытая блокировка
+        conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+
+def get_connection(db_name: str, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Возвращает соединение текущего потока с базой db_name (открывает при первом вызове).
+    readonly=True — отдельное соединение только для чтения (query_only): в WAL оно
+    не ждет поток записи (db_writer.py).
+    При poker_globals.DB_PERSISTENT_CONNECTIONS = False работает как раньше:
+    новое соединение на каждый вызов, release_connection его закрывает.
+    """
+    if not poker_globals.DB_PERSISTENT_CONNECTIONS:
+        conn = sqlite3.connect(db_name)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = _ThreadConnections()
+        # Поток завершился (его thread-local удален): закрываем его соединения.
+        # Иначе каждый короткий поток (StatsLoaderThread) оставлял бы открытыми
+        # соединение и подключенные к нему архивы до выхода из программы.
+        connections.opened = []
+        weakref.finalize(connections, _close_thread_list, connections.opened)
+
+    key = (db_name, readonly)
+    entry = connections.get(key)
+    if entry is not None and entry[0] == _generation:
+        return entry[1]
+
+    if entry is not None:
+        # Закрыто через close_connections(): старое соединение больше не держим
+        connections.opened.remove(entry[1])
+    conn = _open_connection(db_name, readonly)
+    with _lock:
+        generation = _generation
+        _open_connections[id(conn)] = (generation, conn)
+    connections[key] = (generation, conn)
+    connections.opened.append(conn)
+    return conn
+
+
+def release_connection(conn: sqlite3.Connection):
+    """
+    Вызывается вместо conn.close() в конце операции.
+    Незавершенная транзакция (операция упала до commit) откатывается,
+    чтобы следующая операция потока не продолжила ее.
+    """
+    if not poker_globals.DB_PERSISTENT_CONNECTIONS:
+        conn.close()
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.ProgrammingError:
+        # Соединение уже закрыто через close_connections()
+        pass
+
+
+def close_thread_connections():
+    """Закрывает соединения текущего потока (в конце run() короткоживущих потоков)."""
+    connections = getattr(_local, "connections", None)
+    if not connections:
+        return
+    opened = list(connections.opened)
+    connections.clear()
+    connections.opened.clear()
+    _close_thread_list(opened)
+
+
+def close_connections():
+    """Закрывает соединения всех потоков (перед удалением файлов БД и при выходе)."""
+    global _generation
+    with _lock:
+        _generation += 1
+        connections = list(_open_connections.values())
+        _open_connections.clear()
+    for _, conn in connections:
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"⚠️ Ошибка закрытия соединения с БД: {e}")
@@ -0,0 +1,172 @@
+# db_maintenance.py
+
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from poker_globals import (
+    DB_MAINTENANCE_POLL_MS, DB_CHECKPOINT_IDLE_MS, DB_CHECKPOINT_WAL_BYTES,
+    DB_CHECKPOINT_WAL_MAX_BYTES, DB_ANALYZE_INTERVAL_S, DB_ANALYZE_LIMIT
+)
+from db_connection import get_connection, release_connection
+from db_writer import submit_write, get_writer_idle_ms, get_writer_commits
+
+# --- ОБСЛУЖИВАНИЕ БАЗЫ: WAL И СТАТИСТИКА ПЛАНИРОВЩИКА ---
+# Пока работает поток обслуживания, автоматический checkpoint на коммитах потока записи
+# отключен: WAL переносится в базу PASSIVE-checkpoint'ом из этого потока, когда поток
+# записи простаивает (или WAL вырос больше DB_CHECKPOINT_WAL_MAX_BYTES). PASSIVE не ждет
+# ни писателя, ни читателей. После полной загрузки и архивации WAL усекается (TRUNCATE).
+# Файл WAL после PASSIVE не уменьшается, поэтому один его размер не говорит, есть ли
+# что переносить: checkpoint нужен, только если после прошлого были коммиты потока
+# записи или прошлый перенес не все кадры.
+# ANALYZE идет через поток записи, как любая запись. Счетчики — get_maintenance_stats().
+
+# SQLite по умолчанию: checkpoint на коммите, когда в WAL 1000 страниц
+DEFAULT_WAL_AUTOCHECKPOINT = 1000
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    "checkpoints": 0,
+    "checkpoints_incomplete": 0,   # часть кадров не перенесена (их еще читают)
+    "checkpoint_ms_last": 0.0,
+    "checkpoint_ms_max": 0.0,
+    "checkpoint_ms_total": 0.0,
+    "wal_bytes_max": 0,            # наибольший WAL перед checkpoint
+    "truncates": 0,
+    "analyze_runs": 0,
+    "analyze_ms_last": 0.0,
+}
+
+
+def get_wal_size(db_name: str) -> int:
+    """Размер файла WAL базы в байтах (0, если файла нет)."""
+    try:
+        return os.path.getsize(db_name + "-wal")
+    except OSError:
+        return 0
+
+
+def checkpoint_wal(db_name: str, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+    """
+    PRAGMA wal_checkpoint(mode) на соединении текущего потока.
+    Возвращает (busy, кадров в WAL, перенесено кадров) и обновляет счетчики.
+    """
+    wal_bytes = get_wal_size(db_name)
+    conn = None
+    try:
+        conn = get_connection(db_name)
+        start = time.perf_counter()
+        busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        if conn:
+            release_connection(conn)
+
+    with _stats_lock:
+        _stats["checkpoints"] += 1
+        if busy or checkpointed < log_frames:
+            _stats["checkpoints_incomplete"] += 1
+        if mode == "TRUNCATE" and not busy:
+            _stats["truncates"] += 1
+        _stats["checkpoint_ms_last"] = elapsed_ms
+        _stats["checkpoint_ms_max"] = max(_stats["checkpoint_ms_max"], elapsed_ms)
+        _stats["checkpoint_ms_total"] += elapsed_ms
+        _stats["wal_bytes_max"] = max(_stats["wal_bytes_max"], wal_bytes)
+    if mode == "TRUNCATE" and wal_bytes:
+        print(f"   [DB] WAL {wal_bytes / 1048576:.1f} МБ перенесен в базу и усечен за {elapsed_ms:.0f} мс")
+    return busy, log_frames, checkpointed
+
+
+def analyze_database(db_name: str):
+    """ANALYZE с выборкой DB_ANALYZE_LIMIT строк на индекс (через поток записи, если он запущен)."""
+    def command(conn):
+        start = time.perf_counter()
+        conn.execute(f"PRAGMA analysis_limit={DB_ANALYZE_LIMIT}")
+        conn.execute("ANALYZE")
+        return (time.perf_counter() - start) * 1000
+
+    elapsed_ms = submit_write(db_name, command, "ANALYZE", wait=True)
+    with _stats_lock:
+        _stats["analyze_runs"] += 1
+        _stats["analyze_ms_last"] = elapsed_ms
+
+
+def get_maintenance_stats(db_name: str) -> Dict[str, Any]:
+    """Счетчики обслуживания и текущий размер WAL базы (wal_bytes)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["wal_bytes"] = get_wal_size(db_name)
+    return stats
+
+
+def _set_wal_autocheckpoint(db_name: str, pages: int):
+    # Настройка соединения потока записи: выполняем на нем же
+    submit_write(db_name, lambda conn: conn.execute(f"PRAGMA wal_autocheckpoint={pages}"),
+                 "wal_autocheckpoint", wait=True)
+
+
+class DBMaintenanceThread(threading.Thread):
+    """Поток обслуживания: checkpoint WAL при простое потока записи и периодический ANALYZE."""
+
+    def __init__(self, db_name: str):
+        super().__init__(name="DBMaintenanceThread", daemon=True)
+        self.db_name = db_name
+        self._stop_event = threading.Event()
+        self._last_analyze = time.monotonic()
+        # Состояние после прошлого checkpoint: коммиты потока записи и неперенесенные кадры
+        self._commits_at_checkpoint: Optional[int] = None
+        self._frames_left = 0
+
+    def run(self):
+        while not self._stop_event.wait(DB_MAINTENANCE_POLL_MS / 1000):
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"⚠️ Ошибка обслуживания БД: {e}")
+
+    def _tick(self):
+        idle_ms = get_writer_idle_ms()
+        idle = idle_ms is None or idle_ms >= DB_CHECKPOINT_IDLE_MS
+        wal_bytes = get_wal_size(self.db_name)
+        commits = get_writer_commits()
+        pending = commits != self._commits_at_checkpoint or self._frames_left > 0
+        if pending and (wal_bytes > DB_CHECKPOINT_WAL_MAX_BYTES or (idle and wal_bytes > DB_CHECKPOINT_WAL_BYTES)):
+            busy, log_frames, checkpointed = checkpoint_wal(self.db_name)
+            self._commits_at_checkpoint = commits
+            self._frames_left = 1 if busy else max(0, log_frames - checkpointed)
+        if idle and time.monotonic() - self._last_analyze >= DB_ANALYZE_INTERVAL_S:
+            self._last_analyze = time.monotonic()
+            analyze_database(self.db_name)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_maintenance: Optional[DBMaintenanceThread] = None
+_lock = threading.Lock()
+
+
+def start_db_maintenance(db_name: str) -> DBMaintenanceThread:
+    """
+    Запускает поток обслуживания (после start_db_writer) и отключает
+    автоматический checkpoint на соединении потока записи.
+    """
+    global _maintenance
+    with _lock:
+        if _maintenance is None:
+            _set_wal_autocheckpoint(db_name, 0)
+            _maintenance = DBMaintenanceThread(db_name)
+            _maintenance.start()
+        return _maintenance
+
+
+def stop_db_maintenance():
+    """Останавливает поток обслуживания (до stop_db_writer) и возвращает автоматический checkpoint."""
+    global _maintenance
+    with _lock:
+        maintenance = _maintenance
+        _maintenance = None
+    if maintenance is not None:
+        maintenance.stop()
+        maintenance.join()
+        _set_wal_autocheckpoint(maintenance.db_name, DEFAULT_WAL_AUTOCHECKPOINT)
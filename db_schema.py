@@ -0,0 +1,978 @@
+# db_schema.py
+
+import sqlite3
+import datetime
+import re
+from array import array
+from typing import Dict, Any, List, Optional, Tuple
+from poker_globals import ACTION_POSITIONS, DB_RECENT_HANDS
+from db_writer import submit_write
+
+# --- СХЕМА БАЗЫ СТАТИСТИКИ ---
+# Таблицы, миграции, коды текстовых колонок журнала и формат строк, которые пишут
+# poker_stats_db, stats_store, db_bulk_load и db_archive. Модуль не знает DB_NAME:
+# функции получают файл базы параметром (как db_writer и db_maintenance).
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Версия схемы каждой таблицы хранится в schema_version. Миграции выполняются
+# один раз: при старте (setup_database) или при первом обращении к базе
+# (get_segment_id). Готовые таблицы запоминаются в _READY_TABLES, поэтому
+# на пути записи раздачи DDL не выполняется вообще.
+# Миграция 1 — базовая: создает таблицу и догоняет старые базы (созданные до
+# schema_version) недостающими колонками. Новые изменения схемы — новые функции
+# в конце списков CORE_TABLE_MIGRATIONS.
+
+_READY_TABLES = set()  # {(файл базы, имя таблицы)}
+_SEGMENT_IDS: Dict[Tuple[str, str], int] = {}  # (файл базы, сегмент) -> segment_id (get_segment_id)
+
+# Статистика оппонентов: одна таблица на все сегменты, ключ (segment_id, player_id).
+# Сегменты (NL2_6MAX, ...) и игроки — справочники, имена в запросы не подставляются.
+SEGMENTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS segments (
+        segment_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,          -- NL2_6MAX
+        limit_cents INTEGER,                -- 2
+        seat_count INTEGER                  -- 6
+    );
+"""
+
+PLAYERS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS players (
+        player_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+"""
+
+PLAYER_STATS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS player_stats (
+        segment_id INTEGER NOT NULL REFERENCES segments(segment_id),
+        player_id INTEGER NOT NULL REFERENCES players(player_id),
+        hands INTEGER DEFAULT 0,
+        vpip_hands INTEGER DEFAULT 0,
+        pfr_hands INTEGER DEFAULT 0,
+        _3bet_opportunities INTEGER DEFAULT 0,
+        _3bet_successes INTEGER DEFAULT 0,
+        _fold_to_3bet_opportunities INTEGER DEFAULT 0,
+        _fold_to_3bet_successes INTEGER DEFAULT 0,
+
+        pfr_utg INTEGER DEFAULT 0,
+        pfr_mp INTEGER DEFAULT 0,
+        pfr_co INTEGER DEFAULT 0,
+        pfr_bu INTEGER DEFAULT 0,
+        pfr_sb INTEGER DEFAULT 0,
+
+        hands_utg INTEGER DEFAULT 0,
+        hands_mp INTEGER DEFAULT 0,
+        hands_co INTEGER DEFAULT 0,
+        hands_bu INTEGER DEFAULT 0,
+        hands_sb INTEGER DEFAULT 0,
+
+        rfi_opp_utg INTEGER DEFAULT 0,
+        rfi_opp_mp INTEGER DEFAULT 0,
+        rfi_opp_co INTEGER DEFAULT 0,
+        rfi_opp_bu INTEGER DEFAULT 0,
+
+        rfi_succ_utg INTEGER DEFAULT 0,
+        rfi_succ_mp INTEGER DEFAULT 0,
+        rfi_succ_co INTEGER DEFAULT 0,
+        rfi_succ_bu INTEGER DEFAULT 0,
+
+        af_bets_raises INTEGER DEFAULT 0,
+        af_calls INTEGER DEFAULT 0,
+
+        cbet_flop_opp INTEGER DEFAULT 0,
+        cbet_flop_succ INTEGER DEFAULT 0,
+        fcbet_flop_opp INTEGER DEFAULT 0,
+        fcbet_flop_succ INTEGER DEFAULT 0,
+        wtsd_hands INTEGER DEFAULT 0,
+        wsd_hands INTEGER DEFAULT 0,
+
+        PRIMARY KEY (segment_id, player_id)
+    ) WITHOUT ROWID;
+"""
+
+# Суммы по всем лимитам для игрока: GROUP BY по player_id идет по индексу
+PLAYER_STATS_COMBINED_VIEW = """
+    CREATE VIEW IF NOT EXISTS player_stats_combined AS
+    SELECT player_id, COUNT(*) AS segments, {sums}
+    FROM player_stats
+    GROUP BY player_id;
+"""
+
+# Факты раздач всех игроков (и оппонентов, и Hero): строка на (игрок, раздача)
+# для статистики за период и по позициям. Десятки миллионов строк, поэтому только
+# целые колонки, флаги в одном числе (биты PLAYER_HAND_FLAGS), без rowid и без
+# вторичных индексов: строки игрока лежат подряд по первичному ключу.
+PLAYER_HAND_FACTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS player_hand_facts (
+        player_id INTEGER NOT NULL REFERENCES players(player_id),
+        hand_id INTEGER NOT NULL,           -- номер раздачи PokerStars
+        segment_id INTEGER NOT NULL REFERENCES segments(segment_id),
+        time_logged INTEGER,                -- секунды от эпохи, как в my_hand_log
+        position INTEGER NOT NULL,          -- hand_positions.code
+        flags INTEGER NOT NULL,             -- биты PLAYER_HAND_FLAGS
+        af_bets_raises INTEGER NOT NULL,
+        af_calls INTEGER NOT NULL,
+        net_profit INTEGER NOT NULL,        -- центы
+        PRIMARY KEY (player_id, hand_id)
+    ) WITHOUT ROWID;
+"""
+
+# Флаг (бит = индекс в списке, список только дополняется) -> ключи analyze_hand_for_stats
+PLAYER_HAND_FLAGS = [
+    ("vpip", ("vpip",)),
+    ("pfr", ("pfr",)),
+    ("3bet_opp", ("3bet_opp",)),
+    ("3bet", ("3bet_success",)),
+    ("f3bet_opp", ("f3bet_opp",)),
+    ("f3bet", ("f3bet_success",)),
+    ("rfi_opp", tuple(f"rfi_opp_{pos}" for pos in ACTION_POSITIONS)),
+    ("rfi", tuple(f"rfi_succ_{pos}" for pos in ACTION_POSITIONS)),
+    ("cbet_flop_opp", ("cbet_flop_opp",)),
+    ("cbet_flop", ("cbet_flop_succ",)),
+    ("fcbet_flop_opp", ("fcbet_flop_opp",)),
+    ("fcbet_flop", ("fcbet_flop_succ",)),
+    ("wtsd", ("wtsd",)),
+    ("wsd", ("wsd",)),
+]
+PLAYER_HAND_FLAG_BITS = {name: 1 << bit for bit, (name, _) in enumerate(PLAYER_HAND_FLAGS)}
+_PLAYER_HAND_FLAG_KEYS = [(key, 1 << bit) for bit, (_, keys) in enumerate(PLAYER_HAND_FLAGS) for key in keys]
+
+# Последние DB_RECENT_HANDS раздач игрока в сегменте (OpponentStatsStore): слова
+# RecentHands подряд от старых к новым, array('I').tobytes(). Строка — до нескольких КБ,
+# поэтому обычная таблица с rowid, а не WITHOUT ROWID.
+PLAYER_RECENT_HANDS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS player_recent_hands (
+        segment_id INTEGER NOT NULL REFERENCES segments(segment_id),
+        player_id INTEGER NOT NULL REFERENCES players(player_id),
+        words BLOB NOT NULL,
+        PRIMARY KEY (segment_id, player_id)
+    );
+"""
+# Слово раздачи в окне: биты PLAYER_HAND_FLAGS в младших 16 битах,
+# AF-счетчики раздачи — по байту (с насыщением на 255)
+RECENT_HAND_FLAG_BITS = 16
+RECENT_HAND_WORD_SQL = "flags | (min(af_bets_raises, 255) << 16) | (min(af_calls, 255) << 24)"
+# Суммы окна: число раздач, по флагу, AF-счетчики
+RECENT_WINDOW_FIELDS = ["hands"] + [name for name, _ in PLAYER_HAND_FLAGS] + ["af_bets_raises", "af_calls"]
+
+# Старые базы: отдельная таблица на сегмент (NL2_6MAX, NL5_9MAX, ...)
+LEGACY_SEGMENT_TABLE_RE = re.compile(r"^NL(\d+)_(\d+)MAX$")
+
+# Колонки, которых может не быть в таблицах сегментов из старых баз
+SEGMENT_TABLE_LEGACY_COLUMNS = [
+    (col, "INTEGER DEFAULT 0") for col in [
+        "cbet_flop_opp", "cbet_flop_succ",
+        "fcbet_flop_opp", "fcbet_flop_succ",
+        "wtsd_hands", "wsd_hands"
+    ]
+]
+
+# --- КОДЫ ТЕКСТОВЫХ КОЛОНОК my_hand_log ---
+# Позиции, улицы, действия, сила руки и класс руки хранятся малыми целыми кодами.
+# Код — индекс значения в списке (списки только дополняются в конце); справочники
+# с теми же значениями создаются в базе для отчетов и view my_hand_log_text.
+# Значения вне списков пишутся как NULL. Наружу функции отдают прежние строки.
+
+_CHART_RANKS = "AKQJT98765432"
+# 169 классов рук в порядке матрицы 13x13: пары на диагонали, одномастные над ней
+HAND_CLASSES = [
+    f"{_CHART_RANKS[i]}{_CHART_RANKS[j]}" if i == j else
+    f"{_CHART_RANKS[i]}{_CHART_RANKS[j]}s" if i < j else
+    f"{_CHART_RANKS[j]}{_CHART_RANKS[i]}o"
+    for i in range(13) for j in range(13)
+]
+
+HAND_LOG_DIMENSIONS = {
+    "hand_positions": ["", "utg", "mp", "co", "bu", "sb", "bb"],
+    "hand_streets": ["preflop", "flop", "turn", "river"],
+    # first_action — коды действий pokerkit, final_action — итог для лик-файндера
+    "hand_actions": ["", "uncalled", "f", "cc", "cbr", "sm", "pb", "sd", "n/a", "Fold", "Call", "Raise"],
+    "hand_strengths": [
+        "", "High Card", "Pocket Pair", "Overpair", "Set", "Pocket Pair < Top Card",
+        "Two Pair", "Top Pair", "2nd Pair", "Weak Pair", "Pair",
+    ],
+    "hand_classes": HAND_CLASSES,
+}
+
+# Колонка my_hand_log -> справочник ее кодов
+HAND_LOG_CODED_COLUMNS = {
+    "position": "hand_positions",
+    "first_action": "hand_actions",
+    "first_raiser_position": "hand_positions",
+    "final_street": "hand_streets",
+    "final_action": "hand_actions",
+    "final_hand_strength": "hand_strengths",
+    "opponent_position": "hand_positions",
+    "normalized_hand": "hand_classes",
+}
+
+_HAND_LOG_CODES = {
+    table: {name: code for code, name in enumerate(names)}
+    for table, names in HAND_LOG_DIMENSIONS.items()
+}
+
+
+def _encode_hand_log_value(column: str, value: Optional[str]) -> Optional[int]:
+    """Код значения колонки my_hand_log (None для пустого класса руки и неизвестных значений)."""
+    if value is None:
+        return None
+    return _HAND_LOG_CODES[HAND_LOG_CODED_COLUMNS[column]].get(value)
+
+
+def _decode_hand_log_value(column: str, code: Optional[int]) -> Optional[str]:
+    """Строка по коду колонки my_hand_log (обратное к _encode_hand_log_value)."""
+    if code is None:
+        return None
+    names = HAND_LOG_DIMENSIONS[HAND_LOG_CODED_COLUMNS[column]]
+    return names[code] if 0 <= code < len(names) else None
+
+
+def _hand_log_code_sql(column: str, otherwise: str = "NULL") -> str:
+    """CASE-выражение, переводящее старое текстовое значение колонки в код."""
+    names = HAND_LOG_DIMENSIONS[HAND_LOG_CODED_COLUMNS[column]]
+    cases = " ".join(f"WHEN '{name}' THEN {code}" for code, name in enumerate(names))
+    return f"CASE {column} {cases} ELSE {otherwise} END"
+
+
+# --- ВРЕМЯ РАЗДАЧ ---
+# time_logged — целые секунды от эпохи. Время в истории рук без часового пояса
+# (часы клиента PokerStars), поэтому в эпоху оно переводится как время зоны
+# HAND_LOG_TIME_ZONE; зона записывается в db_meta при создании базы. Дни агрегатов
+# и месяцы архивов считаются в той же зоне: date(time_logged, 'unixepoch').
+HAND_LOG_TIME_ZONE = "UTC"
+_HAND_LOG_TZ = datetime.timezone.utc
+
+
+def _to_epoch(value: Optional[datetime.datetime]) -> Optional[int]:
+    """Секунды от эпохи для времени раздачи или границы периода (None — без времени)."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=_HAND_LOG_TZ)
+    return int(value.timestamp())
+
+
+MY_HAND_LOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS my_hand_log (
+        hand_id TEXT NOT NULL,                  -- Идентификатор раздачи (уникальный)
+        table_part_name TEXT NOT NULL,          -- Часть имени стола для привязки к HUD
+        player_name TEXT NOT NULL,
+        position INTEGER NOT NULL,              -- Позиция: hand_positions.code (utg, mp, co, bu, sb, bb)
+        cards TEXT NOT NULL,                    -- Карты игрока (например, "AsKc")
+        is_rfi BOOLEAN NOT NULL,                -- RFI (да/нет)
+        is_pfr BOOLEAN NOT NULL,                -- PFR (да/нет)
+        is_vpip BOOLEAN NOT NULL,               -- VPIP (да/нет)
+        first_action INTEGER,                   -- Первое действие (рейз, колл, фолд): hand_actions.code
+        first_raiser_position INTEGER,          -- hand_positions.code
+        is_steal_attempt BOOLEAN NOT NULL,
+        net_profit INTEGER,                     -- Профит в центах (все суммы журнала — целые центы)
+        time_logged INTEGER DEFAULT (CAST(strftime('%s', 'now', 'localtime') AS INTEGER)),  -- Секунды от эпохи (_to_epoch)
+
+        final_street INTEGER,                   -- hand_streets.code
+        final_action INTEGER,                   -- hand_actions.code
+        final_hand_strength INTEGER,            -- hand_strengths.code
+        facing_bet_pct_pot DECIMAL(5,2),
+        opponent_position INTEGER,              -- hand_positions.code
+        board_cards TEXT,
+        rfi_opportunity INTEGER DEFAULT 0,
+        bb_size INTEGER DEFAULT 0,          -- Большой блайнд в центах
+        ev_adjusted INTEGER DEFAULT 0,      -- All-In EV в центах
+        ev_pending INTEGER DEFAULT 0,       -- 1, пока All-In EV считается в фоновом пуле
+        ev_std_err REAL,                    -- стандартная ошибка EV в центах (0 = полный перебор)
+        is_all_in INTEGER DEFAULT 0,        -- 1, если EV посчитан по моменту All-In
+
+        -- Новые колонки для защиты BB и стилов
+        facing_steal INTEGER DEFAULT 0,  -- 1, если игрок на BB/SB и получил опен-рейз с CO/BU/SB
+        is_steal_defend INTEGER DEFAULT 0, -- 1, если заколлировал (Cold Call)
+        is_steal_3bet INTEGER DEFAULT 0,   -- 1, если сделал 3-бет
+        is_steal_fold INTEGER DEFAULT 0,   -- 1, если сфолдил
+        steal_success INTEGER DEFAULT 0,    -- 1, если наш стил удался (все сфолдили)
+
+        normalized_hand INTEGER,            -- Класс руки 0..168 (AKs, 99, T8o): hand_classes.code
+
+        -- New BB vs Limp Stats columns
+        facing_limp INTEGER DEFAULT 0,
+        is_limp_check INTEGER DEFAULT 0,
+        is_limp_iso INTEGER DEFAULT 0,
+
+        -- WTSD & WSD
+        wtsd INTEGER DEFAULT 0,
+        wsd INTEGER DEFAULT 0,
+
+        -- C-Bet & 3-Bet Stats
+        is_3bet INTEGER DEFAULT 0,
+        is_3bet_opp INTEGER DEFAULT 0,
+        is_cbet INTEGER DEFAULT 0,
+        cbet_opp INTEGER DEFAULT 0,
+        is_fold_to_cbet INTEGER DEFAULT 0,
+        fold_to_cbet_opp INTEGER DEFAULT 0,
+
+        is_fold_to_3bet INTEGER DEFAULT 0,
+        fold_to_3bet_opp INTEGER DEFAULT 0,
+
+        segment_id INTEGER DEFAULT 0,       -- segments.segment_id (0 = неизвестен, старые записи)
+
+        PRIMARY KEY (hand_id, player_name)
+    );
+"""
+
+# Колонки All-In EV в my_hand_log (фоновый пул, точность, пересчет)
+HAND_LOG_EV_COLUMNS = [
+    ("ev_pending", "INTEGER DEFAULT 0"),
+    ("ev_std_err", "REAL"),
+    ("is_all_in", "INTEGER DEFAULT 0")
+]
+
+# Колонки, которых может не быть в my_hand_log из старых баз (в порядке их появления)
+HAND_LOG_LEGACY_COLUMNS = [
+    ("final_street", "INTEGER"),
+    ("final_action", "INTEGER"),
+    ("final_hand_strength", "INTEGER"),
+    ("facing_bet_pct_pot", "DECIMAL(5,2)"),
+    ("opponent_position", "INTEGER"),
+    ("board_cards", "TEXT"),
+    ("rfi_opportunity", "INTEGER DEFAULT 0"),
+    ("normalized_hand", "INTEGER"),
+    ("facing_limp", "INTEGER DEFAULT 0"),
+    ("is_limp_check", "INTEGER DEFAULT 0"),
+    ("is_limp_iso", "INTEGER DEFAULT 0"),
+    ("wtsd", "INTEGER DEFAULT 0"),
+    ("wsd", "INTEGER DEFAULT 0"),
+    ("is_3bet", "INTEGER DEFAULT 0"),
+    ("is_3bet_opp", "INTEGER DEFAULT 0"),
+    ("is_cbet", "INTEGER DEFAULT 0"),
+    ("cbet_opp", "INTEGER DEFAULT 0"),
+    ("is_fold_to_cbet", "INTEGER DEFAULT 0"),
+    ("fold_to_cbet_opp", "INTEGER DEFAULT 0"),
+    ("is_fold_to_3bet", "INTEGER DEFAULT 0"),
+    ("fold_to_3bet_opp", "INTEGER DEFAULT 0"),
+    ("bb_size", "INTEGER DEFAULT 0"),
+    ("ev_adjusted", "INTEGER DEFAULT 0"),
+    # Защита BB и стилы
+    ("facing_steal", "INTEGER DEFAULT 0"),
+    ("is_steal_defend", "INTEGER DEFAULT 0"),
+    ("is_steal_3bet", "INTEGER DEFAULT 0"),
+    ("is_steal_fold", "INTEGER DEFAULT 0"),
+    ("steal_success", "INTEGER DEFAULT 0"),
+    *HAND_LOG_EV_COLUMNS
+]
+
+
+def _add_missing_columns(conn: sqlite3.Connection, table_name: str, columns: List[Tuple[str, str]]):
+    """ALTER TABLE ADD COLUMN только для колонок, которых еще нет в таблице."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    for col_name, col_type in columns:
+        if col_name not in existing:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_name} {col_type}")
+
+
+def _migrate_hand_log_v1(conn: sqlite3.Connection, table_name: str):
+    conn.execute(MY_HAND_LOG_SCHEMA)
+    _add_missing_columns(conn, table_name, HAND_LOG_LEGACY_COLUMNS)
+
+
+# Индексы my_hand_log под запросы Hero:
+# - (player_name, time_logged): диапазон по времени (целые секунды) в get_player_extended_stats и
+#   get_player_hand_log_df, ORDER BY time_logged без сортировки;
+# - частичные покрывающие индексы для матрицы рук (get_chart_hands_data): в индекс
+#   попадают только строки с флагом = 1, запрос по позиции и периоду не читает саму
+#   таблицу. Сам флаг добавлен последним столбцом: SQLite 3.40 иначе не считает
+#   индекс покрывающим.
+HAND_LOG_INDEXES = {
+    "idx_hand_log_player_time": "ON my_hand_log (player_name, time_logged)",
+    **{
+        f"idx_hand_log_chart_{flag}": f"ON my_hand_log (player_name, position, time_logged, normalized_hand, {flag}) WHERE {flag} = 1"
+        for flag in ("is_vpip", "is_pfr", "is_rfi")
+    },
+}
+
+
+def _migrate_hand_log_v2(conn: sqlite3.Connection, table_name: str):
+    for index_name, definition in HAND_LOG_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} {definition}")
+
+
+def _migrate_hand_log_v3(conn: sqlite3.Connection, table_name: str):
+    _add_missing_columns(conn, table_name, [("segment_id", "INTEGER DEFAULT 0")])
+
+
+# Денежные колонки my_hand_log, которые до v4 хранились в долларах (float)
+HAND_LOG_MONEY_COLUMNS = ["net_profit", "bb_size", "ev_adjusted"]
+
+
+def _migrate_hand_log_v4(conn: sqlite3.Connection, table_name: str):
+    """Переводит суммы журнала из долларов в целые центы (и архивы — через _prepare_archive)."""
+    # Триггеры агрегатов иначе пересчитали бы my_daily_stats по каждой строке;
+    # агрегат переводится в центы отдельно (_migrate_my_daily_stats_v2)
+    for trigger_name in MY_DAILY_STATS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    conn.execute(f"""
+        UPDATE my_hand_log SET
+            {', '.join(f"{col} = CAST(ROUND({col} * 100) AS INTEGER)" for col in HAND_LOG_MONEY_COLUMNS)},
+            ev_std_err = ev_std_err * 100
+    """)
+
+
+def _rebuild_hand_log(conn: sqlite3.Connection, table_name: str, converters: Dict[str, str]):
+    """
+    Пересобирает my_hand_log по MY_HAND_LOG_SCHEMA (тип колонки в SQLite иначе не
+    поменять). converters — SQL-выражения для колонок, значения которых меняют формат.
+    Триггеры агрегатов снимаются (их пересоздает миграция my_daily_stats), индексы
+    и view my_hand_log_text создаются заново.
+    """
+    for trigger_name in MY_DAILY_STATS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    # RENAME перенес бы view на старую таблицу
+    had_text_view = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'my_hand_log_text'").fetchone()
+    conn.execute("DROP VIEW IF EXISTS my_hand_log_text")
+    old_columns = _hand_log_columns(conn)
+    conn.execute("ALTER TABLE my_hand_log RENAME TO my_hand_log_old")
+    conn.execute(MY_HAND_LOG_SCHEMA)
+    columns = [col for col in _hand_log_columns(conn) if col in old_columns]
+    conn.execute(f"""
+        INSERT INTO my_hand_log ({', '.join(columns)})
+        SELECT {', '.join(converters.get(col, col) for col in columns)}
+        FROM my_hand_log_old
+    """)
+    # Индексы старой таблицы удаляются вместе с ней
+    conn.execute("DROP TABLE my_hand_log_old")
+    _migrate_hand_log_v2(conn, table_name)
+    if had_text_view:
+        _create_hand_log_text_view(conn)
+
+
+def _migrate_hand_log_v5(conn: sqlite3.Connection, table_name: str):
+    """Текстовые колонки HAND_LOG_CODED_COLUMNS -> целые коды (архивы — так же)."""
+    _rebuild_hand_log(conn, table_name, {col: _hand_log_code_sql(col) for col in HAND_LOG_CODED_COLUMNS})
+
+
+# До v6 time_logged — текст 'YYYY-MM-DD HH:MM:SS' (адаптер datetime модуля sqlite3).
+# strftime('%s') читает его как UTC — это и есть HAND_LOG_TIME_ZONE
+HAND_LOG_TIME_TEXT_SQL = "CASE WHEN typeof(time_logged) = 'text' THEN CAST(strftime('%s', time_logged) AS INTEGER) ELSE time_logged END"
+
+
+def _migrate_hand_log_v6(conn: sqlite3.Connection, table_name: str):
+    """time_logged -> секунды от эпохи, колонка INTEGER (архивы — так же)."""
+    types = {row[1]: row[2] for row in conn.execute("PRAGMA main.table_info(my_hand_log)")}
+    if types.get("time_logged") == "INTEGER":
+        # Таблицу только что пересобрала _migrate_hand_log_v5: меняются лишь значения
+        for trigger_name in MY_DAILY_STATS_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+        conn.execute(f"UPDATE my_hand_log SET time_logged = {HAND_LOG_TIME_TEXT_SQL} WHERE typeof(time_logged) = 'text'")
+    else:
+        _rebuild_hand_log(conn, table_name, {"time_logged": HAND_LOG_TIME_TEXT_SQL})
+
+
+# --- ДНЕВНЫЕ АГРЕГАТЫ HERO (my_daily_stats) ---
+# Одна строка на (игрок, день, позиция, сегмент) с суммами, которые раньше
+# get_player_extended_stats считал по всем строкам my_hand_log. Суммы ведут триггеры
+# на my_hand_log, поэтому агрегат обновляется в той же транзакции, что и вставка
+# раздачи (и пересчет EV). Полные дни берутся из агрегатов, неполные крайние дни
+# периода — из my_hand_log по индексу (player_name, time_logged).
+
+# (колонка агрегата, выражение для одной строки my_hand_log; {r} — префикс NEW./OLD.)
+# Порядок совпадает с разбором результата в get_player_extended_stats (без position).
+MY_DAILY_STATS_COLUMNS = [
+    ("total_hands", "1"),
+    ("pfr_sum", "{r}is_pfr"),
+    ("vpip_sum", "{r}is_vpip"),
+    ("rfi_sum", "{r}is_rfi"),
+    ("rfi_opp_sum", "{r}rfi_opportunity"),
+    ("facing_steal_sum", "{r}facing_steal"),
+    ("steal_fold_sum", "{r}is_steal_fold"),
+    ("steal_call_sum", "{r}is_steal_defend"),
+    ("steal_3bet_sum", "{r}is_steal_3bet"),
+    ("steal_att_sum", "{r}is_steal_attempt"),
+    ("steal_succ_sum", "{r}steal_success"),
+    ("facing_limp_sum", "{r}facing_limp"),
+    ("limp_check_sum", "{r}is_limp_check"),
+    ("limp_iso_sum", "{r}is_limp_iso"),
+    ("wtsd_sum", "{r}wtsd"),
+    ("wsd_sum", "{r}wsd"),
+    ("saw_flop_sum", "CASE WHEN {r}final_street != 0 OR {r}wtsd = 1 THEN 1 ELSE 0 END"),  # 0 = preflop
+    ("p3bet_sum", "{r}is_3bet"),
+    ("p3bet_opp_sum", "{r}is_3bet_opp"),
+    ("cbet_sum", "{r}is_cbet"),
+    ("cbet_opp_sum", "{r}cbet_opp"),
+    ("fcbet_sum", "{r}is_fold_to_cbet"),
+    ("fcbet_opp_sum", "{r}fold_to_cbet_opp"),
+    ("f3bet_sum", "{r}is_fold_to_3bet"),
+    ("f3bet_opp_sum", "{r}fold_to_3bet_opp"),
+    ("net_won_sum", "{r}net_profit"),
+    ("wsd_profit_sum", "CASE WHEN {r}wtsd > 0 THEN {r}net_profit ELSE 0 END"),
+    ("wnsd_profit_sum", "CASE WHEN {r}wtsd = 0 OR {r}wtsd IS NULL THEN {r}net_profit ELSE 0 END"),
+    ("ev_sum", "COALESCE({r}ev_adjusted, {r}net_profit)"),
+    # Суммы в BB — дробные (центы / центы, * 1.0 против целочисленного деления)
+    ("bb_won_sum", "CASE WHEN {r}bb_size > 0 THEN {r}net_profit * 1.0 / {r}bb_size ELSE 0 END"),
+    ("wsd_bb_sum", "CASE WHEN {r}wtsd > 0 AND {r}bb_size > 0 THEN {r}net_profit * 1.0 / {r}bb_size ELSE 0 END"),
+    ("wnsd_bb_sum", "CASE WHEN ({r}wtsd = 0 OR {r}wtsd IS NULL) AND {r}bb_size > 0 THEN {r}net_profit * 1.0 / {r}bb_size ELSE 0 END"),
+    ("ev_bb_sum", "CASE WHEN {r}bb_size > 0 THEN COALESCE({r}ev_adjusted, {r}net_profit) * 1.0 / {r}bb_size ELSE 0 END"),
+]
+# Денежные суммы (net_won_sum, ..., ev_sum) — целые центы, как в my_hand_log
+MY_DAILY_STATS_REAL_COLUMNS = {"bb_won_sum", "wsd_bb_sum", "wnsd_bb_sum", "ev_bb_sum"}
+MY_DAILY_STATS_CENTS_COLUMNS = ["net_won_sum", "wsd_profit_sum", "wnsd_profit_sum", "ev_sum"]
+MY_DAILY_STATS_KEY = ["player_name", "day", "position", "segment_id"]
+
+
+def _daily_key_exprs(r: str = "") -> List[str]:
+    """Выражения ключа my_daily_stats для строки my_hand_log (r — префикс NEW./OLD.)."""
+    return [
+        f"{r}player_name",
+        f"COALESCE(date({r}time_logged, 'unixepoch'), '')",
+        f"{r}position",
+        f"COALESCE({r}segment_id, 0)",
+    ]
+
+
+def _daily_value_exprs(r: str = "") -> List[str]:
+    """Вклад одной строки my_hand_log в каждую колонку агрегата (NULL считается нулем)."""
+    exprs = []
+    for col, expr in MY_DAILY_STATS_COLUMNS:
+        expr = expr.format(r=r)
+        if col in MY_DAILY_STATS_REAL_COLUMNS:
+            exprs.append(f"COALESCE({expr}, 0)")
+        else:
+            exprs.append(f"CAST(COALESCE({expr}, 0) AS INTEGER)")
+    return exprs
+
+
+def _daily_upsert_sql(r: str) -> str:
+    columns = ", ".join(MY_DAILY_STATS_KEY + [col for col, _ in MY_DAILY_STATS_COLUMNS])
+    values = ", ".join(_daily_key_exprs(r) + _daily_value_exprs(r))
+    updates = ", ".join(f"{col} = {col} + excluded.{col}" for col, _ in MY_DAILY_STATS_COLUMNS)
+    return (f"INSERT INTO my_daily_stats ({columns}) VALUES ({values}) "
+            f"ON CONFLICT ({', '.join(MY_DAILY_STATS_KEY)}) DO UPDATE SET {updates};")
+
+
+def _daily_subtract_sql(r: str, source: str = "", condition: str = "") -> str:
+    """Вычитает из агрегата вклад строки my_hand_log (r — префикс OLD. или алиас из source)."""
+    updates = ", ".join(f"{col} = {col} - {expr}" for (col, _), expr in zip(MY_DAILY_STATS_COLUMNS, _daily_value_exprs(r)))
+    match = [f"my_daily_stats.{key} = {expr}" for key, expr in zip(MY_DAILY_STATS_KEY, _daily_key_exprs(r))]
+    if condition:
+        match.append(condition)
+    return f"UPDATE my_daily_stats SET {updates} {source} WHERE {' AND '.join(match)};"
+
+
+MY_DAILY_STATS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS my_daily_stats (
+            player_name TEXT NOT NULL,
+            day TEXT NOT NULL,               -- YYYY-MM-DD из time_logged ('' если времени нет)
+            position INTEGER NOT NULL,       -- hand_positions.code
+            segment_id INTEGER NOT NULL,     -- segments.segment_id (0 = неизвестен)
+            {columns},
+            PRIMARY KEY (player_name, day, position, segment_id)
+        ) WITHOUT ROWID;
+"""
+
+
+def _create_my_daily_stats_table(conn: sqlite3.Connection):
+    columns = ",\n".join(
+        f"{col} {'REAL' if col in MY_DAILY_STATS_REAL_COLUMNS else 'INTEGER'} NOT NULL DEFAULT 0"
+        for col, _ in MY_DAILY_STATS_COLUMNS
+    )
+    conn.execute(MY_DAILY_STATS_SCHEMA.format(columns=columns))
+
+
+def _migrate_my_daily_stats_v1(conn: sqlite3.Connection, table_name: str):
+    """Создает my_daily_stats, триггеры на my_hand_log и заполняет агрегат по уже записанным раздачам."""
+    _create_my_daily_stats_table(conn)
+    _create_my_daily_stats_triggers(conn)
+    _backfill_my_daily_stats(conn)
+
+
+def _migrate_my_daily_stats_v2(conn: sqlite3.Connection, table_name: str):
+    """
+    Денежные суммы агрегата — в целые центы (вслед за _migrate_hand_log_v4).
+    Таблица пересобирается с INTEGER-колонками. Дни, раздачи которых есть в my_hand_log,
+    пересчитываются из уже округленных строк; дни, ушедшие в архивы (целыми месяцами),
+    переносятся из старого агрегата с умножением сумм на 100.
+    """
+    types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(my_daily_stats)")}
+    if types.get("net_won_sum") == "REAL":
+        columns = MY_DAILY_STATS_KEY + [col for col, _ in MY_DAILY_STATS_COLUMNS]
+        conn.execute("ALTER TABLE my_daily_stats RENAME TO my_daily_stats_v1")
+        _create_my_daily_stats_table(conn)
+        _backfill_my_daily_stats(conn)
+        # OR IGNORE: ключи, уже пересчитанные из my_hand_log, не трогаем.
+        # my_hand_log к этому моменту уже в кодах (_migrate_hand_log_v5) — позиция тоже
+        values = [
+            f"CAST(ROUND({col} * 100) AS INTEGER)" if col in MY_DAILY_STATS_CENTS_COLUMNS
+            else _hand_log_code_sql(col, otherwise=col) if col == 'position' else col
+            for col in columns
+        ]
+        conn.execute(f"""
+            INSERT OR IGNORE INTO my_daily_stats ({', '.join(columns)})
+            SELECT {', '.join(values)}
+            FROM my_daily_stats_v1
+        """)
+        conn.execute("DROP TABLE my_daily_stats_v1")
+    # Триггеры сняты в _migrate_hand_log_v4; новые делят центы на bb_size как REAL
+    for trigger_name in MY_DAILY_STATS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    _create_my_daily_stats_triggers(conn)
+
+
+def _migrate_my_daily_stats_v3(conn: sqlite3.Connection, table_name: str):
+    """Позиция в ключе агрегата — код hand_positions (вслед за _migrate_hand_log_v5)."""
+    columns = MY_DAILY_STATS_KEY + [col for col, _ in MY_DAILY_STATS_COLUMNS]
+    conn.execute("ALTER TABLE my_daily_stats RENAME TO my_daily_stats_v2")
+    _create_my_daily_stats_table(conn)
+    # Строки, уже переведенные в коды (_migrate_my_daily_stats_v2), остаются как есть
+    conn.execute(f"""
+        INSERT INTO my_daily_stats ({', '.join(columns)})
+        SELECT {', '.join(_hand_log_code_sql(col, otherwise=col) if col == 'position' else col for col in columns)}
+        FROM my_daily_stats_v2
+    """)
+    conn.execute("DROP TABLE my_daily_stats_v2")
+    # Триггеры сняты вместе со старой my_hand_log (_migrate_hand_log_v5)
+    for trigger_name in MY_DAILY_STATS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    _create_my_daily_stats_triggers(conn)
+
+
+def _migrate_my_daily_stats_v4(conn: sqlite3.Connection, table_name: str):
+    """Триггеры считают день из time_logged в секундах (вслед за _migrate_hand_log_v6); дни те же."""
+    for trigger_name in MY_DAILY_STATS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    _create_my_daily_stats_triggers(conn)
+
+
+def _migrate_hand_log_dimension_v1(conn: sqlite3.Connection, table_name: str):
+    """Справочник кодов колонок my_hand_log (HAND_LOG_DIMENSIONS) для отчетов и my_hand_log_text."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            code INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+    """)
+    conn.executemany(f"INSERT OR IGNORE INTO {table_name} (code, name) VALUES (?, ?)",
+                     list(enumerate(HAND_LOG_DIMENSIONS[table_name])))
+
+
+def _create_hand_log_text_view(conn: sqlite3.Connection):
+    """
+    View my_hand_log_text: my_hand_log с расшифрованными кодами и временем
+    'YYYY-MM-DD HH:MM:SS' (в прежних текстовых колонках) — для ручных запросов и скриптов проверки.
+    """
+    select, joins = [], []
+    for col in _hand_log_columns(conn):
+        dimension = HAND_LOG_CODED_COLUMNS.get(col)
+        if dimension:
+            select.append(f"d_{col}.name AS {col}")
+            joins.append(f"LEFT JOIN {dimension} AS d_{col} ON d_{col}.code = l.{col}")
+        elif col == "time_logged":
+            select.append(f"datetime(l.{col}, 'unixepoch') AS {col}")
+        else:
+            select.append(f"l.{col}")
+    conn.execute(f"CREATE VIEW IF NOT EXISTS my_hand_log_text AS SELECT {', '.join(select)} FROM my_hand_log AS l {' '.join(joins)}")
+
+
+def _migrate_hand_log_text_v1(conn: sqlite3.Connection, table_name: str):
+    _create_hand_log_text_view(conn)
+
+
+def _migrate_hand_log_text_v2(conn: sqlite3.Connection, table_name: str):
+    """Время в view — снова текстом (time_logged в секундах с _migrate_hand_log_v6)."""
+    conn.execute("DROP VIEW IF EXISTS my_hand_log_text")
+    _create_hand_log_text_view(conn)
+
+
+def _migrate_db_meta_v1(conn: sqlite3.Connection, table_name: str):
+    """Параметры базы (ключ-значение): time_zone — зона, в которой записано время раздач."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS db_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """)
+    conn.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('time_zone', ?)", (HAND_LOG_TIME_ZONE,))
+
+
+MY_DAILY_STATS_TRIGGERS = ["trg_my_daily_stats_replace", "trg_my_daily_stats_insert", "trg_my_daily_stats_update"]
+
+
+def _create_my_daily_stats_triggers(conn: sqlite3.Connection):
+    # INSERT OR REPLACE удаляет старую строку без DELETE-триггеров (recursive_triggers
+    # выключены), поэтому ее вклад вычитается перед вставкой.
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_my_daily_stats_replace BEFORE INSERT ON my_hand_log
+        BEGIN
+            {_daily_subtract_sql("o.", "FROM my_hand_log AS o", "o.hand_id = NEW.hand_id AND o.player_name = NEW.player_name")}
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_my_daily_stats_insert AFTER INSERT ON my_hand_log
+        BEGIN
+            {_daily_upsert_sql("NEW.")}
+        END;
+    """)
+    # Пересчет EV (update_hand_ev_batch_in_db) и любые другие UPDATE строки
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_my_daily_stats_update AFTER UPDATE ON my_hand_log
+        BEGIN
+            {_daily_subtract_sql("OLD.")}
+            {_daily_upsert_sql("NEW.")}
+        END;
+    """)
+
+
+def _backfill_my_daily_stats(conn: sqlite3.Connection):
+    """Заполняет my_daily_stats по уже записанным раздачам (одним GROUP BY)."""
+    key_exprs = _daily_key_exprs()
+    conn.execute(f"""
+        INSERT INTO my_daily_stats ({', '.join(MY_DAILY_STATS_KEY + [col for col, _ in MY_DAILY_STATS_COLUMNS])})
+        SELECT {', '.join(key_exprs)}, {', '.join(f"SUM({expr})" for expr in _daily_value_exprs())}
+        FROM my_hand_log
+        GROUP BY {', '.join(key_exprs)}
+    """)
+
+
+def _migrate_hand_offsets_v1(conn: sqlite3.Connection, table_name: str):
+    # Индекс раздач: где в файле истории лежит текст раздачи (для --recompute-ev)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hand_offsets (
+            hand_id TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            byte_offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+    """)
+
+
+def _migrate_hand_log_archives_v1(conn: sqlite3.Connection, table_name: str):
+    # Справочник месячных архивов my_hand_log (archive_hand_log)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hand_log_archives (
+            month TEXT PRIMARY KEY,          -- YYYY-MM
+            file_name TEXT NOT NULL,         -- файл архива рядом с основной базой
+            hands INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+
+
+def _migrate_segments_v1(conn: sqlite3.Connection, table_name: str):
+    conn.execute(SEGMENTS_SCHEMA)
+
+
+def _migrate_players_v1(conn: sqlite3.Connection, table_name: str):
+    conn.execute(PLAYERS_SCHEMA)
+
+
+def _insert_segment(conn: sqlite3.Connection, table_segment: str) -> int:
+    """Возвращает segment_id сегмента, добавляя его в справочник при необходимости."""
+    match = LEGACY_SEGMENT_TABLE_RE.match(table_segment)
+    limit_cents, seat_count = (int(match.group(1)), int(match.group(2))) if match else (None, None)
+    conn.execute("INSERT OR IGNORE INTO segments (name, limit_cents, seat_count) VALUES (?, ?, ?)",
+                 (table_segment, limit_cents, seat_count))
+    return conn.execute("SELECT segment_id FROM segments WHERE name = ?", (table_segment,)).fetchone()[0]
+
+
+def _migrate_player_stats_v1(conn: sqlite3.Connection, table_name: str):
+    """Создает player_stats и переносит в нее таблицы сегментов старых баз (после чего удаляет их)."""
+    conn.execute(PLAYER_STATS_SCHEMA)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_player_stats_player ON player_stats (player_id)")
+    conn.execute(PLAYER_STATS_COMBINED_VIEW.format(
+        sums=", ".join(f"SUM({col}) AS {col}" for col in SEGMENT_COUNTER_COLUMNS)
+    ))
+
+    legacy_tables = [
+        name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        if LEGACY_SEGMENT_TABLE_RE.match(name)
+    ]
+    columns = ", ".join(SEGMENT_COUNTER_COLUMNS)
+    for legacy_table in legacy_tables:
+        _add_missing_columns(conn, legacy_table, SEGMENT_TABLE_LEGACY_COLUMNS)
+        segment_id = _insert_segment(conn, legacy_table)
+        conn.execute(f"INSERT OR IGNORE INTO players (name) SELECT player_name FROM {legacy_table}")
+        conn.execute(f"""
+            INSERT INTO player_stats (segment_id, player_id, {columns})
+            SELECT ?, p.player_id, {', '.join(f't.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+            FROM {legacy_table} t JOIN players p ON p.name = t.player_name
+        """, (segment_id,))
+        conn.execute(f"DROP TABLE {legacy_table}")
+        conn.execute("DELETE FROM schema_version WHERE table_name = ?", (legacy_table,))
+        print(f"   [DB] Таблица {legacy_table} перенесена в player_stats")
+
+
+def _migrate_player_hand_facts_v1(conn: sqlite3.Connection, table_name: str):
+    # Факты пишутся только для новых раздач: старые оппоненты есть лишь в счетчиках
+    conn.execute(PLAYER_HAND_FACTS_SCHEMA)
+
+
+def _migrate_player_recent_hands_v1(conn: sqlite3.Connection, table_name: str):
+    """Создает player_recent_hands и заполняет окна из player_hand_facts."""
+    conn.execute(PLAYER_RECENT_HANDS_SCHEMA)
+    rows = conn.execute(f"""
+        SELECT segment_id, player_id, {RECENT_HAND_WORD_SQL} FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY segment_id, player_id ORDER BY hand_id DESC) AS n
+            FROM player_hand_facts
+        )
+        WHERE n <= ?
+        ORDER BY segment_id, player_id, hand_id
+    """, (DB_RECENT_HANDS,))
+    windows: Dict[Tuple[int, int], array] = {}
+    for segment_id, player_id, word in rows:
+        windows.setdefault((segment_id, player_id), array('I')).append(word)
+    conn.executemany("INSERT OR REPLACE INTO player_recent_hands (segment_id, player_id, words) VALUES (?, ?, ?)",
+                     [(*key, words.tobytes()) for key, words in windows.items()])
+
+
+# Порядок важен: player_stats и player_hand_facts ссылаются на segments и players,
+# триггеры my_daily_stats — на колонки my_hand_log, view my_hand_log_text —
+# на my_hand_log и справочники кодов
+CORE_TABLE_MIGRATIONS = {
+    "db_meta": [_migrate_db_meta_v1],
+    "my_hand_log": [_migrate_hand_log_v1, _migrate_hand_log_v2, _migrate_hand_log_v3, _migrate_hand_log_v4,
+                    _migrate_hand_log_v5, _migrate_hand_log_v6],
+    "hand_offsets": [_migrate_hand_offsets_v1],
+    "hand_log_archives": [_migrate_hand_log_archives_v1],
+    "segments": [_migrate_segments_v1],
+    "players": [_migrate_players_v1],
+    "player_stats": [_migrate_player_stats_v1],
+    "player_hand_facts": [_migrate_player_hand_facts_v1],
+    "player_recent_hands": [_migrate_player_recent_hands_v1],
+    "my_daily_stats": [_migrate_my_daily_stats_v1, _migrate_my_daily_stats_v2, _migrate_my_daily_stats_v3,
+                       _migrate_my_daily_stats_v4],
+    **{table: [_migrate_hand_log_dimension_v1] for table in HAND_LOG_DIMENSIONS},
+    "my_hand_log_text": [_migrate_hand_log_text_v1, _migrate_hand_log_text_v2],
+}
+
+
+def _run_migrations(db_name: str, table_name: str, migrations: list):
+    """
+    Доводит таблицу базы db_name (основной или архива журнала) до последней версии схемы
+    одной транзакцией через submit_write (поток записи, если он запущен): второй поток
+    дождется первого и увидит уже записанную версию.
+    """
+
+    def migrate(conn):
+        # Без потока записи submit_write не открывает транзакцию сам, а DDL ее не начинает
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+        """)
+        row = conn.execute("SELECT version FROM schema_version WHERE table_name = ?", (table_name,)).fetchone()
+        version = row[0] if row else 0
+        for migration in migrations[version:]:
+            migration(conn, table_name)
+        if version < len(migrations):
+            conn.execute("INSERT OR REPLACE INTO schema_version (table_name, version) VALUES (?, ?)",
+                         (table_name, len(migrations)))
+
+    submit_write(db_name, migrate, f"миграции {table_name}", wait=True)
+    _READY_TABLES.add((db_name, table_name))
+
+
+def _ensure_core_tables(db_name: str):
+    for table_name, migrations in CORE_TABLE_MIGRATIONS.items():
+        if (db_name, table_name) not in _READY_TABLES:
+            _run_migrations(db_name, table_name, migrations)
+
+
+# --- ФОРМАТ СТРОК АГРЕГАТОВ, ФАКТОВ И ЖУРНАЛА ---
+
+# Колонки агрегатов сегмента и ключи дельт из analyze_hand_for_stats (hands считается отдельно)
+SEGMENT_DELTA_FIELDS = [
+    ("vpip_hands", "vpip"),
+    ("pfr_hands", "pfr"),
+    ("_3bet_opportunities", "3bet_opp"),
+    ("_3bet_successes", "3bet_success"),
+    ("_fold_to_3bet_opportunities", "f3bet_opp"),
+    ("_fold_to_3bet_successes", "f3bet_success"),
+    *[(f"pfr_{pos}", f"pfr_{pos}") for pos in ["utg", "mp", "co", "bu", "sb"]],
+    *[(f"hands_{pos}", f"hands_{pos}") for pos in ["utg", "mp", "co", "bu", "sb"]],
+    *[(f"rfi_opp_{pos}", f"rfi_opp_{pos}") for pos in ACTION_POSITIONS],
+    *[(f"rfi_succ_{pos}", f"rfi_succ_{pos}") for pos in ACTION_POSITIONS],
+    ("af_bets_raises", "af_bets_raises"),
+    ("af_calls", "af_calls"),
+    ("cbet_flop_opp", "cbet_flop_opp"),
+    ("cbet_flop_succ", "cbet_flop_succ"),
+    ("fcbet_flop_opp", "fcbet_flop_opp"),
+    ("fcbet_flop_succ", "fcbet_flop_succ"),
+    ("wtsd_hands", "wtsd"),
+    ("wsd_hands", "wsd"),
+]
+# Флаги (True/False), а не счетчики
+SEGMENT_FLAG_KEYS = {"vpip", "pfr", "wtsd", "wsd"}
+
+# Порядок счетчиков в массиве: hands + колонки SEGMENT_DELTA_FIELDS
+SEGMENT_COUNTER_COLUMNS = ["hands"] + [col for col, _ in SEGMENT_DELTA_FIELDS]
+_COUNTER_INDEX = {col: i for i, col in enumerate(SEGMENT_COUNTER_COLUMNS)}
+
+# UPSERT дельт агрегатов: (segment_id, имя игрока, hands, *дельты)
+PLAYER_STATS_UPSERT_SQL = f"""
+    INSERT INTO player_stats (segment_id, player_id, {', '.join(SEGMENT_COUNTER_COLUMNS)})
+    VALUES (?, (SELECT player_id FROM players WHERE name = ?), {', '.join('?' * len(SEGMENT_COUNTER_COLUMNS))})
+    ON CONFLICT(segment_id, player_id) DO UPDATE SET
+        {', '.join(f'{col} = {col} + excluded.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+"""
+
+
+def _segment_delta(data: Dict[str, Any]) -> List[int]:
+    """Дельты одной раздачи игрока в порядке SEGMENT_DELTA_FIELDS."""
+    return [
+        (1 if data.get(key, False) else 0) if key in SEGMENT_FLAG_KEYS else data.get(key, 0)
+        for _, key in SEGMENT_DELTA_FIELDS
+    ]
+
+
+PLAYER_HAND_FACTS_COLUMNS = [
+    "player_id", "hand_id", "segment_id", "time_logged", "position",
+    "flags", "af_bets_raises", "af_calls", "net_profit",
+]
+# Строка факта: (имя игрока, *остальные колонки); player_id ищется по имени
+PLAYER_HAND_FACTS_INSERT_SQL = f"""
+    INSERT OR REPLACE INTO player_hand_facts ({', '.join(PLAYER_HAND_FACTS_COLUMNS)})
+    VALUES ((SELECT player_id FROM players WHERE name = ?), {', '.join('?' * (len(PLAYER_HAND_FACTS_COLUMNS) - 1))})
+"""
+
+
+def _player_hand_flags(data: Dict[str, Any]) -> int:
+    """Флаги раздачи игрока одним числом (биты PLAYER_HAND_FLAGS)."""
+    flags = 0
+    for key, mask in _PLAYER_HAND_FLAG_KEYS:
+        if data.get(key):
+            flags |= mask
+    return flags
+
+
+HAND_LOG_INSERT_SQL = """
+    INSERT OR REPLACE INTO my_hand_log (
+        hand_id, table_part_name, player_name, position, cards,
+        is_rfi, is_pfr, is_vpip, first_action, first_raiser_position,
+        is_steal_attempt, net_profit, time_logged,
+        final_street, final_action, final_hand_strength,
+        facing_bet_pct_pot, opponent_position, board_cards,
+        rfi_opportunity,
+        facing_steal, is_steal_defend, is_steal_3bet, is_steal_fold, steal_success,
+        facing_limp, is_limp_check, is_limp_iso, normalized_hand,
+        wtsd, wsd,
+        is_3bet, is_3bet_opp, is_cbet, cbet_opp, is_fold_to_cbet, fold_to_cbet_opp,
+        is_fold_to_3bet, fold_to_3bet_opp,
+        bb_size, ev_adjusted, ev_pending, ev_std_err, is_all_in,
+        segment_id
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+HAND_LOG_INSERT_COLUMNS = [
+    col.strip() for col in re.search(r"my_hand_log \((.*?)\) VALUES", HAND_LOG_INSERT_SQL, re.S).group(1).split(",")
+]
+
+
+def _ev_cents(ev_adjusted: Optional[float]) -> Optional[int]:
+    """
+    EV для колонки ev_adjusted: целые центы, а нулевой EV — NULL (читатели берут
+    COALESCE(ev_adjusted, net_profit)). Одно правило для вставки и для UPDATE результата EV.
+    """
+    if ev_adjusted is None:
+        return None
+    return round(ev_adjusted) or None
+
+
+def _hand_log_columns(conn: sqlite3.Connection) -> List[str]:
+    # Порядок колонок в старых базах (ALTER TABLE) и в архивах может отличаться
+    return [row[1] for row in conn.execute("PRAGMA main.table_info(my_hand_log)")]
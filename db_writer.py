@@ -0,0 +1,218 @@
+# db_writer.py
+
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional, List
+from poker_globals import DB_WRITE_QUEUE_MAX, DB_WRITE_GROUP_MAX
+from db_connection import get_connection, release_connection
+
+# --- ЕДИНСТВЕННЫЙ ПОТОК ЗАПИСИ В БД ---
+# Пишет в SQLite только этот поток: монитор, callback пула EV и сброс статистики
+# оппонентов кладут команды в ограниченную очередь, а поток забирает все, что
+# накопилось (до DB_WRITE_GROUP_MAX), и выполняет их одной транзакцией (group commit).
+# Читатели используют свои соединения только для чтения (get_connection(..., readonly=True))
+# и в WAL не ждут писателя. Пока поток не запущен (полная загрузка, скрипты),
+# submit_write выполняет команду сразу в вызывающем потоке.
+
+# Команда — функция f(conn) -> результат. Она не должна вызывать commit/rollback:
+# транзакцией управляет submit_write (или поток записи).
+WriteCommand = Callable[[sqlite3.Connection], Any]
+
+
+class _PendingWrite:
+    __slots__ = ("db_name", "command", "description", "done", "result", "error")
+
+    def __init__(self, db_name: str, command: WriteCommand, description: str, wait: bool):
+        self.db_name = db_name
+        self.command = command
+        self.description = description
+        self.done = threading.Event() if wait else None
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+_STOP = object()
+
+
+class DBWriterThread(threading.Thread):
+    """Поток записи: забирает команды из очереди и выполняет их пачками в одной транзакции."""
+
+    def __init__(self, max_queue: int = DB_WRITE_QUEUE_MAX, group_max: int = DB_WRITE_GROUP_MAX):
+        super().__init__(name="DBWriterThread", daemon=True)
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.group_max = group_max
+        self.transactions = 0
+        self.commands = 0
+        # Идет ли сейчас группа и когда закончилась последняя (perf_counter) — по ним
+        # db_maintenance.py понимает, что поток записи простаивает
+        self.busy = False
+        self.last_commit = time.perf_counter()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            self.busy = True
+            group = [item]
+            while len(group) < self.group_max:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                group.append(item)
+
+            # Команды разных баз (тесты, бенчмарк) идут своими транзакциями, порядок сохраняется
+            start = 0
+            for i in range(1, len(group) + 1):
+                if i == len(group) or group[i].db_name != group[start].db_name:
+                    self._execute_group(group[start:i])
+                    start = i
+            self.last_commit = time.perf_counter()
+            self.busy = False
+
+    def _execute_group(self, group: List[_PendingWrite]):
+        conn = None
+        try:
+            conn = get_connection(group[0].db_name)
+            conn.execute("BEGIN IMMEDIATE")
+            for item in group:
+                # SAVEPOINT: ошибка одной команды откатывает только ее
+                conn.execute("SAVEPOINT write_command")
+                try:
+                    item.result = item.command(conn)
+                    conn.execute("RELEASE write_command")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_command")
+                    conn.execute("RELEASE write_command")
+                    item.error = e
+            conn.commit()
+            self.transactions += 1
+            self.commands += len(group)
+        except Exception as e:
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            for item in group:
+                if item.error is None:
+                    item.error = e
+        finally:
+            if conn:
+                release_connection(conn)
+
+        for item in group:
+            if item.done is not None:
+                item.done.set()
+            elif item.error is not None:
+                print(f"❌ Ошибка записи в БД ({item.description}): {item.error}")
+
+
+_writer: Optional[DBWriterThread] = None
+_lock = threading.Lock()
+
+
+def start_db_writer() -> DBWriterThread:
+    """Запускает поток записи (если еще не запущен)."""
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = DBWriterThread()
+            _writer.start()
+        return _writer
+
+
+def stop_db_writer():
+    """Дописывает все команды из очереди и останавливает поток записи."""
+    global _writer
+    with _lock:
+        writer = _writer
+        _writer = None
+    if writer is not None:
+        writer.queue.put(_STOP)
+        writer.join()
+
+
+def submit_write(db_name: str, command: WriteCommand, description: str = "", wait: bool = False) -> Any:
+    """
+    Выполняет команду записи. С запущенным потоком — ставит в очередь (при полной
+    очереди вызывающий поток ждет места). wait=True — дождаться коммита и вернуть
+    результат команды (ошибка команды пробрасывается вызывающему).
+    Без потока записи команда выполняется сразу в своей транзакции.
+    """
+    writer = _writer
+    if writer is None:
+        return _execute_now(db_name, command)
+    if threading.current_thread() is writer:
+        # Вложенная запись из команды: в уже открытой транзакции группы
+        return command(get_connection(db_name))
+
+    item = _PendingWrite(db_name, command, description, wait)
+    writer.queue.put(item)
+    if not wait:
+        return None
+    item.done.wait()
+    if item.error is not None:
+        raise item.error
+    return item.result
+
+
+def is_db_writer_running() -> bool:
+    return _writer is not None
+
+
+def ensure_no_writer(description: str):
+    """
+    Для операций, которые пишут своим соединением мимо потока записи (ATTACH, VACUUM,
+    временные таблицы соединения): при запущенном потоке они снова ловили бы
+    "database is locked", поэтому разрешены только до start_db_writer().
+    """
+    if _writer is not None:
+        raise RuntimeError(f"{description}: выполняется только до запуска потока записи (start_db_writer)")
+
+
+def wait_for_writes(db_name: str):
+    """Ждет, пока поток записи закоммитит все команды, поставленные до вызова."""
+    submit_write(db_name, lambda conn: None, wait=True)
+
+
+def get_pending_writes() -> int:
+    """Количество команд в очереди потока записи."""
+    writer = _writer
+    return writer.queue.qsize() if writer is not None else 0
+
+
+def get_writer_idle_ms() -> Optional[float]:
+    """Сколько мс поток записи простаивает (очередь пуста); None — поток не запущен."""
+    writer = _writer
+    if writer is None:
+        return None
+    if writer.busy or writer.queue.qsize():
+        return 0.0
+    return (time.perf_counter() - writer.last_commit) * 1000
+
+
+def get_writer_commits() -> int:
+    """Число транзакций, закоммиченных потоком записи (0 — поток не запущен)."""
+    writer = _writer
+    return writer.transactions if writer is not None else 0
+
+
+def _execute_now(db_name: str, command: WriteCommand) -> Any:
+    conn = None
+    try:
+        conn = get_connection(db_name)
+        result = command(conn)
+        conn.commit()
+        return result
+    except Exception:
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            release_connection(conn)
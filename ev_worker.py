@@ -0,0 +1,206 @@
+# ev_worker.py
+
+import os
+import time
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Dict, Optional, Tuple, Any, List
+from pokerkit import HandHistory
+from my_pokerkit_parser import CustomHandHistory
+from poker_globals import EV_WORKER_COUNT, EV_RECOMPUTE_BATCH_SIZE
+from poker_stats_db import calculate_all_in_ev, update_hand_ev_in_db, update_hand_ev_batch_in_db
+
+# --- ФОНОВЫЙ ПУЛ ДЛЯ РАСЧЕТА ALL-IN EV ---
+# Монте-Карло и реплей состояний занимают сотни миллисекунд на раздачу,
+# поэтому на живом пути раздача с моментом All-In пишется сразу (ev_pending = 1),
+# а EV считается в отдельных процессах и дописывается UPDATE-ом.
+# Процессы (а не потоки) выбраны, чтобы расчет не конкурировал за GIL с GUI.
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_pending_jobs = 0
+
+# Результат расчета: (EV в целых центах, стандартная ошибка EV в центах — REAL, как ev_std_err)
+EvResult = Tuple[int, float]
+
+
+def _ev_result(hand_history: HandHistory, player_name: str, net_profit: int) -> Optional[EvResult]:
+    ev_result = calculate_all_in_ev(hand_history, player_name, net_profit)
+    if ev_result is None:
+        return None
+    ev_val, ev_std_err = ev_result
+    return round(ev_val), ev_std_err
+
+
+def _compute_ev_job(hand_history: HandHistory, player_name: str, net_profit: int) -> Tuple[Any, str, Optional[EvResult]]:
+    """Выполняется в процессе пула: только расчет, без доступа к БД."""
+    return hand_history.hand, player_name, _ev_result(hand_history, player_name, net_profit)
+
+
+def _on_job_done(future: Future):
+    """Callback пула: записывает результат в БД и уменьшает счетчик очереди."""
+    global _pending_jobs
+    try:
+        if not future.cancelled():
+            hand_id, player_name, ev_result = future.result()
+            if ev_result is None:
+                update_hand_ev_in_db(hand_id, player_name, None)
+            else:
+                update_hand_ev_in_db(hand_id, player_name, *ev_result)
+    except Exception as e:
+        print(f"❌ Ошибка фонового расчета EV: {e}")
+    finally:
+        with _lock:
+            _pending_jobs -= 1
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=EV_WORKER_COUNT)
+    return _executor
+
+
+def submit_ev_job(hand_history: HandHistory, player_name: str, net_profit: int):
+    """Ставит раздачу в очередь на расчет All-In EV (net_profit в центах). Не блокирует вызывающий поток."""
+    global _pending_jobs
+    with _lock:
+        executor = _get_executor()
+        _pending_jobs += 1
+    try:
+        future = executor.submit(_compute_ev_job, hand_history, player_name, int(net_profit))
+    except Exception as e:
+        with _lock:
+            _pending_jobs -= 1
+        print(f"❌ Не удалось поставить расчет EV в очередь: {e}")
+        return
+    future.add_done_callback(_on_job_done)
+
+
+def _on_pending_job_done(player_name: str, future: Future):
+    """Callback дозапуска (resubmit_pending_ev_jobs): пишет EV, только если раздачу удалось прочитать."""
+    global _pending_jobs
+    try:
+        if not future.cancelled():
+            hand_id, replayed, ev_result = future.result()
+            if replayed:
+                if ev_result is None:
+                    update_hand_ev_in_db(hand_id, player_name, None)
+                else:
+                    update_hand_ev_in_db(hand_id, player_name, *ev_result)
+    except Exception as e:
+        print(f"❌ Ошибка фонового расчета EV: {e}")
+    finally:
+        with _lock:
+            _pending_jobs -= 1
+
+
+def resubmit_pending_ev_jobs(candidates: List[Tuple[str, int, str, int, int, Optional[str]]], player_name: str) -> int:
+    """
+    Ставит в фоновый пул раздачи, оставшиеся с ev_pending = 1 после прошлого запуска
+    (пул остановлен до расчета). Текст раздачи читается по индексу hand_offsets, как в
+    --recompute-ev. Нечитаемая раздача остается с ev_pending до следующего запуска.
+    Возвращает число поставленных раздач.
+    """
+    global _pending_jobs
+    submitted = 0
+    for hand_id, net, path, offset, length, _ in candidates:
+        with _lock:
+            executor = _get_executor()
+            _pending_jobs += 1
+        try:
+            future = executor.submit(_recompute_ev_job, (hand_id, int(net), path, offset, length, player_name))
+        except Exception as e:
+            with _lock:
+                _pending_jobs -= 1
+            print(f"❌ Не удалось поставить расчет EV в очередь: {e}")
+            break
+        future.add_done_callback(partial(_on_pending_job_done, player_name))
+        submitted += 1
+    return submitted
+
+
+def get_pending_ev_jobs() -> int:
+    """Количество раздач, ожидающих расчета EV (в очереди и в работе)."""
+    with _lock:
+        return _pending_jobs
+
+
+def shutdown_ev_workers(wait: bool = True):
+    """
+    Останавливает пул. Задачи, не успевшие стартовать, отменяются:
+    такие раздачи остаются в БД с ev_pending = 1 и при следующем запуске
+    снова ставятся в пул (resubmit_pending_ev_jobs).
+    """
+    global _executor
+    with _lock:
+        executor = _executor
+        _executor = None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=True)
+
+
+# --- ПАКЕТНЫЙ ПЕРЕСЧЕТ EV (--recompute-ev) ---
+
+def _recompute_ev_job(task: Tuple[str, int, str, int, int, str]) -> Tuple[str, bool, Optional[EvResult]]:
+    """
+    Читает одну раздачу по смещению из индекса и пересчитывает EV (в процессе пула).
+    Возвращает (hand_id, replayed, EV): replayed = False, если раздачу не удалось
+    прочитать (файл изменился или переехал) — такую строку в БД не трогаем.
+    """
+    hand_id, net_profit, file_path, byte_offset, length, player_name = task
+    try:
+        with open(file_path, 'rb') as f:
+            f.seek(byte_offset)
+            hand_text = f.read(length).decode('utf-8-sig')
+        hh = next(iter(CustomHandHistory.from_pokerstars(hand_text, error_status=True)), None)
+    except Exception as e:
+        print(f"⚠️ Не удалось прочитать раздачу {hand_id}: {e}")
+        return hand_id, False, None
+    if hh is None or str(hh.hand) != hand_id:
+        print(f"⚠️ Раздача {hand_id} не найдена по смещению {byte_offset} в {os.path.basename(file_path)}")
+        return hand_id, False, None
+    return hand_id, True, _ev_result(hh, player_name, net_profit)
+
+
+def recompute_all_in_ev(candidates: List[Tuple[str, int, str, int, int, Optional[str]]], player_name: str) -> Tuple[int, int]:
+    """
+    Пересчитывает All-In EV для раздач-кандидатов на всех ядрах.
+    candidates: [(hand_id, net_profit в центах, file_path, byte_offset, length, month)] из индекса
+    hand_offsets (month — архив строки, None — основная база).
+    Результаты пишутся пачками по EV_RECOMPUTE_BATCH_SIZE в одной транзакции (пачка — по базе строки).
+    Раздачи, которые не удалось прочитать из файла, пропускаются: их EV в БД остается прежним.
+    Возвращает (пересчитано раздач, пропущено раздач).
+    """
+    tasks = [(hand_id, net, path, offset, length, player_name) for hand_id, net, path, offset, length, _ in candidates]
+    if not tasks:
+        return 0, 0
+
+    workers = os.cpu_count() or 1
+    chunksize = max(1, min(16, len(tasks) // (workers * 4)))
+    start = time.perf_counter()
+    done = 0
+    skipped = 0
+    batches: Dict[Optional[str], list] = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_recompute_ev_job, tasks, chunksize=chunksize)
+        for candidate, (hand_id, replayed, ev_result) in zip(candidates, results):
+            if not replayed:
+                skipped += 1
+                continue
+            ev_val, ev_std_err = ev_result if ev_result is not None else (None, None)
+            month = candidate[5]
+            batch = batches.setdefault(month, [])
+            batch.append((hand_id, player_name, ev_val, ev_std_err))
+            done += 1
+            if len(batch) >= EV_RECOMPUTE_BATCH_SIZE:
+                update_hand_ev_batch_in_db(batch, month)
+                batches[month] = []
+                elapsed = time.perf_counter() - start
+                print(f"   EV: {done}/{len(tasks)} раздач ({done / elapsed:.1f} раздач/с)")
+
+    for month, batch in batches.items():
+        update_hand_ev_batch_in_db(batch, month)
+    return done, skipped
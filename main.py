@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 import signal
 import argparse
 import warnings
@@ -19,9 +20,17 @@ else:
     pwc = None
 
 # Импорт модулей проекта (предполагается, что они доступны)
-from poker_globals import MY_PLAYER_NAME, TARGET_HISTORY_DIR, FILE_SIZES, StatUpdateData
-from poker_monitor import WatchdogThread, MonitorSignals, process_file_full_load, is_tournament_file
-from poker_stats_db import setup_database, get_stats_for_players, get_player_extended_stats, remove_database_files
+import poker_globals
+from poker_globals import MY_PLAYER_NAME, TARGET_HISTORY_DIR, FILE_SIZES, StatUpdateData, DB_NAME, HUD_STATS_SCOPES
+from poker_monitor import WatchdogThread, MonitorSignals, process_file_full_load, is_tournament_file, index_hand_offsets
+from poker_stats_db import setup_database, get_stats_for_players, get_player_extended_stats, remove_database_files, get_all_in_ev_candidates, clear_ev_pending_in_db, flush_opponent_stats
+from table_stats_service import TableStatsService
+from ev_worker import shutdown_ev_workers, get_pending_ev_jobs, recompute_all_in_ev, resubmit_pending_ev_jobs
+from db_connection import close_connections
+from db_writer import start_db_writer, stop_db_writer, wait_for_writes
+from db_maintenance import start_db_maintenance, stop_db_maintenance, get_maintenance_stats
+from db_bulk_load import begin_bulk_load, finish_bulk_load
+from db_archive import archive_hand_log
 from personal_stats_hud import PersonalStatsWindow
 from datetime import datetime
 # Import Custom MacOS Adapter to bypass pywinctl issues
@@ -261,6 +270,8 @@ class HUDWindow(QWidget):
 
         if not self.current_table_players:
             table_info = f"Стол: {self.active_table_name}\nСегмент: {self.active_table_segment}" if self.active_table_name else "Неизвестно"
+            if self.active_table_name and poker_globals.HUD_STATS_SCOPE != "segment":
+                table_info += f" (статистика: {poker_globals.HUD_STATS_SCOPE})"
             self.status_label.setText(f"{table_info}\nОжидание игроков...")
             self.status_label.adjustSize()
             self.status_label.show()
@@ -337,6 +348,11 @@ class HUDWindow(QWidget):
                     f"WTSD:{data['wtsd']} WSD:{data['wsd']}\n"
                     f"AF:{data.get('af', '0.0')}"
                 )
+                # Последние DB_RECENT_HANDS раздач, если окно короче всей истории игрока
+                recent = data.get('recent')
+                if recent and 0 < recent['hands'] < hands_val:
+                    hud_line += (f"\nL{recent['hands']}: {recent['vpip']}/{recent['pfr']}"
+                                 f" 3B:{recent['3bet']} AF:{recent['af']}")
 
                 player_label = QLabel(hud_line)
                 player_label.setParent(self) # Обязательно привязываем к окну
@@ -538,9 +554,11 @@ class HUDWindow(QWidget):
 
 class HUDManager(QObject):
     """Класс для управления множеством HUDWindow, по одному на активный стол."""
-    def __init__(self):
+    def __init__(self, stats_service: Optional[TableStatsService] = None):
         super().__init__()
         self.active_huds: Dict[str, HUDWindow] = {}
+        # Закрытые столы убираем и из пакетного чтения статистики монитора
+        self.stats_service = stats_service
 
         # --- Новый код для личной статистики ---
         self.my_player_name = MY_PLAYER_NAME # <-- Ваш никнейм
@@ -572,6 +590,8 @@ class HUDManager(QObject):
         """Удаляет HUD из списка менеджера, когда соответствующий стол закрыт."""
         if file_path in self.active_huds:
             self.active_huds.pop(file_path)
+            if self.stats_service:
+                self.stats_service.forget_table(file_path)
             print(f"MANAGER: Удален HUD для файла: {os.path.basename(file_path)}. Активных HUD: {len(self.active_huds)}")
 
     def close_all(self):
@@ -597,15 +617,65 @@ def run_full_load(directory: str, filter_segment: Optional[str] = None, filter_d
         if os.path.isfile(os.path.join(directory, item)) and item.endswith('.txt')
     ]
 
+    # Быстрый путь: буфер без индексов, перенос и индексы в конце (db_bulk_load)
+    begin_bulk_load(DB_NAME)
     count = 0
-    for full_path in files_to_process:
-        process_file_full_load(full_path, filter_segment=args.filter_segment, filter_date=args.filter_date)
-        count += 1
-        if count % 50 == 0:
-            print(f"   Обработано {count} файлов...")
+    try:
+        for full_path in files_to_process:
+            process_file_full_load(full_path, filter_segment=args.filter_segment, filter_date=args.filter_date)
+            count += 1
+            if count % 50 == 0:
+                print(f"   Обработано {count} файлов...")
+    finally:
+        try:
+            finish_bulk_load(DB_NAME)
+        except Exception as e:
+            # Перенос откатан: журнал и статистика оппонентов в базе остались пустыми
+            print(f"❌ Полная загрузка не завершена: {e}. Запустите --load-all еще раз.")
+            sys.exit(1)
 
     print(f"--- ✅ Полная загрузка завершена. Обработано файлов: {count} ---")
 
+def run_ev_recompute(directory: str):
+    """Пересчитывает All-In EV для уже загруженных раздач Hero без переимпорта базы."""
+    print("--- 🔁 ПЕРЕСЧЕТ ALL-IN EV ---")
+    indexed = index_hand_offsets(directory)
+    candidates = get_all_in_ev_candidates(MY_PLAYER_NAME)
+    located = [c for c in candidates if c[2] is not None]
+    archived = sum(1 for c in candidates if c[5] is not None)
+    print(f"   Раздач в индексе: {indexed}. Кандидатов All-In: {len(candidates)} (из архивов: {archived}), найдено в файлах: {len(located)}")
+    if len(located) < len(candidates):
+        print(f"⚠️ {len(candidates) - len(located)} раздач нет в файлах истории '{directory}', они пропущены.")
+
+    start = time.perf_counter()
+    done, skipped = recompute_all_in_ev(located, MY_PLAYER_NAME)
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+    if skipped:
+        print(f"⚠️ {skipped} раздач не удалось прочитать из файлов (файл изменился или переехал): их EV не изменен.")
+    print(f"--- ✅ Пересчет EV завершен: {done} раздач за {elapsed:.1f} с ({rate:.1f} раздач/с) ---")
+
+def resume_pending_ev(directory: str):
+    """
+    Дозапускает расчет EV для раздач, оставшихся с ev_pending = 1 (пул остановлен до расчета).
+    Раздачи, которых нет в файлах истории, больше не посчитать: флаг снимается, EV = профит.
+    """
+    pending = get_all_in_ev_candidates(MY_PLAYER_NAME, pending_only=True)
+    if not pending:
+        return
+    if any(c[2] is None for c in pending):
+        # Живой путь не ведет индекс раздач: строим его, только если он нужен
+        index_hand_offsets(directory)
+        wait_for_writes(DB_NAME)
+        pending = get_all_in_ev_candidates(MY_PLAYER_NAME, pending_only=True)
+    located = [c for c in pending if c[2] is not None]
+    lost = [(c[0], MY_PLAYER_NAME) for c in pending if c[2] is None]
+    if lost:
+        print(f"⚠️ {len(lost)} раздач с незавершенным EV нет в файлах истории '{directory}': EV остается равным профиту.")
+        clear_ev_pending_in_db(lost)
+    submitted = resubmit_pending_ev_jobs(located, MY_PLAYER_NAME)
+    print(f"--- 🔁 Дозапуск расчета EV: {submitted} раздач ---")
+
 def parse_arguments():
     """Настраивает и выполняет парсинг аргументов командной строки."""
     parser = argparse.ArgumentParser(description="Poker HUD and Hand History Monitor.")
@@ -640,6 +710,21 @@ def parse_arguments():
         help='Фильтровать историю раздач по дате (включительно) в формате YYYY-MM-DD.'
     )
 
+    # --- Пересчет All-In EV без переимпорта ---
+    parser.add_argument(
+        '--recompute-ev',
+        action='store_true',
+        help='Пересчитать All-In EV для раздач Hero в базе и выйти (использует файлы из --dir).'
+    )
+
+    # --- Какие лимиты суммировать в статистике оппонентов HUD ---
+    parser.add_argument(
+        '--hud-scope',
+        choices=HUD_STATS_SCOPES,
+        default=poker_globals.HUD_STATS_SCOPE,
+        help='Статистика оппонентов в HUD: segment — лимит стола, seats — все лимиты с тем же числом мест, all — все лимиты.'
+    )
+
     # Добавьте аргумент для директории, если она передается как аргумент
     # parser.add_argument('directory', type=str, help='Путь к директории с историей раздач.')
 
@@ -650,6 +735,7 @@ if __name__ == '__main__':
     args = parse_arguments()
 
     TARGET_HISTORY_DIR = args.dir
+    poker_globals.HUD_STATS_SCOPE = args.hud_scope
 
     if not os.path.isdir(TARGET_HISTORY_DIR):
         print(f"❌ Ошибка: '{TARGET_HISTORY_DIR}' не является директорией.")
@@ -664,6 +750,13 @@ if __name__ == '__main__':
         setup_database() # Пересоздаем файлы (пустые)
         run_full_load(TARGET_HISTORY_DIR, filter_segment=args.filter_segment, filter_date=args.filter_date)
 
+    if args.recompute_ev:
+        run_ev_recompute(TARGET_HISTORY_DIR)
+        sys.exit(0)
+
+    # Прошлые месяцы журнала раздач — в архивные файлы (до запуска потока записи)
+    archive_hand_log(DB_NAME)
+
     # --- 2. СТАНДАРТНАЯ ИНИЦИАЛИЗАЦИЯ (Для мониторинга) ---
     for item in os.listdir(TARGET_HISTORY_DIR):
         full_path = os.path.join(TARGET_HISTORY_DIR, item)
@@ -683,11 +776,13 @@ if __name__ == '__main__':
     timer.timeout.connect(lambda: None)
     # ------------------------------------
 
-    hud_manager = HUDManager()
+    # Статистика оппонентов для всех открытых столов: одно чтение за проход монитора
+    stats_service = TableStatsService()
+    hud_manager = HUDManager(stats_service)
 
     monitor_signals = MonitorSignals()
     # watchdog_thread теперь создается как не-демонический по умолчанию
-    watchdog_thread = WatchdogThread(TARGET_HISTORY_DIR, monitor_signals, session_start_time=SESSION_START_TIME)
+    watchdog_thread = WatchdogThread(TARGET_HISTORY_DIR, monitor_signals, session_start_time=SESSION_START_TIME, stats_service=stats_service)
 
     monitor_signals.stat_updated.connect(hud_manager.handle_update_signal)
 
@@ -696,6 +791,19 @@ if __name__ == '__main__':
         """Вызывается перед завершением приложения для чистой остановки потока."""
         print("HUD Manager: Завершение потока мониторинга...")
         watchdog_thread.stop()
+        pending = get_pending_ev_jobs()
+        if pending:
+            print(f"HUD Manager: Остановка пула EV (в очереди: {pending}, останутся с ev_pending=1 и досчитаются при следующем запуске)...")
+        shutdown_ev_workers()
+        flush_opponent_stats()
+        stop_db_maintenance()
+        maintenance = get_maintenance_stats(DB_NAME)
+        print(f"HUD Manager: WAL {maintenance['wal_bytes'] / 1048576:.1f} МБ (макс. {maintenance['wal_bytes_max'] / 1048576:.1f} МБ), "
+              f"checkpoint: {maintenance['checkpoints']} (макс. {maintenance['checkpoint_ms_max']:.0f} мс), "
+              f"ANALYZE: {maintenance['analyze_runs']}")
+        # Поток записи дописывает очередь до закрытия соединений
+        stop_db_writer()
+        close_connections()
 
     # Подключаем функцию очистки к сигналу, который срабатывает при закрытии app.exec()
     app.aboutToQuit.connect(cleanup_before_exit)
@@ -709,6 +817,12 @@ if __name__ == '__main__':
 
     app.aboutToQuit.connect(global_cleanup)
 
+    # Вся запись в БД в живом режиме идет через один поток (db_writer.py)
+    start_db_writer()
+    # Checkpoint WAL в простоях потока записи и периодический ANALYZE (db_maintenance.py)
+    start_db_maintenance(DB_NAME)
+    # EV раздач, не досчитанных пулом до прошлого выхода
+    resume_pending_ev(TARGET_HISTORY_DIR)
     watchdog_thread.start()
     print(f"--- Запущен мониторинг директории '{TARGET_HISTORY_DIR}' ---")
 
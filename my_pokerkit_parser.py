@@ -1,10 +1,26 @@
-from pokerkit.notation import HandHistory, PokerStarsParser, parse_value
+from pokerkit.notation import HandHistory, PokerStarsParser
 from pokerkit.utilities import Card
 from re import compile, MULTILINE, search, Pattern, Match
 from operator import add
 from typing import Any, Callable, Generator, Set, Sequence
 from collections import defaultdict
 
+
+def parse_cents(raw_value: str) -> int:
+    """
+    Переводит денежную сумму из истории раздач в целые центы ('0.02' -> 2, '1,234.5' -> 123450).
+    Используется вместо pokerkit.parse_value: все суммы раздачи (стеки, ставки, выигрыши,
+    рейк) дальше считаются в int без Decimal и float.
+    """
+    raw_value = raw_value.replace(',', '')
+    whole, _, fraction = raw_value.partition('.')
+    if len(fraction) > 2:
+        # Больше двух знаков после точки в кэш-играх не бывает, но не теряем сумму
+        return round(float(raw_value) * 100)
+    negative = whole.startswith('-')
+    cents = abs(int(whole or '0')) * 100 + int(fraction.ljust(2, '0'))
+    return -cents if negative else cents
+
 # 1. Создаем свой парсер, наследуясь от библиотечного
 #    и переопределяя только то, что нам нужно.
 class CustomPokerStarsParser(PokerStarsParser):
@@ -251,11 +267,12 @@ class CustomHandHistory(HandHistory):
             cls,
             s: str,
             *,
-            parse_value: Callable[[str], int] = parse_value,
+            parse_value: Callable[[str], int] = parse_cents,
             error_status: bool = False,
     ) -> Generator['CustomHandHistory', None, int]:
         """
         Парсит историю раздач PokerStars, используя CustomPokerStarsParser.
+        Суммы (стеки, ставки, выигрыши, rake_amount) — целые центы (parse_cents).
         """
         # Здесь мы создаем экземпляр нашего парсера, а не стандартного.
         parser = CustomPokerStarsParser()
@@ -265,7 +282,7 @@ class CustomHandHistory(HandHistory):
         # Note: Regex needs to match multiline or be iterated
         import re
         rake_pattern = re.compile(r'Total pot .*?\| Rake \$(?P<rake>[\d.]+)')
-        all_rakes = [float(m.group('rake')) for m in rake_pattern.finditer(s)]
+        all_rakes = [parse_cents(m.group('rake')) for m in rake_pattern.finditer(s)]
         
         # 1. Parse and Yield
         hh_gen = parser(s, parse_value=parse_value, error_status=error_status)
@@ -274,7 +291,7 @@ class CustomHandHistory(HandHistory):
             if i < len(all_rakes):
                 setattr(hh, 'rake_amount', all_rakes[i])
             else:
-                setattr(hh, 'rake_amount', 0.0)
+                setattr(hh, 'rake_amount', 0)
             yield hh
 
 # 3. Пример использования
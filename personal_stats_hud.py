@@ -7,6 +7,7 @@ from PySide6.QtCore import Qt, QTimer, QDate, QPoint, Signal, QThread, Slot
 from PySide6.QtGui import QMouseEvent, QColor
 from datetime import datetime, time
 from poker_stats_db import get_player_extended_stats, get_chart_hands_data, get_player_hand_log_df
+from db_connection import close_thread_connections
 from hand_matrix_widget import HandChartDialog
 from graph_widget import PokerGraphWidget
 
@@ -28,6 +29,9 @@ class StatsLoaderThread(QThread):
         except Exception as e:
             print(f"Thread Error: {e}")
             self.stats_loaded.emit(None)
+        finally:
+            # Поток одноразовый: его соединение (и подключенные архивы) закрываем сразу
+            close_thread_connections()
 
 class PersonalStatsWindow(QWidget):
     """
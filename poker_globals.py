@@ -2,10 +2,52 @@
 
 from typing import Dict, Any, Tuple, List
 import os
-import decimal
 
 # --- КОНСТАНТЫ ---
 DB_NAME = 'poker_stats.db'
+# Одно долгоживущее соединение с БД на поток (db_connection.py).
+# False — старый режим: соединение открывается и закрывается на каждый запрос.
+DB_PERSISTENT_CONNECTIONS = True
+# Пакетная запись раздач (HandBatchWriter): транзакция раз в N раздач или T мс.
+# Живой путь — короткая граница (HUD ждет записи), полная загрузка — большие пачки.
+DB_LIVE_BATCH_HANDS = 50
+DB_LIVE_BATCH_MS = 200
+DB_BULK_BATCH_HANDS = 1000
+DB_BULK_BATCH_MS = 5000
+# Статистика оппонентов в памяти (OpponentStatsStore): как часто писать дельты в БД
+# и сколько игроков держать загруженными (после записи кеш сбрасывается при превышении)
+DB_STATS_FLUSH_MS = 2000
+DB_STATS_STORE_MAX_PLAYERS = 5000
+# Окно последних раздач оппонента (кольцевой буфер на сегмент и игрока): HUD показывает
+# статистику за последние DB_RECENT_HANDS раздач рядом со статистикой за все время
+DB_RECENT_HANDS = 500
+# Кеш готовых записей HUD оппонентов (OpponentStatsCache) перед get_stats_for_players:
+# запись игрока сбрасывается, когда он сыграл раздачу; кроме того — LRU по размеру и TTL
+DB_STATS_CACHE_MAX_PLAYERS = 2000
+DB_STATS_CACHE_TTL_S = 300
+# Статистика оппонентов в HUD (--hud-scope): "segment" — только лимит стола,
+# "seats" — все лимиты с тем же числом мест, "all" — все лимиты
+HUD_STATS_SCOPES = ("segment", "seats", "all")
+HUD_STATS_SCOPE = "segment"
+# Поток записи в БД (db_writer.py): размер очереди команд (при переполнении
+# отправитель ждет) и сколько команд максимум объединять в одну транзакцию
+DB_WRITE_QUEUE_MAX = 1000
+DB_WRITE_GROUP_MAX = 200
+# Архив журнала раздач по месяцам (poker_stats_archive_YYYY_MM.db рядом с DB_NAME):
+# сколько месяцев (включая текущий) остается в основной базе и сколько архивов
+# держать подключенными (ATTACH) к одному соединению одновременно
+DB_ARCHIVE_HOT_MONTHS = 1
+DB_ARCHIVE_MAX_ATTACHED = 6
+# Обслуживание БД (db_maintenance.py): PASSIVE-checkpoint WAL, когда поток записи
+# простаивает DB_CHECKPOINT_IDLE_MS, а WAL больше DB_CHECKPOINT_WAL_BYTES (при WAL больше
+# DB_CHECKPOINT_WAL_MAX_BYTES — не дожидаясь простоя); ANALYZE раз в DB_ANALYZE_INTERVAL_S
+# с выборкой DB_ANALYZE_LIMIT строк на индекс
+DB_MAINTENANCE_POLL_MS = 1000
+DB_CHECKPOINT_IDLE_MS = 2000
+DB_CHECKPOINT_WAL_BYTES = 1024 * 1024
+DB_CHECKPOINT_WAL_MAX_BYTES = 64 * 1024 * 1024
+DB_ANALYZE_INTERVAL_S = 3600
+DB_ANALYZE_LIMIT = 1000
 # Теперь это просто заглушка, имя стола будет определяться динамически.
 TARGET_WINDOW_TITLE_PART = "poker table"
 # Директория для мониторинга (устанавливается при запуске)
@@ -19,18 +61,29 @@ StatUpdateData = Tuple[str, Dict[str, int], str, str, Dict[str, Any]]
 
 ACTION_POSITIONS = ["utg", "mp", "co", "bu"]
 
+# Фоновый расчет All-In EV: число процессов пула (один процессор оставляем GUI и монитору)
+EV_WORKER_COUNT = max(1, (os.cpu_count() or 2) - 1)
+# Точность расчета эквити: Монте-Карло останавливается, когда стандартная ошибка
+# эквити <= EV_EQUITY_TOLERANCE (но не раньше EV_MIN_SAMPLES и не позже EV_MAX_SAMPLES).
+# Если раскладов борда не больше EV_MAX_SAMPLES, они перебираются полностью.
+EV_EQUITY_TOLERANCE = 0.01
+EV_MIN_SAMPLES = 200
+EV_MAX_SAMPLES = 5000
+# Пересчет EV (--recompute-ev): сколько результатов писать одной транзакцией
+EV_RECOMPUTE_BATCH_SIZE = 200
+
 ALL_STATS_FIELDS = [
     'pfr_utg', 'pfr_mp', 'pfr_co', 'pfr_bu', 'pfr_sb',
     'hands_utg', 'hands_mp', 'hands_co', 'hands_bu', 'hands_sb'
 ]
 
-def get_table_name_segment(min_bet: decimal.Decimal, seat_count: int) -> str:
+def get_table_name_segment(min_bet: int, seat_count: int) -> str:
     """
     Генерирует уникальное имя таблицы для БД на основе лимита и количества мест.
+    min_bet — большой блайнд в центах (парсер отдает суммы в центах).
     Пример: 'NL2_9MAX' (для $0.02)
     """
-    # Преобразуем лимит в целое число центов (0.02 -> 2)
-    limit_cents = int(min_bet * 100)
+    limit_cents = int(min_bet)
 
     limit_str = f"{limit_cents}"
 
@@ -4,20 +4,24 @@ import os
 import time
 import datetime
 import re
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from PySide6.QtCore import QThread, Signal, QObject
 from pokerkit import HandHistory
 from my_pokerkit_parser import CustomHandHistory
 from poker_globals import FILE_SIZES, MY_PLAYER_NAME, ACTION_POSITIONS, StatUpdateData, get_table_name_segment
+from poker_globals import DB_LIVE_BATCH_HANDS, DB_LIVE_BATCH_MS, DB_BULK_BATCH_HANDS, DB_BULK_BATCH_MS
 from poker_stats_db import (
     analyze_hand_for_stats,
-    update_stats_in_db,
     analyze_player_stats,
     analyze_player_stats,
-    update_hand_stats_in_db,
+    HandBatchWriter,
+    flush_opponent_stats,
     get_stats_for_players, 
-    get_player_extended_stats
+    get_hero_session_stats,
+    update_hand_offsets_in_db
 )
+from ev_worker import submit_ev_job
+from table_stats_service import TableStatsService
 # --- КЛАСС СИГНАЛОВ ---
 
 class MonitorSignals(QObject):
@@ -102,9 +106,11 @@ def extract_seats_from_content(content: str) -> Dict[str, int]:
         
     return seat_map
 
-def process_file_update(file_path: str, filter_segment: Optional[str] = None, filter_date: Optional[str] = None, session_start_time: Optional[datetime.datetime] = None) -> Optional[StatUpdateData]:
+def process_file_update(file_path: str, filter_segment: Optional[str] = None, filter_date: Optional[str] = None, session_start_time: Optional[datetime.datetime] = None, fetch_stats: bool = True) -> Optional[StatUpdateData]:
     """
     Парсит новую раздачу, ОБНОВЛЯЕТ БД и возвращает 4 значения.
+    fetch_stats=False — статистику оппонентов не читать: в table_stats только стеки
+    и статистика Hero, остальное добавит TableStatsService сразу для всех столов.
     """
 
     filename = os.path.basename(file_path)
@@ -164,12 +170,25 @@ def process_file_update(file_path: str, filter_segment: Optional[str] = None, fi
 
         last_hand_seat_map = {} # Хранит карту мест последней раздачи
 
-        # 2. Обработка и запись в БД
+        # 2. Обработка и запись в БД (пачками, см. HandBatchWriter)
+        writer = HandBatchWriter(DB_LIVE_BATCH_HANDS, DB_LIVE_BATCH_MS)
+        ev_jobs = []
         for i, hh in enumerate(hhs_list): # Используем enumerate для отслеживания последней раздачи
             stats_to_commit = analyze_hand_for_stats(hh)
-            update_stats_in_db(stats_to_commit, table_segment)
-            player_stats_to_commit = analyze_player_stats(hh, MY_PLAYER_NAME)
-            update_hand_stats_in_db(player_stats_to_commit)
+            # All-In EV не считаем синхронно: раздача пишется сразу с ev_pending,
+            # а Монте-Карло уходит в фоновый пул (ev_worker.py), чтобы HUD не ждал.
+            player_stats_to_commit = analyze_player_stats(hh, MY_PLAYER_NAME, compute_ev=False)
+            writer.add_hand(table_segment, stats_to_commit, player_stats_to_commit)
+            hero_row = player_stats_to_commit.get(MY_PLAYER_NAME)
+            if hero_row and hero_row.get('ev_pending'):
+                ev_jobs.append((hh, hero_row.get('net_profit', 0)))
+        # Пишем до чтения статистики для HUD и до постановки EV в очередь
+        # (UPDATE результата EV должен найти строку раздачи)
+        writer.flush()
+        for hh, net_profit in ev_jobs:
+            submit_ev_job(hh, MY_PLAYER_NAME, net_profit)
+        # Статистика оппонентов читается из памяти, в БД — отложенно
+        flush_opponent_stats(only_if_due=True)
         
         # 3. Извлекаем точные места игроков из текста последней раздачи
         first_hand_in_batch = hhs_list[0] # Используем первую раздачу батча для определения даты сессии
@@ -188,20 +207,17 @@ def process_file_update(file_path: str, filter_segment: Optional[str] = None, fi
         # 4.1 Статистика игроков за столом
         player_names = list(last_hand_seat_map.keys())
         table_stats = {}
-        if player_names:
+        if player_names and fetch_stats:
             table_stats = get_stats_for_players(player_names, table_segment)
 
-        # 4.2 Сессионная статистика Hero (если он есть)
+        # 4.2 Сессионная статистика Hero (если он есть): из памяти, без запроса к БД
         hero_stats = {}
         if MY_PLAYER_NAME in player_names:
-             # Fetch stats starting from session_start_time (or default to recent if None)
-             # If session_start_time is None, we might fetch nothing or all day?
-             # Let's assume passed session_start_time is valid.
              if session_start_time:
-                 hero_stats = get_player_extended_stats(MY_PLAYER_NAME, "", min_time=session_start_time)
+                 hero_stats = get_hero_session_stats(MY_PLAYER_NAME, session_start_time)
              else:
                  today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
-                 hero_stats = get_player_extended_stats(MY_PLAYER_NAME, "", min_time=today)
+                 hero_stats = get_hero_session_stats(MY_PLAYER_NAME, today)
 
         if hhs_list:
             last_hh = hhs_list[-1]
@@ -210,44 +226,21 @@ def process_file_update(file_path: str, filter_segment: Optional[str] = None, fi
                 bb_size = last_hh.min_bet
                 if bb_size > 0:
                     for i, player_name in enumerate(last_hh.players):
-                        if player_name in table_stats:
+                        if player_name in table_stats or not fetch_stats:
                             stack = last_hh.starting_stacks[i]
                             # Рассчитываем и форматируем стек в ББ (целое число)
                             stack_bb = int(stack / bb_size)
-                            table_stats[player_name]['stack_bb'] = stack_bb
+                            table_stats.setdefault(player_name, {})['stack_bb'] = stack_bb
             except Exception as e:
                 print(f"⚠️ Ошибка расчета стеков в BB: {e}")
 
         FILE_SIZES[file_path] = current_size
 
         # 5. Возвращаем расширенный набор данных
-        # (file_path, seat_map, table_title_part, table_segment, table_stats, hero_stats)
-        # Note: We need to update StatUpdateData definition or just use tuple unpacking in main.py
-        # Current tuple in main.py call: _, seat_map, _, seg, pre_stats = data
-        # We can merge hero_stats into table_stats (precalculated_stats)
-        
-        # Merge Hero Stats into table_stats under MY_PLAYER_NAME key?
-        # But table_stats is formatted { 'vpip': '20.5', ... }
-        # hero_stats is { 'vpip': {'total': ...}, ... } (Extended format)
-        # We should formatting it here to be consistent or handle it in main.py.
-        # Let's handle formatting here to keep main.py simple.
-        
+        # (file_path, seat_map, table_title_part, table_segment, table_stats)
+        # Статистика Hero уже в формате HUD и кладется в table_stats под его именем.
         if hero_stats:
-             # Format hero stats to HUD format
-             hud_data = {
-                  'hands': hero_stats['hands']['total'],
-                  'vpip': hero_stats['vpip']['total'],
-                  'pfr': hero_stats['pfr']['total'],
-                  '3bet': hero_stats.get('3bet', {}).get('total', '0.0'),
-                  'f3bet': '0.0', 
-                  'cbet': hero_stats.get('cbet', {}).get('total', '0.0'),
-                  'fcbet': hero_stats.get('fold_to_cbet', {}).get('total', '0.0'),
-                  'wtsd': hero_stats.get('wtsd', {}).get('wtsd', '0.0'), 
-                  'wsd': hero_stats.get('wtsd', {}).get('wsd', '0.0'),
-                  'af': '0.0'
-             }
-             table_stats[MY_PLAYER_NAME] = hud_data
-        
+             table_stats[MY_PLAYER_NAME] = hero_stats
 
         return (file_path, last_hand_seat_map, table_title_part, table_segment, table_stats)
 
@@ -315,12 +308,16 @@ def process_file_full_load(file_path: str, filter_segment: Optional[str] = None,
                 # print(f"   [LOAD] Skipped {filename} ({date_segment} < {filter_dt})")
                 return
 
-        # Обработка и запись в БД
-        for hh in hhs_list:
-            stats_to_commit = analyze_hand_for_stats(hh)
-            update_stats_in_db(stats_to_commit, table_segment)
-            player_stats_to_commit = analyze_player_stats(hh, MY_PLAYER_NAME)
-            update_hand_stats_in_db(player_stats_to_commit)
+        # Обработка и запись в БД (большими пачками)
+        writer = HandBatchWriter(DB_BULK_BATCH_HANDS, DB_BULK_BATCH_MS)
+        try:
+            for hh in hhs_list:
+                stats_to_commit = analyze_hand_for_stats(hh)
+                player_stats_to_commit = analyze_player_stats(hh, MY_PLAYER_NAME)
+                writer.add_hand(table_segment, stats_to_commit, player_stats_to_commit)
+        finally:
+            writer.flush()
+            flush_opponent_stats()
         # Устанавливаем размер, чтобы монитор не читал его заново
         FILE_SIZES[file_path] = os.path.getsize(file_path)
 
@@ -329,14 +326,52 @@ def process_file_full_load(file_path: str, filter_segment: Optional[str] = None,
         traceback.print_exc()
         print(f"❌ Ошибка полной загрузки в {filename}: {e}")
 
+# --- ИНДЕКС РАЗДАЧ В ФАЙЛАХ ИСТОРИИ ---
+
+HAND_HEADER_RE = re.compile(rb"PokerStars Hand #(\d+):")
+
+def scan_hand_offsets(file_path: str) -> List[Tuple[str, int, int]]:
+    """
+    Находит раздачи в файле без парсинга: [(hand_id, byte_offset, length)].
+    Файл читается в бинарном режиме, поэтому смещения можно использовать с seek().
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    matches = list(HAND_HEADER_RE.finditer(data))
+    offsets = []
+    for i, match in enumerate(matches):
+        start = match.start()
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(data)
+        offsets.append((match.group(1).decode('ascii'), start, end - start))
+    return offsets
+
+def index_hand_offsets(directory: str) -> int:
+    """Обновляет таблицу hand_offsets для всех файлов кеш-игр директории. Возвращает число раздач."""
+    total = 0
+    for item in os.listdir(directory):
+        full_path = os.path.join(directory, item)
+        if not (os.path.isfile(full_path) and item.endswith('.txt')) or is_tournament_file(item):
+            continue
+        try:
+            rows = [(hand_id, full_path, offset, length) for hand_id, offset, length in scan_hand_offsets(full_path)]
+        except OSError as e:
+            print(f"⚠️ Не удалось прочитать {item}: {e}")
+            continue
+        update_hand_offsets_in_db(rows)
+        total += len(rows)
+    return total
+
 # --- ПОТОК МОНИТОРИНГА ---
 
 class WatchdogThread(QThread):
     """Поток для мониторинга директории с файлами истории раздач."""
-    def __init__(self, directory: str, signals: MonitorSignals, filter_segment: Optional[str] = None, filter_date: Optional[str] = None, session_start_time: Optional[datetime.datetime] = None, parent=None):
+    def __init__(self, directory: str, signals: MonitorSignals, filter_segment: Optional[str] = None, filter_date: Optional[str] = None, session_start_time: Optional[datetime.datetime] = None, stats_service: Optional[TableStatsService] = None, parent=None):
         super().__init__(parent)
         self.directory = directory
         self.signals = signals
+        # Статистика оппонентов читается один раз за проход для всех открытых столов
+        self.stats_service = stats_service or TableStatsService()
         self._running = True
         self.filter_segment = filter_segment
         self.filter_date = filter_date
@@ -350,16 +385,24 @@ class WatchdogThread(QThread):
     def run(self):
         while self._running:
             try:
+                updates = []
                 for item in os.listdir(self.directory):
                     full_path = os.path.join(self.directory, item)
 
                     if os.path.isfile(full_path) and full_path.endswith('.txt'):
-                        update_data = process_file_update(full_path, self.filter_segment, self.filter_date, self.session_start_time)
+                        update_data = process_file_update(full_path, self.filter_segment, self.filter_date, self.session_start_time, fetch_stats=False)
 
                         if update_data:
-                            self.signals.stat_updated.emit(update_data)
+                            updates.append(update_data)
+
+                for update_data in self.stats_service.refresh(updates):
+                    self.signals.stat_updated.emit(update_data)
 
             except Exception as e:
                 print(f"❌ Ошибка в потоке мониторинга: {e}")
 
+            # Отложенная запись статистики оппонентов, даже если новых раздач нет
+            flush_opponent_stats(only_if_due=True)
             self.msleep(500)
+
+        flush_opponent_stats()
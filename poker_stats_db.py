@@ -1,101 +1,200 @@
 # poker_stats_db.py
 
 import sqlite3
-import decimal
 import datetime
 import sys
 import os
-from typing import Dict, Any, List, Optional
-from decimal import Decimal
+import time
+from array import array
+from typing import Dict, Any, List, Optional, Tuple
 from pokerkit import HandHistory
 from pokerkit import StandardHighHand, Deck, Card
 import random
+import math
 from itertools import combinations
+from poker_globals import EV_EQUITY_TOLERANCE, EV_MIN_SAMPLES, EV_MAX_SAMPLES, DB_LIVE_BATCH_HANDS, DB_LIVE_BATCH_MS
 
-def calculate_equity_monte_carlo(hero_hole, villain_holes, board, full_deck_list, sample_count=1000):
+def _best_hand(cards):
+    """Лучшая 5-карточная комбинация из 7 карт (7-choose-5)."""
+    return max(StandardHighHand(c) for c in combinations(cards, 5))
+
+def _sanitize_cards(cards):
+    # We use rank+suit string to ensure clean parsing.
+    # Card.parse returns a generator, so we use next().
+    return [next(Card.parse(f"{c.rank}{c.suit}")) for c in cards]
+
+def _sample_runouts(runout_value, deck, cards_needed, tolerance, seed, min_samples, max_samples):
     """
-    Calculates equity for Hero vs Villains using Monte Carlo simulation.
+    Усредняет runout_value(runout) по раскладам оставшегося борда.
+    Возвращает (mean, std_err, samples).
+
+    Если всех раскладов не больше max_samples (тёрн, флоп), они перебираются
+    полностью и std_err = 0. Иначе Монте-Карло останавливается, как только
+    стандартная ошибка падает ниже tolerance (но не раньше min_samples).
     """
-    # 1. Filter Deck (Remove known cards)
-    # DEBUG: Inspect inputs
-    # print(f"DEBUG EV: HeroHole={hero_hole} Type={type(hero_hole)}")
-    # if len(hero_hole) > 0: print(f"DEBUG EV: HeroHole[0]={hero_hole[0]} Type={type(hero_hole[0])}")
-    
-    try:
-        # Robust filtering: Use string representation (Rank+Suit) to ensure no duplicates
-        # even if Card objects have different identities.
-        known_card_strs = {str(c) for c in (hero_hole + board)}
-        for v_hole in villain_holes:
-             for c in v_hole:
-                 known_card_strs.add(str(c))
-        
-        # known_cards set for backup (debugging)
-        # known_cards = set(hero_hole + board)
-        
-    except Exception as e:
-        print(f"DEBUG EV CRASH setup: {e}")
-        raise e
-        
-    deck = [c for c in full_deck_list if str(c) not in known_card_strs]
-    
-    # 2. Determine cards to come
-    cards_needed = 5 - len(board)
-    actual_samples = sample_count
-    
-    if cards_needed <= 0:
-        actual_samples = 1
-        
-    hero_wins = 0.0
-    
-    for _ in range(actual_samples):
-        if cards_needed > 0 and len(deck) >= cards_needed:
-            runout = random.sample(deck, cards_needed)
-        else:
-            runout = []
-            
-        full_board = board + runout
-        
+    # 1. Полный перебор, если он не дороже лимита выборки
+    if math.comb(len(deck), cards_needed) <= max_samples:
+        total = 0.0
+        count = 0
+        for runout in combinations(deck, cards_needed):
+            try:
+                total += runout_value(runout)
+                count += 1
+            except Exception as e:
+                print(f"DEBUG EV LOOP ERROR: {e}")
+        return (total / count if count else 0.0), 0.0, count
+
+    # 2. Монте-Карло с ранней остановкой (Welford: среднее и дисперсия за один проход)
+    rng = random.Random(seed)
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    std_err = 0.0
+    for _ in range(max_samples):
         try:
-            # SANITIZATION + 7-choose-5 Logic
-            # Helper to sanitize a list of cards
-            def sanitize(cards):
-                # We use rank+suit string to ensure clean parsing.
-                # Card.parse returns a generator, so we use next().
-                return [next(Card.parse(f"{c.rank}{c.suit}")) for c in cards]
-            
-            # Evaluate best 5-card hand from available 7 cards (Hole + Board)
-            hero_cards = sanitize(hero_hole + full_board)
-            hero_hand = max(StandardHighHand(c) for c in combinations(hero_cards, 5))
-            
-            villain_hands = []
-            for v_hole in villain_holes:
-                v_cards = sanitize(v_hole + full_board)
-                v_hand = max(StandardHighHand(c) for c in combinations(v_cards, 5))
-                villain_hands.append(v_hand)
-            
-            if not villain_hands:
-                hero_wins += 1.0; continue
-                
-            best_villain = max(villain_hands)
-            
-            if hero_hand > best_villain:
-                hero_wins += 1.0
-            elif hero_hand == best_villain:
-                winners = 1 + villain_hands.count(hero_hand)
-                hero_wins += (1.0 / winners)
+            x = runout_value(rng.sample(deck, cards_needed))
         except Exception as e:
-            # Print only first few errors to avoid spam
-            if actual_samples == 1 or random.random() < 0.01:
-                print(f"DEBUG EV LOOP ERROR: {e}")
+            print(f"DEBUG EV LOOP ERROR: {e}")
             continue
-            
-    return hero_wins / actual_samples
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+        if n >= min_samples:
+            std_err = math.sqrt(m2 / (n - 1) / n)
+            if std_err <= tolerance:
+                break
+
+    return mean, std_err, n
+
+def build_side_pots(contributions: Dict[int, float], live_players: List[int]) -> List[Tuple[float, List[int]]]:
+    """
+    Раскладывает вклады игроков (индекс -> сумма) на основной и побочные банки.
+    Возвращает [(сумма, [претенденты])], начиная с основного банка.
+    Фишки сфолдивших игроков остаются в банках, но претендовать на них могут
+    только live_players. Часть ставки, которую никто не уравнял, — возврат,
+    в банки она не попадает.
+    """
+    levels = sorted({contributions[idx] for idx in live_players if contributions[idx] > 0})
+    pots = []
+    prev = 0.0
+    for level in levels:
+        amount = sum(min(c, level) - min(c, prev) for c in contributions.values())
+        eligible = [idx for idx in live_players if contributions[idx] >= level]
+        if len(eligible) == 1:
+            # Неуравненный остаток ставки возвращается игроку
+            amount -= level - prev
+        if amount > 0:
+            pots.append((amount, eligible))
+        prev = level
+
+    # Мертвые фишки выше последнего уровня (на практике не встречается)
+    dead = sum(max(0.0, c - prev) for c in contributions.values())
+    if dead > 0 and pots:
+        pots[-1] = (pots[-1][0] + dead, pots[-1][1])
+    return pots
+
+def estimate_pot_share(hole_cards: Dict[int, list], hero_idx: int, pots: List[Tuple[float, List[int]]],
+                       board, full_deck_list, tolerance=EV_EQUITY_TOLERANCE, seed=None,
+                       min_samples=EV_MIN_SAMPLES, max_samples=EV_MAX_SAMPLES) -> Tuple[float, float, int]:
+    """
+    Ожидаемая сумма, которую Hero заберет из основного и побочных банков.
+    Возвращает (amount, std_err, samples).
+
+    Каждый расклад борда оценивается один раз: руки всех игроков ранжируются,
+    и доля Hero в каждом банке (с учетом дележа) набирается из того же прохода.
+    tolerance задается в долях разыгрываемых банков (как стандартная ошибка эквити).
+    """
+    # 1. Sanitize once + filter deck (remove known cards by Rank+Suit string)
+    cards = {idx: _sanitize_cards(h) for idx, h in hole_cards.items()}
+    board_cards = _sanitize_cards(board)
+
+    known_card_strs = {str(c) for c in board_cards}
+    for h in cards.values():
+        for c in h:
+            known_card_strs.add(str(c))
+
+    deck = []
+    for c in _sanitize_cards(full_deck_list):
+        if str(c) not in known_card_strs:
+            known_card_strs.add(str(c))
+            deck.append(c)
+
+    cards_needed = max(0, 5 - len(board_cards))
+    if len(deck) < cards_needed:
+        cards_needed = 0
+
+    # 2. Банки без борьбы достаются единственному претенденту без симуляции
+    hero_fixed = sum(amount for amount, eligible in pots if len(eligible) == 1 and eligible[0] == hero_idx)
+    contested = [(amount, eligible) for amount, eligible in pots if len(eligible) > 1 and hero_idx in eligible]
+    contested_total = sum(amount for amount, _ in contested)
+    if contested_total <= 0:
+        return hero_fixed, 0.0, 0
+
+    players = sorted({idx for _, eligible in contested for idx in eligible})
+    weights = [(amount / contested_total, eligible) for amount, eligible in contested]
+
+    def hero_share(runout):
+        full_board = board_cards + list(runout)
+        hands = {idx: _best_hand(cards[idx] + full_board) for idx in players}
+        hero_hand = hands[hero_idx]
+        share = 0.0
+        for weight, eligible in weights:
+            best = max(hands[idx] for idx in eligible)
+            if hero_hand == best:
+                share += weight / sum(1 for idx in eligible if hands[idx] == best)
+        return share
+
+    mean, std_err, n = _sample_runouts(hero_share, deck, cards_needed, tolerance, seed, min_samples, max_samples)
+    return hero_fixed + mean * contested_total, std_err * contested_total, n
+
+def estimate_equity(hero_hole, villain_holes, board, full_deck_list,
+                    tolerance=EV_EQUITY_TOLERANCE, seed=None,
+                    min_samples=EV_MIN_SAMPLES, max_samples=EV_MAX_SAMPLES):
+    """
+    Оценивает эквити Hero против известных рук соперников (один общий банк).
+    Возвращает (equity, std_err, samples). seed (например, номер раздачи)
+    делает результат воспроизводимым.
+    """
+    hole_cards = {0: hero_hole}
+    for i, v_hole in enumerate(villain_holes):
+        hole_cards[i + 1] = v_hole
+    if not villain_holes:
+        return 1.0, 0.0, 0
+    return estimate_pot_share(hole_cards, 0, [(1.0, list(hole_cards))], board, full_deck_list,
+                              tolerance=tolerance, seed=seed,
+                              min_samples=min_samples, max_samples=max_samples)
+
+def calculate_equity_monte_carlo(hero_hole, villain_holes, board, full_deck_list, sample_count=EV_MAX_SAMPLES, seed=None):
+    """
+    Calculates equity for Hero vs Villains using Monte Carlo simulation.
+    Обертка над estimate_equity, возвращает только эквити.
+    """
+    equity, _, _ = estimate_equity(hero_hole, villain_holes, board, full_deck_list,
+                                   seed=seed, max_samples=sample_count)
+    return equity
 
 from pokerkit.analysis import calculate_equities
 from pokerkit.hands import StandardHighHand
 from pokerkit.utilities import Deck, Card, Rank
 # Добавляем импорт для генерации имени таблицы
 from poker_globals import DB_NAME, ACTION_POSITIONS, ALL_STATS_FIELDS, get_table_name_segment
+from db_connection import get_connection, release_connection, close_connections
+import poker_globals
+from db_writer import submit_write
+from db_schema import (
+    CORE_TABLE_MIGRATIONS, HAND_LOG_CODED_COLUMNS, HAND_LOG_DIMENSIONS, HAND_LOG_INSERT_SQL,
+    HAND_LOG_MONEY_COLUMNS, HAND_LOG_TIME_ZONE, LEGACY_SEGMENT_TABLE_RE, MY_DAILY_STATS_COLUMNS,
+    PLAYER_HAND_FACTS_INSERT_SQL, PLAYER_HAND_FLAGS, RECENT_WINDOW_FIELDS, _COUNTER_INDEX,
+    _READY_TABLES, _SEGMENT_IDS, _daily_value_exprs, _decode_hand_log_value, _encode_hand_log_value,
+    _ensure_core_tables, _ev_cents, _hand_log_columns, _insert_segment, _player_hand_flags, _to_epoch
+)
+from stats_store import _opponent_stats, _stats_cache, _hero_session
+from db_bulk_load import is_bulk_loading, BULK_HAND_LOG_INSERT_SQL, BULK_PLAYER_HAND_FACTS_INSERT_SQL
+from db_archive import (
+    ARCHIVE_SCHEMA_PREFIX, _archive_files, _archive_months, _attach_archives, _ensure_archives,
+    _hand_log_table_groups, _update_archived_hand_ev
+)
 from pokerkit.utilities import Card, Rank
 import pandas as pd
 
@@ -131,214 +230,71 @@ def normalize_cards(cards_str: str) -> str:
         return f"{r1}{r2}o"
 
 # --- 1. ФУНКЦИИ НАСТРОЙКИ БАЗЫ ДАННЫХ ---
+# Таблицы и миграции — db_schema.py, месячные архивы журнала — db_archive.py.
 
 def remove_database_files():
     """Удаляет файлы базы данных (db, wal, shm) для полной перезагрузки."""
-    for ext in ["", "-wal", "-shm"]:
-        path = DB_NAME + ext
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-                print(f"🗑️ Удален файл базы данных: {path}")
-            except Exception as e:
-                print(f"❌ Ошибка удаления {path}: {e}")
+    # Открытые соединения потоков держат файлы (и на Windows не дают их удалить)
+    close_connections()
+    # Схема новой базы будет создана миграциями заново
+    _READY_TABLES.difference_update([key for key in _READY_TABLES if key[0] == DB_NAME])
+    for key in [key for key in _SEGMENT_IDS if key[0] == DB_NAME]:
+        del _SEGMENT_IDS[key]
+    _opponent_stats.clear(DB_NAME)
+    _stats_cache.clear(DB_NAME)
+    _hero_session.clear(DB_NAME)
+    # Месячные архивы журнала (archive_hand_log) удаляются вместе с базой
+    archives = _archive_files(DB_NAME)
+    _READY_TABLES.difference_update([key for key in _READY_TABLES if key[0] in archives])
+    for db_path in [DB_NAME] + archives:
+        for ext in ["", "-wal", "-shm"]:
+            path = db_path + ext
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    print(f"🗑️ Удален файл базы данных: {path}")
+                except Exception as e:
+                    print(f"❌ Ошибка удаления {path}: {e}")
+
+def get_segment_id(table_segment: str) -> Optional[int]:
+    """
+    Гарантирует готовность схемы и возвращает segment_id сегмента.
+    После первого вызова для сегмента — только поиск в словаре, без обращения к БД.
+    """
+    key = (DB_NAME, table_segment)
+    segment_id = _SEGMENT_IDS.get(key)
+    if segment_id is not None:
+        return segment_id
 
-def setup_database_table(table_segment: str):
-    """Создает таблицу статистики с уникальным именем, если она не существует."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        # Enable Write-Ahead Logging for better concurrency
-        conn.execute("PRAGMA journal_mode=WAL;")
-        cursor = conn.cursor()
-
-        safe_table_name = table_segment.replace("'", "").replace(";", "").replace(" ", "")
-
-        # Схема таблицы: ДОБАВЛЕНЫ 4 НОВЫХ СТОЛБЦА
-        cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {safe_table_name} (
-                player_name TEXT PRIMARY KEY,
-                hands INTEGER DEFAULT 0,
-                vpip_hands INTEGER DEFAULT 0,
-                pfr_hands INTEGER DEFAULT 0,
-                _3bet_opportunities INTEGER DEFAULT 0,
-                _3bet_successes INTEGER DEFAULT 0,
-                _fold_to_3bet_opportunities INTEGER DEFAULT 0,
-                _fold_to_3bet_successes INTEGER DEFAULT 0,
-
-                pfr_utg INTEGER DEFAULT 0,
-                pfr_mp INTEGER DEFAULT 0,
-                pfr_co INTEGER DEFAULT 0,
-                pfr_bu INTEGER DEFAULT 0,
-                pfr_sb INTEGER DEFAULT 0,
-
-                hands_utg INTEGER DEFAULT 0,
-                hands_mp INTEGER DEFAULT 0,
-                hands_co INTEGER DEFAULT 0,
-                hands_bu INTEGER DEFAULT 0,
-                hands_sb INTEGER DEFAULT 0,
-
-                rfi_opp_utg INTEGER DEFAULT 0,
-                rfi_opp_mp INTEGER DEFAULT 0,
-                rfi_opp_co INTEGER DEFAULT 0,
-                rfi_opp_bu INTEGER DEFAULT 0,
-
-                rfi_succ_utg INTEGER DEFAULT 0,
-                rfi_succ_mp INTEGER DEFAULT 0,
-                rfi_succ_co INTEGER DEFAULT 0,
-                rfi_succ_bu INTEGER DEFAULT 0,
-
-                af_bets_raises INTEGER DEFAULT 0,
-                af_calls INTEGER DEFAULT 0,
-
-                cbet_flop_opp INTEGER DEFAULT 0,
-                cbet_flop_succ INTEGER DEFAULT 0,
-                fcbet_flop_opp INTEGER DEFAULT 0,
-                fcbet_flop_succ INTEGER DEFAULT 0,
-                wtsd_hands INTEGER DEFAULT 0,
-                wsd_hands INTEGER DEFAULT 0
-            )
-        """)
-
-        # МИГРАЦИЯ: Добавляем колонки, если таблица уже существовала без них
-        columns_to_add = [
-            "cbet_flop_opp", "cbet_flop_succ",
-            "fcbet_flop_opp", "fcbet_flop_succ",
-            "wtsd_hands", "wsd_hands"
-        ]
-        for col in columns_to_add:
-            try:
-                cursor.execute(f"ALTER TABLE {safe_table_name} ADD COLUMN {col} INTEGER DEFAULT 0")
-            except sqlite3.OperationalError:
-                # Колонка уже существует
-                pass
-
-        # 🌟 2. НОВАЯ ТАБЛИЦА: Лог сыгранных раздач
-        conn.execute(f"""
-            CREATE TABLE IF NOT EXISTS my_hand_log (
-                hand_id TEXT NOT NULL,                  -- Идентификатор раздачи (уникальный)
-                table_part_name TEXT NOT NULL,          -- Часть имени стола для привязки к HUD
-                player_name TEXT NOT NULL,
-                position TEXT NOT NULL,                 -- Позиция (utg, mp, co, bu, sb, bb)
-                cards TEXT NOT NULL,                    -- Карты игрока (например, "AsKc")
-                is_rfi BOOLEAN NOT NULL,                -- RFI (да/нет)
-                is_pfr BOOLEAN NOT NULL,                -- PFR (да/нет)
-                is_vpip BOOLEAN NOT NULL,               -- VPIP (да/нет)
-                first_action TEXT,                      -- Первое агрессивное действие (рейз, колл, фолд)
-                first_raiser_position TEXT,
-                is_steal_attempt BOOLEAN NOT NULL,
-                net_profit DECIMAL(10,2),
-                time_logged DATETIME DEFAULT CURRENT_TIMESTAMP,
-                
-                final_street TEXT,
-                final_action TEXT,
-                final_hand_strength TEXT,
-                facing_bet_pct_pot DECIMAL(5,2),
-                opponent_position TEXT,
-                board_cards TEXT,
-                rfi_opportunity INTEGER DEFAULT 0,
-                bb_size DECIMAL(10,2) DEFAULT 0,
-                ev_adjusted DECIMAL(10,2) DEFAULT 0,
-                
-                -- Новые колонки для защиты BB и стилов
-                facing_steal INTEGER DEFAULT 0,  -- 1, если игрок на BB/SB и получил опен-рейз с CO/BU/SB
-                is_steal_defend INTEGER DEFAULT 0, -- 1, если заколлировал (Cold Call)
-                is_steal_3bet INTEGER DEFAULT 0,   -- 1, если сделал 3-бет
-                is_steal_fold INTEGER DEFAULT 0,   -- 1, если сфолдил
-                steal_success INTEGER DEFAULT 0,    -- 1, если наш стил удался (все сфолдили)
-                
-                normalized_hand TEXT,               -- Normalized hand (e.g., AKs, 99, T8o)
-                
-                -- New BB vs Limp Stats columns
-                facing_limp INTEGER DEFAULT 0,
-                is_limp_check INTEGER DEFAULT 0,
-                is_limp_iso INTEGER DEFAULT 0,
-                
-                -- WTSD & WSD
-                wtsd INTEGER DEFAULT 0,
-                wsd INTEGER DEFAULT 0,
-                
-                -- C-Bet & 3-Bet Stats
-                is_3bet INTEGER DEFAULT 0,
-                is_3bet_opp INTEGER DEFAULT 0,
-                is_cbet INTEGER DEFAULT 0,
-                cbet_opp INTEGER DEFAULT 0,
-                is_fold_to_cbet INTEGER DEFAULT 0,
-                fold_to_cbet_opp INTEGER DEFAULT 0,
-                
-                is_fold_to_3bet INTEGER DEFAULT 0,
-                fold_to_3bet_opp INTEGER DEFAULT 0,
-
-                PRIMARY KEY (hand_id, player_name)
-            );
-        """)
-        
-        # МИГРАЦИЯ my_hand_log
-        log_columns_to_add = [
-            "final_street", "final_action", "final_hand_strength",
-            "facing_bet_pct_pot", "opponent_position", "board_cards",
-            "rfi_opportunity", "normalized_hand", "facing_limp", "is_limp_check", "is_limp_iso",
-            "wtsd", "wsd",
-            "is_3bet", "is_3bet_opp", "is_cbet", "cbet_opp", "is_fold_to_cbet", "fold_to_cbet_opp",
-            "is_fold_to_3bet", "fold_to_3bet_opp"
-        ]
-        for col in log_columns_to_add:
-            try:
-                col_type = "TEXT"
-                if "pct_pot" in col: col_type = "DECIMAL(5,2)"
-                elif any(x in col for x in ["rfi_opportunity", "is_limp", "facing_limp", "wtsd", "wsd", "is_3bet", "cbet", "fold_to_cbet", "fold_to_3bet", "opp"]): 
-                    col_type = "INTEGER DEFAULT 0"
-                
-                cursor.execute(f"ALTER TABLE my_hand_log ADD COLUMN {col} {col_type}")
-            except sqlite3.OperationalError:
-                pass
-        
-        # The following block is added by the user's instruction.
-        # It appears to be intended for migration of specific columns,
-        # but is placed inside the loop for `log_columns_to_add`.
-        # This will cause the `rfi_opportunity` and BB defense columns
-        # to be attempted to be added multiple times.
-        try:
-            cursor.execute(f"ALTER TABLE my_hand_log ADD COLUMN rfi_opportunity INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
-
-        try:
-             cursor.execute(f"ALTER TABLE my_hand_log ADD COLUMN bb_size DECIMAL(10,2) DEFAULT 0")
-        except sqlite3.OperationalError:
-             pass
+        if any((DB_NAME, table_name) not in _READY_TABLES for table_name in CORE_TABLE_MIGRATIONS):
+            setup_database()
+        segment_id = submit_write(DB_NAME, lambda conn: _insert_segment(conn, table_segment),
+                                  f"сегмент {table_segment}", wait=True)
+        _SEGMENT_IDS[key] = segment_id
+    except Exception as e:
+        print(f"❌ Ошибка при настройке сегмента '{table_segment}': {e}")
+    return segment_id
 
-        try:
-             cursor.execute(f"ALTER TABLE my_hand_log ADD COLUMN ev_adjusted DECIMAL(10,2) DEFAULT 0")
-        except sqlite3.OperationalError:
-             pass
-
-        # Migration for BB Defense Stats (Step 5)
-        new_cols = [
-            ("facing_steal", "INTEGER DEFAULT 0"),
-            ("is_steal_defend", "INTEGER DEFAULT 0"),
-            ("is_steal_3bet", "INTEGER DEFAULT 0"),
-            ("is_steal_fold", "INTEGER DEFAULT 0"),
-            ("steal_success", "INTEGER DEFAULT 0"),
-            # Step 6: BB vs Limp
-            ("facing_limp", "INTEGER DEFAULT 0"),
-            ("is_limp_check", "INTEGER DEFAULT 0"),
-            ("is_limp_iso", "INTEGER DEFAULT 0")
-        ]
-        for col_name, col_type in new_cols:
-            try:
-                cursor.execute(f"ALTER TABLE my_hand_log ADD COLUMN {col_name} {col_type}")
-            except sqlite3.OperationalError:
-                pass
-        conn.commit()
+def setup_database():
+    """
+    Инициализация базы данных: миграции общих таблиц (my_hand_log, hand_offsets,
+    player_stats и справочники) и схемы месячных архивов журнала.
+    Вызывается один раз при старте.
+    """
+    conn = None
+    try:
+        _ensure_core_tables(DB_NAME)
+        conn = get_connection(DB_NAME)
+        _ensure_archives(conn, DB_NAME)
+        zone = conn.execute("SELECT value FROM db_meta WHERE key = 'time_zone'").fetchone()
+        if zone and zone[0] != HAND_LOG_TIME_ZONE:
+            print(f"⚠️ Время раздач в базе записано в зоне {zone[0]}, а не {HAND_LOG_TIME_ZONE}: периоды и дни будут сдвинуты")
     except Exception as e:
-        print(f"❌ Ошибка при настройке таблицы '{table_segment}': {e}")
+        print(f"❌ Ошибка при инициализации базы данных: {e}")
     finally:
         if conn:
-            conn.close()
-
-def setup_database():
-    """Инициализация базы данных (не создает таблицы, так как они динамические)."""
-    pass
+            release_connection(conn)
 
     return None
 
@@ -522,6 +478,28 @@ def determine_position(player_index_p: int, num_players_in_hand: int) -> Optiona
     return None
 
 # --- 2.1 ФУНКЦИЯ АНАЛИЗА РАЗДАЧИ ---
+def _hand_time(hand_history: HandHistory) -> Optional[datetime.datetime]:
+    """Время раздачи из истории рук (None, если дата не распознана)."""
+    try:
+        hh_date = getattr(hand_history, 'date', None)
+        hh_time = getattr(hand_history, 'time', None)
+
+        # Fix for PokerKit versions where .date is not present but year/month/day are
+        if hh_date is None:
+            if hasattr(hand_history, 'year') and hasattr(hand_history, 'month') and hasattr(hand_history, 'day'):
+                # Ensure values are integers (sometimes None if parsing failed)
+                if hand_history.year and hand_history.month and hand_history.day:
+                    hh_date = datetime.date(hand_history.year, hand_history.month, hand_history.day)
+
+        if isinstance(hh_date, datetime.date):
+            if hh_time and isinstance(hh_time, datetime.time):
+                return datetime.datetime.combine(hh_date, hh_time)
+            return datetime.datetime(hh_date.year, hh_date.month, hh_date.day)
+    except Exception:
+        pass
+    return None
+
+
 def analyze_hand_for_stats(hand_history: HandHistory):
     """
     Анализирует распарсенную раздачу для определения VPIP, PFR, 3Bet и Fold to 3Bet.
@@ -529,7 +507,8 @@ def analyze_hand_for_stats(hand_history: HandHistory):
     Использует:
     - Порядок действий p1 -> p2 -> ...
     - Коды действий: cc, cbr, f.
-    - Возвращает словарь {player_name: {...}} с новыми метриками.
+    - Возвращает словарь {player_name: {...}} с новыми метриками
+      и фактами раздачи для player_hand_facts (hand_id, position, time_logged, net_profit в центах).
     """
     stats_update = {}
     player_map = {}
@@ -578,6 +557,12 @@ def analyze_hand_for_stats(hand_history: HandHistory):
     # Для WTSD отслеживаем активных игроков
     active_players = set(all_players)
 
+    # Вложения игроков в банк (центы): для net_profit в player_hand_facts
+    n_players = len(all_players)
+    hh_stacks = list(hand_history.starting_stacks) if hand_history.starting_stacks else [0] * n_players
+    invested = list(hand_history.antes) if getattr(hand_history, 'antes', None) else [0] * n_players
+    street_bets = list(hand_history.blinds_or_straddles) if hand_history.blinds_or_straddles else [0] * n_players
+
     # 1. Основной цикл по действиям
     is_postflop = False
     current_street = 'preflop' # preflop, flop, turn, river
@@ -589,6 +574,9 @@ def analyze_hand_for_stats(hand_history: HandHistory):
         if action_str.startswith('d db'):
             is_postflop = True
             postflop_has_bet = False
+            for i, bet in enumerate(street_bets):
+                invested[i] += bet
+            street_bets = [0] * n_players
             # Переход на новую улицу
             if current_street == 'preflop':
                 current_street = 'flop'
@@ -612,6 +600,13 @@ def analyze_hand_for_stats(hand_history: HandHistory):
             # Обновление WTSD (если фолд, выбывает)
             if action_type_code == 'f':
                 active_players.discard(player_name)
+
+            # Ставка на улице: cbr — "до" суммы, cc — до текущей (колл олл-ина — не больше стека)
+            player_idx = int(player_code[1:]) - 1
+            if action_type_code == 'cbr':
+                street_bets[player_idx] = int(parts[2])
+            elif action_type_code == 'cc':
+                street_bets[player_idx] = min(max(street_bets), hh_stacks[player_idx] - invested[player_idx])
             
             key_to_update = 'hands_' + player_map.get(player_code)[1]
             stats_update[player_name][key_to_update] = 1
@@ -750,11 +745,25 @@ def analyze_hand_for_stats(hand_history: HandHistory):
             except ValueError:
                 pass
 
+    # Непринятая часть ставки возвращается: максимум вложений — не больше второго по величине
+    for i, bet in enumerate(street_bets):
+        invested[i] += bet
+    if n_players > 1:
+        top = max(range(n_players), key=invested.__getitem__)
+        invested[top] = min(invested[top], max(v for i, v in enumerate(invested) if i != top))
+    hh_winnings = list(hand_history.winnings) if hand_history.winnings else [0] * n_players
+    hand_time = _hand_time(hand_history)
+
     # 2. Финальная агрегация (для очистки булевых значений)
     final_stats = {}
-    for name, data in stats_update.items():
+    for i, (name, data) in enumerate(stats_update.items()):
         # VPIP и PFR сохраняются
         final_stats[name] = {
+            # Для player_hand_facts (winnings — уже без рейка)
+            'hand_id': hand_history.hand,
+            'position': player_map[f'p{i + 1}'][1],
+            'time_logged': hand_time,
+            'net_profit': int(hh_winnings[i] - invested[i]),
             'vpip': data['vpip'],
             'pfr': data['pfr'],
             # 3Bet %
@@ -795,7 +804,7 @@ def analyze_hand_for_stats(hand_history: HandHistory):
 
 # --- 2.2 ФУНКЦИЯ АНАЛИЗА РАЗДАЧИ ИГРОКА ---
 # --- 2.2 ФУНКЦИЯ АНАЛИЗА РАЗДАЧИ ИГРОКА ---
-def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, known_bb_size: float = 0.0) -> Dict[str, Any]:
+def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, known_bb_size: int = 0, compute_ev: bool = True) -> Dict[str, Any]:
     
     # 0. Проверяем, участвовал ли игрок в раздаче
     if analyze_player_name not in hand_history.players:
@@ -806,8 +815,8 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
     player_map = {}
     all_players = [p for p in hand_history.players]
     analyze_player_code = ""
-    player_bet = Decimal('0.00')
-    player_win = Decimal('0.00')
+    player_bet = 0
+    player_win = 0
     
     # Ensure list conversion for subscriptable access
     hh_winnings = list(hand_history.winnings) if hand_history.winnings else []
@@ -835,8 +844,8 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
                 'first_raiser_position': "",
                 'is_steal_attempt': 0,
                 # 'actions': [],
-                'net_profit': 0.00,
-                'net_profit': 0.00,
+                'net_profit': 0,
+                'net_profit': 0,
                 'time_logged': datetime.datetime.now(), # Placeholder
                 'final_street': 'preflop',
                 'final_action': 'n/a',
@@ -859,50 +868,35 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
                 'cbet_flop_opp': 0,
                 'is_fold_to_cbet': 0, # fcbet_flop_succ
                 'fold_to_cbet_opp': 0,  # fcbet_flop_opp
-                'bb_size': 0.0,
-                'ev_adjusted': 0.0
+                'bb_size': 0,
+                'ev_adjusted': 0
             }
 
 
             # 1. ВРЕМЯ РАЗДАЧИ
-            try:
-                hh_date = getattr(hand_history, 'date', None)
-                hh_time = getattr(hand_history, 'time', None)
-
-                # Fix for PokerKit versions where .date is not present but year/month/day are
-                if hh_date is None:
-                    if hasattr(hand_history, 'year') and hasattr(hand_history, 'month') and hasattr(hand_history, 'day'):
-                        # Ensure values are integers (sometimes None if parsing failed)
-                        if hand_history.year and hand_history.month and hand_history.day:
-                            hh_date = datetime.date(hand_history.year, hand_history.month, hand_history.day)
-
-                if isinstance(hh_date, datetime.date):
-                    if hh_time and isinstance(hh_time, datetime.time):
-                         stats_update[player_name]['time_logged'] = datetime.datetime.combine(hh_date, hh_time)
-                    else:
-                         stats_update[player_name]['time_logged'] = datetime.datetime(hh_date.year, hh_date.month, hh_date.day)
-            except Exception:
-                pass
+            hand_time = _hand_time(hand_history)
+            if hand_time is not None:
+                stats_update[player_name]['time_logged'] = hand_time
             
-            # 1.1 BB SIZE EXTRACTION
+            # 1.1 BB SIZE EXTRACTION (в центах, как и все суммы раздачи)
 
             # Priority 1: explicitly passed known_bb_size
             if known_bb_size > 0:
-                 stats_update[player_name]['bb_size'] = float(known_bb_size)
+                 stats_update[player_name]['bb_size'] = int(known_bb_size)
             # Priority 2: min_bet from HandHistory (usually BB in NLHE)
             elif getattr(hand_history, 'min_bet', None):
-                 stats_update[player_name]['bb_size'] = float(hand_history.min_bet)
+                 stats_update[player_name]['bb_size'] = int(hand_history.min_bet)
             # Priority 3: Extract from blinds list (fallback)
             elif hh_blinds:
-                active_blinds = [float(b) for b in hh_blinds if b and float(b) > 0]
+                active_blinds = [int(b) for b in hh_blinds if b and b > 0]
                 if active_blinds:
                     stats_update[player_name]['bb_size'] = max(active_blinds)
                 else:
                     if len(hh_blinds) >= 2:
-                         val = float(hh_blinds[1]) if hh_blinds[1] else 0.0
-                         stats_update[player_name]['bb_size'] = val if val > 0 else 0.0
+                         val = int(hh_blinds[1]) if hh_blinds[1] else 0
+                         stats_update[player_name]['bb_size'] = val if val > 0 else 0
                     elif len(hh_blinds) == 1:
-                         stats_update[player_name]['bb_size'] = float(hh_blinds[0])
+                         stats_update[player_name]['bb_size'] = int(hh_blinds[0])
 
             
             # --- ОТЛАДОЧНЫЙ БЛОК ДЛЯ ПОИСКА ОШИБКИ ---
@@ -1085,21 +1079,21 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
     # 1.2 Подсчет инвестиций и выигрыша.
     # Мы должны отслеживать ставки на каждой улице (префлоп, флоп, терн, ривер),
     # чтобы правильно вычислять размеры коллов и общие инвестиции.
-    total_investment = {p_code: Decimal('0.00') for p_code in player_map.keys()}
-    total_investment = {p_code: Decimal('0.00') for p_code in player_map.keys()}
-    bets_this_street = {p_code: Decimal('0.00') for p_code in player_map.keys()}
+    # Все суммы — целые центы (parse_cents в CustomHandHistory)
+    total_investment = {p_code: 0 for p_code in player_map.keys()}
+    bets_this_street = {p_code: 0 for p_code in player_map.keys()}
     
     current_street = 'preflop' # Инициализация улицы
     
     remaining_stacks = {f'p{i+1}': stack for i, stack in enumerate(hh_stacks)}
-    current_street_bet = Decimal('0.00')
-    last_bet_by_player = {'player': None, 'amount': Decimal('0.00')}
+    current_street_bet = 0
+    last_bet_by_player = {'player': None, 'amount': 0}
     last_action_was_fold = False
     
     # For final state tracking
     current_board_cards = ""
     last_aggressor_pos = ""
-    pot_before_street = Decimal('0.00')
+    pot_before_street = 0
     
     # C-Bet / Fold to C-Bet Tracking
     preflop_aggressor = last_raiser # Passed from Loop 1 (if Loop 1 found a raiser)
@@ -1107,15 +1101,13 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
     flop_cbet_made = False
     f2cbet_counted = False
     
-    decimal.getcontext().prec = 10 # Увеличиваем точность для Decimal
-
     # Инициализируем ставки блайндами
     for i, p_name in enumerate(all_players):
         p_code = f'p{i+1}'
         if hh_blinds and i < len(hh_blinds):
             blind_amount = hh_blinds[i]
             if blind_amount > 0:
-                investment = min(blind_amount, remaining_stacks.get(p_code, Decimal('0.00')))
+                investment = min(blind_amount, remaining_stacks.get(p_code, 0))
                 total_investment[p_code] += investment
                 remaining_stacks[p_code] -= investment # ❗️ Уменьшаем остаток стека
                 bets_this_street[p_code] = blind_amount
@@ -1134,9 +1126,9 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
             street_pot = sum(bets_this_street.values())
             pot_before_street += street_pot
 
-            bets_this_street = {p_code: Decimal('0.00') for p_code in player_map.keys()}
-            current_street_bet = Decimal('0.00')
-            last_bet_by_player = {'player': None, 'amount': Decimal('0.00')}
+            bets_this_street = {p_code: 0 for p_code in player_map.keys()}
+            current_street_bet = 0
+            last_bet_by_player = {'player': None, 'amount': 0}
             last_aggressor_pos = "" # Сброс агрессора на новой улице
 
             # Обновляем карты борда
@@ -1191,12 +1183,12 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
             last_action_was_fold = False
 
             if action_type_code == 'cbr': # Bet/Raise
-                raise_to_amount = Decimal(parts[2])
-                already_invested_this_street = bets_this_street.get(player_code, Decimal('0.00'))
+                raise_to_amount = int(parts[2])
+                already_invested_this_street = bets_this_street.get(player_code, 0)
                 additional_investment = raise_to_amount - already_invested_this_street
 
                 # Убираем дублирование, оставляем одну строку
-                total_investment[player_code] = total_investment.get(player_code, Decimal('0.00')) + additional_investment
+                total_investment[player_code] = total_investment.get(player_code, 0) + additional_investment
                 remaining_stacks[player_code] -= additional_investment # ❗️ Уменьшаем остаток стека
                 bets_this_street[player_code] = raise_to_amount
                 current_street_bet = raise_to_amount
@@ -1204,25 +1196,25 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
                 last_aggressor_pos = player_map.get(player_code)[1] # Сохраняем позицию агрессора
 
             elif action_type_code == 'cc': # Call
-                last_bet_by_player = {'player': None, 'amount': Decimal('0.00')}
-                already_invested_this_street = bets_this_street.get(player_code, Decimal('0.00'))
+                last_bet_by_player = {'player': None, 'amount': 0}
+                already_invested_this_street = bets_this_street.get(player_code, 0)
                 
                 required_call = current_street_bet - already_invested_this_street
                 
                 # ❗️ Новая логика с учетом стека: Игрок не может поставить больше, чем у него есть
-                player_stack = total_investment.get(player_code, Decimal('0.00'))
+                player_stack = total_investment.get(player_code, 0)
                 # Вычисляем реальный остаток стека
-                real_remaining_stack = remaining_stacks.get(player_code, Decimal('0.00'))
+                real_remaining_stack = remaining_stacks.get(player_code, 0)
                 
                 call_amount = min(required_call, real_remaining_stack)
 
                 if call_amount > 0:
                     # Убираем дублирование
-                    total_investment[player_code] = total_investment.get(player_code, Decimal('0.00')) + call_amount
+                    total_investment[player_code] = total_investment.get(player_code, 0) + call_amount
                     remaining_stacks[player_code] -= call_amount # ❗️ Уменьшаем остаток стека
-                    bets_this_street[player_code] = bets_this_street.get(player_code, Decimal('0.00')) + call_amount
+                    bets_this_street[player_code] = bets_this_street.get(player_code, 0) + call_amount
 
-                total_invested_by_caller = bets_this_street.get(player_code, Decimal('0.00'))
+                total_invested_by_caller = bets_this_street.get(player_code, 0)
                 if total_invested_by_caller < current_street_bet:
                     current_street_bet = total_invested_by_caller
 
@@ -1233,7 +1225,7 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
             elif action_type_code == 'r': # Return Bet (Uncalled bet returned)
                 # Format: pX r amount
                 # Example: p1 r 1.12
-                return_amount = Decimal(parts[2])
+                return_amount = int(parts[2])
                 
                 # Correct investment and bets
                 total_investment[player_code] -= return_amount
@@ -1255,7 +1247,7 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
                 facing_pct = 0.0
                 if current_street_bet > 0 and action_type_code in ('cc', 'f'):
                     # Сколько нам нужно доставить?
-                    my_invested = bets_this_street.get(analyze_player_code, Decimal('0.00'))
+                    my_invested = bets_this_street.get(analyze_player_code, 0)
                     to_call = current_street_bet - my_invested
                     
                     if current_pot > 0:
@@ -1277,7 +1269,7 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
                 stats_update[analyze_player_name]['final_hand_strength'] = strength
 
 
-    player_bet = total_investment.get(analyze_player_code, Decimal('0.00'))
+    player_bet = total_investment.get(analyze_player_code, 0)
 
     # Если последнее действие в истории было фолдом, значит, предыдущая ставка не была принята.
     if last_action_was_fold and last_bet_by_player['player'] == analyze_player_code:
@@ -1345,10 +1337,11 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
             'fcbet_flop_opp': data.get('fold_to_cbet_opp', 0),  # Internal: fold_to_cbet_opp
             'is_fold_to_3bet': data.get('is_fold_to_3bet', 0), 
             'fold_to_3bet_opp': data.get('fold_to_3bet_opp', 0),
-            'bb_size': data.get('bb_size', 0.0)
+            'bb_size': data.get('bb_size', 0)
         }
 
     # RECALCULATE NET PROFIT USING STACKS (Fixes uncalled bet return issues)
+    all_in_seen = False
     try:
         if analyze_player_name in hand_history.players:
             h_idx = hand_history.players.index(analyze_player_name)
@@ -1357,18 +1350,21 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
             final_state = None
             for state in hand_history:
                 final_state = state
+                # Тот же момент All-In, что ищет calculate_all_in_ev: без него расчет EV не нужен
+                if not all_in_seen:
+                    all_in_seen = _is_all_in_moment(state, h_idx)
                 
             if final_state:
                 end_stack = final_state.stacks[h_idx]
-                # Use Decimal strings to ensure precision
-                reliable_profit = float(Decimal(str(end_stack)) - Decimal(str(start_stack)))
+                # Целые центы: разница стеков точная
+                reliable_profit = int(end_stack - start_stack)
                 
                 if analyze_player_name in final_stats:
                     # Subtract Rake if we won (assuming we paid it)
                     # Note: We now pre-parse rake into 'rake_amount' attribute in CustomHandHistory
-                    rake_val = getattr(hand_history, 'rake_amount', 0.0)
+                    rake_val = getattr(hand_history, 'rake_amount', 0)
                     if reliable_profit > 0 and rake_val > 0:
-                         reliable_profit -= float(rake_val)
+                         reliable_profit -= int(rake_val)
                             
 
 
@@ -1386,514 +1382,816 @@ def analyze_player_stats(hand_history: HandHistory, analyze_player_name: str, kn
 
     # 2. EV CALCULATION (All-In EV)
     # Only if Hero went to showdown and it was an All-In situation.
+    # По умолчанию EV = реальному профиту. Для кандидатов (Hero дошел до шоудауна)
+    # считаем EV сразу или, на живом пути (compute_ev=False), помечаем раздачу
+    # как ожидающую (ev_pending) и отдаем расчет фоновому пулу (ev_worker.py) —
+    # только если в раздаче был момент All-In (иначе calculate_all_in_ev вернет None).
+    final_stats[analyze_player_name]['ev_adjusted'] = final_stats[analyze_player_name].get('net_profit', 0)
+    final_stats[analyze_player_name]['ev_pending'] = 0
+    final_stats[analyze_player_name]['ev_std_err'] = None
+    final_stats[analyze_player_name]['is_all_in'] = 0
+
+    if analyze_player_name in active_players and was_showdown and hand_history.winnings:
+        if compute_ev:
+            ev_result = calculate_all_in_ev(hand_history, analyze_player_name, final_stats[analyze_player_name].get('net_profit', 0))
+            if ev_result is not None:
+                final_stats[analyze_player_name]['ev_adjusted'], final_stats[analyze_player_name]['ev_std_err'] = ev_result
+                final_stats[analyze_player_name]['is_all_in'] = 1
+        elif all_in_seen:
+            final_stats[analyze_player_name]['ev_pending'] = 1
+
+    return final_stats
+
+# --- 2.3 ФУНКЦИЯ РАСЧЕТА ALL-IN EV ---
+def _is_all_in_moment(state, hero_idx: int) -> bool:
+    """
+    Момент All-In: раздача разыгрывается между двумя и более игроками, ходов нет,
+    Hero в раздаче и больше не ходит (Hero в All-In или фишки остались не больше чем у одного игрока).
+    """
+    active_indices = [idx for idx, status in enumerate(state.statuses) if status]
+    return (
+        state.status
+        and len(active_indices) >= 2
+        and state.actor_index is None
+        and hero_idx in active_indices
+        and any(state.stacks[idx] == 0 for idx in active_indices)
+        and (state.stacks[hero_idx] == 0
+             or sum(1 for idx in active_indices if state.stacks[idx] > 0) <= 1)
+    )
+
+
+def calculate_all_in_ev(hand_history: HandHistory, analyze_player_name: str, net_profit: int) -> Optional[Tuple[float, float]]:
+    """
+    Находит момент All-In с участием игрока и возвращает (EV, стандартная ошибка EV)
+    в центах (net_profit — тоже в центах); округляет их запись в БД.
+    Момент All-In — первое состояние, где торговля закрыта и Hero больше не ходит
+    (Hero в All-In или фишки остались не больше чем у одного игрока); борд берется
+    из этого момента. Банки (основной и побочные) строятся из итоговых вкладов
+    игроков, дошедших до вскрытия; доля Hero в каждом считается за один проход
+    симуляции.
+    Возвращает None, если All-In не найден или карты соперников неизвестны.
+    Сид Монте-Карло берется из номера раздачи, поэтому результат воспроизводим.
+    Функция не трогает БД, поэтому может выполняться в фоновом процессе.
+    """
     try:
-        final_stats[analyze_player_name]['ev_adjusted'] = final_stats[analyze_player_name].get('net_profit', 0.0)
-        
-        if analyze_player_name in active_players and was_showdown and hand_history.winnings:
-             # Find Hero Index
-            if analyze_player_name in hand_history.players:
-                hero_idx = hand_history.players.index(analyze_player_name)
-                
-                # Iterate through states to find the All-In moment
-                found_all_in = False
-                hero_equity = 0.0
-                
-                # Pass 1: Gather Final Known Hands from HH Actions (Method B)
-                # We do this BEFORE state iteration to have validation map ready.
-                player_known_hands = {}
-                standard_deck_strs = {str(c) for c in Deck.STANDARD}
-                
-                if hasattr(hand_history, 'actions'):
-                     for action in hand_history.actions:
-                         # Expected format: "p{N} sm {Cards}" e.g "p2 sm AcQc"
-                         if isinstance(action, str) and ' sm ' in action:
-                             parts = action.split()
-                             if len(parts) >= 3 and parts[1] == 'sm':
-                                 p_str = parts[0] # p2
-                                 c_str = parts[2] # AcQc
-                                 if p_str.startswith('p') and c_str != '????':
-                                     try:
-                                         idx = int(p_str[1:]) - 1
-                                         parsed_cards = list(Card.parse(c_str))
-                                         player_known_hands[idx] = parsed_cards
-                                     except Exception:
-                                         pass
-                                         
-                # print(f"DEBUG EV: Gathered Known Hands (Actions): {player_known_hands}")
-
-                # Pass 2: Iterate using generic iterator (Fresh States)
-                for state in hand_history:
-                    # print(f"DEBUG LOOP State: {state.statuses} Stacks: {state.stacks}")
-                    active_indices = [idx for idx, status in enumerate(state.statuses) if status]
-                    is_all_in = any(state.stacks[idx] == 0 for idx in active_indices)
-                    
-                    if is_all_in:
-                        # Ensure Hero is actually involved
-                        if hero_idx not in active_indices:
-                            continue
-                            
-                        # Use Gathered Cards for validation/calc
-                        all_cards_valid = True
-                        calc_hole_cards = {}
-                        
-                        for idx in active_indices:
-                            # Start with current state cards
-                            cards = state.hole_cards[idx]
-                            
-                            # Check validity
-                            is_valid = False
-                            if cards:
-                                is_valid = True
-                                for c in cards:
-                                    if str(c) not in standard_deck_strs:
-                                        is_valid = False; break
-                            
-                            if not is_valid:
-                                # Try patch from gathered info
-                                if idx in player_known_hands:
-                                    cards = player_known_hands[idx]
-                                    is_valid = True 
-                                    # print(f"DB EV DEBUG: Patching Player {idx} with {cards}")
-                            
-                            if not is_valid:
-                                all_cards_valid = False
-                                # print(f"DB EV DEBUG: Player {idx} has unknown cards even after patch. Known: {list(player_known_hands.keys())}")
-                                break
-                            
-                            calc_hole_cards[idx] = cards
-                        
-                        if not all_cards_valid:
-                            continue
-                        
-                        if all_cards_valid:
-                            try:
-                                # Identify Hero and Villain Holes using PATCHED cards
-                                hero_ranges = calc_hole_cards[hero_idx]
-                                villain_indices = [idx for idx in active_indices if idx != hero_idx]
-                                villain_ranges = [calc_hole_cards[idx] for idx in villain_indices]
-                                
-                                raw_board = state.board_cards
-                                # Fix nested board
-                                board = []
-                                for item in raw_board:
-                                    if isinstance(item, list):
-                                        board.extend(item)
-                                    else:
-                                        board.append(item)
-                                
-                                deck = list(Deck.STANDARD)
-                                # print(f"DB EV DEBUG: Calcing Equity at State. Board: {board} Hero: {hero_ranges} Villains: {villain_ranges}")
-                                
-                                # Custom Calculation
-                                hero_equity = calculate_equity_monte_carlo(
-                                    hero_ranges, 
-                                    villain_ranges, 
-                                    board, 
-                                    deck, 
-                                    sample_count=1000
-                                )
-                                
-                                # print(f"DB EV DEBUG: Calculated Equity: {hero_equity}")
-                                
-                                found_all_in = True
-                                break # Stop at first All-In moment
-                                
-                            except Exception as e:
-                                # import traceback
-                                # print(f"EV Calc Error for {player_name} in hand {hand_history.hand}: {e}")
-                                # print(traceback.format_exc())
-                                break
-                
-                if found_all_in:
-                    # Calculate EV using Final Pot and All-In Equity
-                    total_pot = sum(hand_history.winnings)
-                    hero_collected = hand_history.winnings[hero_idx]
-                    net_profit_val = float(final_stats[analyze_player_name].get('net_profit', 0.0))
-                    hero_invested = float(hero_collected) - net_profit_val
-                    
-                    ev_val = (float(total_pot) * hero_equity) - hero_invested
-                    
-                    final_stats[analyze_player_name]['ev_adjusted'] = ev_val
-                    # print(f"EV CALC SUCCESS: {analyze_player_name} Eq: {hero_equity:.2f} EV: {ev_val:.2f}")
+        if analyze_player_name not in hand_history.players:
+            return None
+
+        hero_idx = hand_history.players.index(analyze_player_name)
+
+        # Iterate through states to find the All-In moment
+        found_all_in = False
+        hero_expected = 0.0
+        expected_std_err = 0.0
+        pots = []
+
+        # Pass 1: Gather Final Known Hands from HH Actions (Method B)
+        # We do this BEFORE state iteration to have validation map ready.
+        player_known_hands = {}
+        standard_deck_strs = {str(c) for c in Deck.STANDARD}
+
+        if hasattr(hand_history, 'actions'):
+             for action in hand_history.actions:
+                 # Expected format: "p{N} sm {Cards}" e.g "p2 sm AcQc"
+                 if isinstance(action, str) and ' sm ' in action:
+                     parts = action.split()
+                     if len(parts) >= 3 and parts[1] == 'sm':
+                         p_str = parts[0] # p2
+                         c_str = parts[2] # AcQc
+                         if p_str.startswith('p') and c_str != '????':
+                             try:
+                                 idx = int(p_str[1:]) - 1
+                                 parsed_cards = list(Card.parse(c_str))
+                                 player_known_hands[idx] = parsed_cards
+                             except Exception:
+                                 pass
+
+        # print(f"DEBUG EV: Gathered Known Hands (Actions): {player_known_hands}")
+
+        # Pass 2: Iterate using generic iterator (Fresh States)
+        # The state object is mutated in place, so copy what we need.
+        board = []
+        lock_hole_cards = {}
+        final_active = []
+        final_contributions = {}
+        for state in hand_history:
+            # print(f"DEBUG LOOP State: {state.statuses} Stacks: {state.stacks}")
+            active_indices = [idx for idx, status in enumerate(state.statuses) if status]
+            if not state.status or len(active_indices) < 2:
+                continue
+
+            # Pot structure is taken from the last state before the pot is pushed:
+            # players who fold after Hero's All-In lose their claim to it.
+            final_active = active_indices
+            final_contributions = {
+                idx: float(state.starting_stacks[idx] - state.stacks[idx])
+                for idx in range(len(state.stacks))
+            }
+
+            if found_all_in:
+                continue
+
+            # All-In moment: no pending action and Hero can't act anymore
+            # (Hero is All-In, or nobody else has chips behind).
+            if _is_all_in_moment(state, hero_idx):
+                raw_board = state.board_cards
+                # Fix nested board
+                for item in raw_board:
+                    if isinstance(item, list):
+                        board.extend(item)
+                    else:
+                        board.append(item)
+                lock_hole_cards = {idx: list(state.hole_cards[idx]) for idx in active_indices}
+                found_all_in = True # Stop at first All-In moment
+
+        if found_all_in:
+            # Use Gathered Cards for validation/calc
+            calc_hole_cards = {}
+            for idx in final_active:
+                # Start with cards known at the All-In moment
+                cards = lock_hole_cards.get(idx, [])
+
+                # Check validity
+                is_valid = bool(cards) and all(str(c) in standard_deck_strs for c in cards)
+
+                if not is_valid and idx in player_known_hands:
+                    # Try patch from gathered info
+                    cards = player_known_hands[idx]
+                    is_valid = True
+
+                if not is_valid:
+                    # print(f"DB EV DEBUG: Player {idx} has unknown cards even after patch. Known: {list(player_known_hands.keys())}")
+                    return None
+
+                calc_hole_cards[idx] = cards
+
+            if hero_idx not in calc_hole_cards:
+                return None
+
+            # Main/side pots from what everyone has put in
+            pots = build_side_pots(final_contributions, final_active)
+
+            deck = list(Deck.STANDARD)
+            # Custom Calculation (PATCHED cards of every live player)
+            hero_expected, expected_std_err, _ = estimate_pot_share(
+                calc_hole_cards,
+                hero_idx,
+                pots,
+                board,
+                deck,
+                seed=str(hand_history.hand)
+            )
+            # print(f"DB EV DEBUG: Expected share: {hero_expected} Pots: {pots}")
+
+            # Rake is taken from the pots: scale expected share by collected / contested
+            total_pot = sum(amount for amount, _ in pots)
+            total_collected = float(sum(hand_history.winnings))
+            rake_factor = total_collected / total_pot if total_pot > 0 else 1.0
+
+            hero_collected = hand_history.winnings[hero_idx]
+            net_profit_val = float(net_profit)
+            hero_invested = float(hero_collected) - net_profit_val
+
+            ev_val = (hero_expected * rake_factor) - hero_invested
+            ev_std_err = expected_std_err * rake_factor
+            # print(f"EV CALC SUCCESS: {analyze_player_name} Share: {hero_expected:.2f} EV: {ev_val:.2f}")
+            return ev_val, ev_std_err
 
     except Exception as e:
         # print(f"General EV Logic Error for {analyze_player_name}: {e}")
-        # import traceback
         pass
 
-    return final_stats
+    return None
+
+def _player_hand_fact_row(player_name: str, data: Dict[str, Any], segment_id: int) -> tuple:
+    """Строка player_hand_facts из результата analyze_hand_for_stats."""
+    return (
+        player_name, int(data['hand_id']), segment_id, _to_epoch(data.get('time_logged')),
+        _encode_hand_log_value('position', data.get('position') or '') or 0,
+        _player_hand_flags(data), data.get('af_bets_raises', 0), data.get('af_calls', 0),
+        int(data.get('net_profit', 0)),
+    )
+
+
+def _insert_player_hand_facts(conn: sqlite3.Connection, rows: List[tuple]):
+    conn.executemany("INSERT OR IGNORE INTO players (name) VALUES (?)", [(row[0],) for row in rows])
+    conn.executemany(PLAYER_HAND_FACTS_INSERT_SQL, rows)
+
 
 def update_stats_in_db(stats_to_commit: Dict[str, Dict[str, Any]], table_segment: str):
-    """Обновляет статистику в динамической таблице, включая 3Bet и Fold to 3Bet."""
+    """Обновляет статистику сегмента в player_stats, включая 3Bet и Fold to 3Bet (сразу, без отложенной записи)."""
     
     if not stats_to_commit:
         return
 
-    # 1. Сначала настраиваем таблицу (если нет)
-    setup_database_table(table_segment)
-    safe_table_name = table_segment.replace("'", "").replace(";", "").replace(" ", "")
+    try:
+        segment_id = get_segment_id(table_segment)
+        _opponent_stats.add_hand(DB_NAME, table_segment, stats_to_commit)
+        _opponent_stats.flush()
+        if segment_id is not None:
+            rows = [_player_hand_fact_row(name, data, segment_id) for name, data in stats_to_commit.items()]
+            submit_write(DB_NAME, lambda conn: _insert_player_hand_facts(conn, rows), "факты раздачи")
+    except Exception as e:
+        print(f"❌ Ошибка при обновлении статистики в БД ('{table_segment}'): {e}")
 
-    conn = None
+def _hand_log_row(data: Dict[str, Any], segment_id: int = 0) -> tuple:
+    """Строка my_hand_log из результата analyze_player_stats (в порядке HAND_LOG_INSERT_SQL)."""
+    cards = data.get('cards', "")
+    ev_adjusted = data.get('ev_adjusted')
+    ev_std_err = data.get('ev_std_err')
+    code = _encode_hand_log_value
+    return (
+        data.get('hand_id', ""), data.get('table_part_name', ""), data.get('player_name', ""),
+        code('position', data.get('position', "")), cards,
+        data.get('is_rfi', 0), data.get('is_pfr', 0), data.get('is_vpip', 0),
+        code('first_action', data.get('first_action', "")), code('first_raiser_position', data.get('first_raiser_position', "")),
+        data.get('is_steal_attempt', ""), int(data.get('net_profit', 0)), _to_epoch(data.get('time_logged')),
+        code('final_street', data.get('final_street', '')), code('final_action', data.get('final_action', '')),
+        code('final_hand_strength', data.get('final_hand_strength', '')),
+        data.get('facing_bet_pct_pot', 0.0), code('opponent_position', data.get('opponent_position', '')), data.get('board_cards', ''),
+        data.get('rfi_opportunity', 0),
+        data.get('facing_steal', 0), data.get('is_steal_defend', 0), data.get('is_steal_3bet', 0),
+        data.get('is_steal_fold', 0), data.get('steal_success', 0),
+        # BB vs Limp
+        data.get('facing_limp', 0), data.get('is_limp_check', 0), data.get('is_limp_iso', 0),
+        # Normalize Hand for Chart
+        code('normalized_hand', normalize_cards(cards)),
+        # WTSD
+        data.get('wtsd', 0), data.get('wsd', 0),
+        # C-Bet & 3-Bet (Updated Keys)
+        data.get('is_3bet_pre', 0), data.get('is_3bet_opp_pre', 0),
+        data.get('cbet_flop_succ', 0), data.get('cbet_flop_opp', 0),
+        data.get('fcbet_flop_succ', 0), data.get('fcbet_flop_opp', 0),
+        data.get('is_fold_to_3bet', 0), data.get('fold_to_3bet_opp', 0),
+        # Суммы — целые центы; EV из расчета эквити дробный и округляется до цента
+        int(data.get('bb_size', 0)),
+        _ev_cents(ev_adjusted),
+        data.get('ev_pending', 0),
+        float(ev_std_err) if ev_std_err is not None else None,
+        data.get('is_all_in', 0),
+        segment_id
+    )
+
+
+def update_hand_stats_in_db(stats_to_commit: Dict[str, Dict[str, Any]], table_segment: str = ""):
+    """Сохраняет данные об одной сыгранной раздаче в лог (table_segment — для дневных агрегатов)."""
+    hand_id = None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        segment_id = (get_segment_id(table_segment) if table_segment else None) or 0
+        rows = []
+        for data in stats_to_commit.values():
+            hand_id = data.get('hand_id', "")
+            rows.append(_hand_log_row(data, segment_id))
+        submit_write(DB_NAME, lambda conn: conn.executemany(HAND_LOG_INSERT_SQL, rows), f"лог раздачи {hand_id}")
+    except Exception as e:
+        print(f"Ошибка сохранения лога раздачи {hand_id}: {e}", file=sys.stderr)
+
+# --- АГРЕГАТЫ В ПАМЯТИ (stats_store.py) ---
+
+
+def flush_opponent_stats(only_if_due: bool = False) -> int:
+    """
+    Отложенная запись статистики оппонентов (only_if_due — только если прошло DB_STATS_FLUSH_MS).
+    При быстрой загрузке дельты копятся до finish_bulk_load.
+    """
+    if is_bulk_loading(DB_NAME):
+        return 0
+    return _opponent_stats.flush(only_if_due)
+
+
+def get_hero_session_stats(player_name: str, min_time: datetime.datetime) -> Dict[str, Any]:
+    """Сессионная статистика Hero для HUD из памяти (формат get_stats_for_players)."""
+    try:
+        return _hero_session.get_hud_stats(DB_NAME, player_name, min_time)
+    except Exception as e:
+        print(f"❌ Ошибка при получении сессионной статистики Hero: {e}")
+        return {}
+
+# --- ПАКЕТНАЯ ЗАПИСЬ РАЗДАЧ ---
+
+class HandBatchWriter:
+    """
+    Накапливает строки my_hand_log и player_hand_facts и пишет их одной транзакцией
+    (executemany) раз в max_hands раздач или max_delay_ms. Дельты агрегатов сегментов сразу
+    уходят в память (OpponentStatsStore) и пишутся в БД отложенно, строки Hero
+    сразу учитываются в сессионной статистике (HeroSessionStats).
+    Объект используется одним потоком; перед чтением лога вызывать flush().
+    """
+
+    def __init__(self, max_hands: int = DB_LIVE_BATCH_HANDS, max_delay_ms: int = DB_LIVE_BATCH_MS):
+        self.max_hands = max_hands
+        self.max_delay = max_delay_ms / 1000.0
+        self._log_rows: List[tuple] = []
+        self._fact_rows: List[tuple] = []
+        self._hands = 0
+        self._batch_started = 0.0
+
+    def add_hand(self, table_segment: str, stats_to_commit: Dict[str, Dict[str, Any]], player_stats_to_commit: Dict[str, Dict[str, Any]]):
+        """Добавляет раздачу в пачку; пачка пишется, если набралось max_hands или истек max_delay_ms."""
+        segment_id = get_segment_id(table_segment)
+        _opponent_stats.add_hand(DB_NAME, table_segment, stats_to_commit)
+        if segment_id is not None:
+            for player_name, data in stats_to_commit.items():
+                try:
+                    self._fact_rows.append(_player_hand_fact_row(player_name, data, segment_id))
+                except Exception as e:
+                    print(f"Ошибка сохранения фактов раздачи {data.get('hand_id', '')}: {e}", file=sys.stderr)
+        segment_id = segment_id or 0
+
+        for data in player_stats_to_commit.values():
+            try:
+                self._log_rows.append(_hand_log_row(data, segment_id))
+                _hero_session.add_row(DB_NAME, data)
+            except Exception as e:
+                print(f"Ошибка сохранения лога раздачи {data.get('hand_id', '')}: {e}", file=sys.stderr)
+
+        if self._hands == 0:
+            self._batch_started = time.perf_counter()
+        self._hands += 1
+        if self._hands >= self.max_hands or time.perf_counter() - self._batch_started >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Пишет накопленные строки лога и фактов одной транзакцией (через поток записи,
+        если он запущен: тогда метод не ждет коммита). Возвращает число раздач.
+        """
+        if self._hands == 0:
+            return 0
+        log_rows, fact_rows, hands = self._log_rows, self._fact_rows, self._hands
+        self._log_rows, self._fact_rows, self._hands = [], [], 0
+        if not log_rows and not fact_rows:
+            return hands
+
+        # При быстрой загрузке — в буферы bulk_hand_log и bulk_player_hand_facts (finish_bulk_load)
+        bulk = is_bulk_loading(DB_NAME)
+
+        def write(conn):
+            conn.executemany(BULK_HAND_LOG_INSERT_SQL if bulk else HAND_LOG_INSERT_SQL, log_rows)
+            if bulk:
+                conn.executemany(BULK_PLAYER_HAND_FACTS_INSERT_SQL, fact_rows)
+            else:
+                _insert_player_hand_facts(conn, fact_rows)
+
+        try:
+            submit_write(DB_NAME, write, f"пачка из {hands} раздач")
+        except Exception as e:
+            print(f"❌ Ошибка пакетной записи {hands} раздач в БД: {e}")
+            return 0
+        return hands
 
-        for player_name, data in stats_to_commit.items():
-            is_vpip = 1 if data.get('vpip', False) else 0
-            is_pfr = 1 if data.get('pfr', False) else 0
-
-            # Новые метрики
-            s3bet = data.get('3bet_success', 0)
-            o3bet = data.get('3bet_opp', 0)
-            sf3bet = data.get('f3bet_success', 0)
-            of3bet = data.get('f3bet_opp', 0)
-
-            pfr_utg = data.get('pfr_utg', 0)
-            pfr_mp = data.get('pfr_mp', 0)
-            pfr_co = data.get('pfr_co', 0)
-            pfr_bu = data.get('pfr_bu', 0)
-            pfr_sb = data.get('pfr_sb', 0)
-            hands_utg = data.get('hands_utg', 0)
-            hands_mp = data.get('hands_mp', 0)
-            hands_co = data.get('hands_co', 0)
-            hands_bu = data.get('hands_bu', 0)
-            hands_sb = data.get('hands_sb', 0)
-
-            rfi_opp_utg = data.get('rfi_opp_utg', 0)
-            rfi_opp_mp = data.get('rfi_opp_mp', 0)
-            rfi_opp_co = data.get('rfi_opp_co', 0)
-            rfi_opp_bu = data.get('rfi_opp_bu', 0)
-            rfi_succ_utg = data.get('rfi_succ_utg', 0)
-            rfi_succ_mp = data.get('rfi_succ_mp', 0)
-            rfi_succ_co = data.get('rfi_succ_co', 0)
-            rfi_succ_bu = data.get('rfi_succ_bu', 0)
-
-            af_bets_raises = data.get('af_bets_raises', 0)
-            af_calls = data.get('af_calls', 0)
-
-            cbet_op = data.get('cbet_flop_opp', 0)
-            cbet_sc = data.get('cbet_flop_succ', 0)
-            fcbet_op = data.get('fcbet_flop_opp', 0)
-            fcbet_sc = data.get('fcbet_flop_succ', 0)
-            wtsd = 1 if data.get('wtsd', False) else 0
-            wsd = 1 if data.get('wsd', False) else 0
-
-
-
-            cursor.execute(f"""
-                INSERT INTO {safe_table_name}
-                    (player_name, hands, vpip_hands, pfr_hands,
-                    _3bet_opportunities, _3bet_successes,
-                    _fold_to_3bet_opportunities, _fold_to_3bet_successes,
-                    pfr_utg, pfr_mp, pfr_co, pfr_bu, pfr_sb,
-                    hands_utg, hands_mp, hands_co, hands_bu, hands_sb,
-                    rfi_opp_utg, rfi_opp_mp, rfi_opp_co, rfi_opp_bu,
-                    rfi_succ_utg, rfi_succ_mp, rfi_succ_co, rfi_succ_bu
-                    , af_bets_raises, af_calls,
-                    cbet_flop_opp, cbet_flop_succ, fcbet_flop_opp, fcbet_flop_succ, wtsd_hands, wsd_hands
-                    )
-                VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(player_name) DO UPDATE SET
-                    hands = hands + 1,
-                    vpip_hands = vpip_hands + excluded.vpip_hands,
-                    pfr_hands = pfr_hands + excluded.pfr_hands,
-                    _3bet_opportunities = _3bet_opportunities + excluded._3bet_opportunities,
-                    _3bet_successes = _3bet_successes + excluded._3bet_successes,
-                    _fold_to_3bet_opportunities = _fold_to_3bet_opportunities + excluded._fold_to_3bet_opportunities,
-                    _fold_to_3bet_successes = _fold_to_3bet_successes + excluded._fold_to_3bet_successes,
-                    pfr_utg = pfr_utg + excluded.pfr_utg,
-                    pfr_mp = pfr_mp + excluded.pfr_mp,
-                    pfr_co = pfr_co + excluded.pfr_co,
-                    pfr_bu = pfr_bu + excluded.pfr_bu,
-                    pfr_sb = pfr_sb + excluded.pfr_sb,
-                    hands_utg = hands_utg + excluded.hands_utg,
-                    hands_mp = hands_mp + excluded.hands_mp,
-                    hands_co = hands_co + excluded.hands_co,
-                    hands_bu = hands_bu + excluded.hands_bu,
-                    hands_sb = hands_sb + excluded.hands_sb,
-                    rfi_opp_utg = rfi_opp_utg + excluded.rfi_opp_utg,
-                    rfi_opp_mp = rfi_opp_mp + excluded.rfi_opp_mp,
-                    rfi_opp_co = rfi_opp_co + excluded.rfi_opp_co,
-                    rfi_opp_bu = rfi_opp_bu + excluded.rfi_opp_bu,
-                    rfi_succ_utg = rfi_succ_utg + excluded.rfi_succ_utg,
-                    rfi_succ_mp = rfi_succ_mp + excluded.rfi_succ_mp,
-                    rfi_succ_co = rfi_succ_co + excluded.rfi_succ_co,
-                    rfi_succ_bu = rfi_succ_bu + excluded.rfi_succ_bu,
-                    af_bets_raises = af_bets_raises + excluded.af_bets_raises,
-                    af_calls = af_calls + excluded.af_calls,
-                    cbet_flop_opp = cbet_flop_opp + excluded.cbet_flop_opp,
-                    cbet_flop_succ = cbet_flop_succ + excluded.cbet_flop_succ,
-                    fcbet_flop_opp = fcbet_flop_opp + excluded.fcbet_flop_opp,
-                    fcbet_flop_succ = fcbet_flop_succ + excluded.fcbet_flop_succ,
-                    wtsd_hands = wtsd_hands + excluded.wtsd_hands,
-                    wsd_hands = wsd_hands + excluded.wsd_hands
-            """, (
-                    player_name, is_vpip, is_pfr, o3bet, s3bet, of3bet, sf3bet,
-                    pfr_utg, pfr_mp, pfr_co, pfr_bu, pfr_sb,
-                    hands_utg, hands_mp, hands_co, hands_bu, hands_sb,
-                    rfi_opp_utg, rfi_opp_mp, rfi_opp_co, rfi_opp_bu,
-                    rfi_succ_utg, rfi_succ_mp, rfi_succ_co, rfi_succ_bu,
-                    af_bets_raises, af_calls,
-                    cbet_op, cbet_sc, fcbet_op, fcbet_sc, wtsd, wsd
-                 )
+def update_hand_ev_in_db(hand_id: Any, player_name: str, ev_adjusted: Optional[float], ev_std_err: Optional[float] = None):
+    """
+    Записывает результат фонового расчета All-In EV (и его точность) и снимает флаг ev_pending.
+    Если All-In не найден (ev_adjusted is None), остается EV = профит.
+    """
+    update_hand_ev_batch_in_db([(hand_id, player_name, ev_adjusted, ev_std_err)])
+
+def update_hand_ev_batch_in_db(results: List[Tuple[Any, str, Optional[float], Optional[float]]], month: Optional[str] = None):
+    """
+    Записывает пачку результатов All-In EV одной транзакцией.
+    results: [(hand_id, player_name, ev_adjusted, ev_std_err)].
+    Для раздач без All-In (ev_adjusted is None) EV возвращается к профиту.
+    EV и ошибка — в центах; EV округляется до целого цента, нулевой EV пишется как NULL (_ev_cents).
+    month — раздачи из архива этого месяца (get_all_in_ev_candidates), а не из основной базы.
+    """
+    if not results:
+        return
+    if month is not None:
+        try:
+            _update_archived_hand_ev(DB_NAME, month, results)
+        except Exception as e:
+            print(f"Ошибка записи EV для {len(results)} раздач архива {month}: {e}", file=sys.stderr)
+        return
+
+    found = [
+        (_ev_cents(ev), (float(err) if err is not None else None), hand_id, player)
+        for hand_id, player, ev, err in results if ev is not None
+    ]
+    not_found = [(hand_id, player) for hand_id, player, ev, _ in results if ev is None]
+
+    def write(conn):
+        if found:
+            conn.executemany(
+                "UPDATE my_hand_log SET ev_adjusted = ?, ev_std_err = ?, is_all_in = 1, ev_pending = 0 "
+                "WHERE hand_id = ? AND player_name = ?",
+                found
+            )
+        if not_found:
+            conn.executemany(
+                "UPDATE my_hand_log SET ev_adjusted = NULLIF(net_profit, 0), ev_std_err = NULL, is_all_in = 0, ev_pending = 0 "
+                "WHERE hand_id = ? AND player_name = ?",
+                not_found
             )
 
-        conn.commit()
+    try:
+        submit_write(DB_NAME, write, f"EV для {len(results)} раздач")
     except Exception as e:
-        print(f"❌ Ошибка при обновлении статистики в БД ('{table_segment}'): {e}")
-    finally:
-        if conn:
-            conn.close()
+        print(f"Ошибка записи EV для {len(results)} раздач: {e}", file=sys.stderr)
 
-def update_hand_stats_in_db(stats_to_commit: Dict[str, Dict[str, Any]]):
-    """Сохраняет данные об одной сыгранной раздаче в лог."""
+def clear_ev_pending_in_db(keys: List[Tuple[Any, str]]):
+    """Снимает ev_pending с раздач [(hand_id, player_name)], EV которых посчитать уже нельзя (EV остается = профит)."""
+    if not keys:
+        return
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        submit_write(DB_NAME, lambda conn: conn.executemany(
+            "UPDATE my_hand_log SET ev_pending = 0 WHERE hand_id = ? AND player_name = ?", keys
+        ), f"ev_pending для {len(keys)} раздач")
+    except Exception as e:
+        print(f"Ошибка снятия ev_pending для {len(keys)} раздач: {e}", file=sys.stderr)
 
-        for player_name, data in stats_to_commit.items():
-            hand_id = data.get('hand_id', "")
-            table_part_name = data.get('table_part_name', "")
-            player_name = data.get('player_name', "")
-            position = data.get('position', "")
-            cards = data.get('cards', "")
-            is_rfi = data.get('is_rfi', 0)
-            is_pfr = data.get('is_pfr', 0)
-            is_vpip = data.get('is_vpip', 0)
-            first_action = data.get('first_action', "")
-            first_raiser_position = data.get('first_raiser_position', "")
-            is_steal_attempt = data.get('is_steal_attempt', "")
-            net_profit = float(data.get('net_profit', 0.00))
-            net_profit = float(data.get('net_profit', 0.00))
-            time_logged = data.get('time_logged')
-            
-            final_street = data.get('final_street', '')
-            final_action = data.get('final_action', '')
-            final_hand_strength = data.get('final_hand_strength', '')
-            facing_bet_pct_pot = data.get('facing_bet_pct_pot', 0.0)
-            opponent_position = data.get('opponent_position', '')
-            board_cards = data.get('board_cards', '')
-            rfi_opportunity = data.get('rfi_opportunity', 0)
-            facing_steal = data.get('facing_steal', 0)
-            is_steal_defend = data.get('is_steal_defend', 0)
-            is_steal_3bet = data.get('is_steal_3bet', 0)
-            is_steal_fold = data.get('is_steal_fold', 0)
-            steal_success = data.get('steal_success', 0)
-            
-            # BB vs Limp
-            facing_limp = data.get('facing_limp', 0)
-            is_limp_check = data.get('is_limp_check', 0)
-            is_limp_iso = data.get('is_limp_iso', 0)
-            
-            # WTSD
-            wtsd = data.get('wtsd', 0)
-            wsd = data.get('wsd', 0)
-            
-            # C-Bet & 3-Bet (Updated Keys)
-            is_3bet = data.get('is_3bet_pre', 0)
-            is_3bet_opp = data.get('is_3bet_opp_pre', 0)
-            is_cbet = data.get('cbet_flop_succ', 0)
-            cbet_opp = data.get('cbet_flop_opp', 0)
-            is_fold_to_cbet = data.get('fcbet_flop_succ', 0)
-            fold_to_cbet_opp = data.get('fcbet_flop_opp', 0)
-            is_fold_to_3bet = data.get('is_fold_to_3bet', 0)
-            fold_to_3bet_opp = data.get('fold_to_3bet_opp', 0)
-            
-            # Normalize Hand for Chart
-            normalized_hand = normalize_cards(cards)
-
-            conn.execute("""
-                INSERT OR REPLACE INTO my_hand_log (
-                    hand_id, table_part_name, player_name, position, cards,
-                    is_rfi, is_pfr, is_vpip, first_action, first_raiser_position,
-                    is_steal_attempt, net_profit, time_logged,
-                    final_street, final_action, final_hand_strength,
-                    facing_bet_pct_pot, opponent_position, board_cards,
-                    rfi_opportunity,
-                    facing_steal, is_steal_defend, is_steal_3bet, is_steal_fold, steal_success,
-                    facing_limp, is_limp_check, is_limp_iso, normalized_hand,
-                    wtsd, wsd,
-                    is_3bet, is_3bet_opp, is_cbet, cbet_opp, is_fold_to_cbet, fold_to_cbet_opp,
-                is_fold_to_3bet, fold_to_3bet_opp,
-                bb_size, ev_adjusted
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            hand_id, table_part_name, player_name, position, cards,
-            is_rfi, is_pfr, is_vpip, first_action, first_raiser_position,
-            is_steal_attempt, net_profit, time_logged,
-            final_street, final_action, final_hand_strength,
-            facing_bet_pct_pot, opponent_position, board_cards,
-            rfi_opportunity,
-            facing_steal, is_steal_defend, is_steal_3bet, is_steal_fold, steal_success,
-            facing_limp, is_limp_check, is_limp_iso, normalized_hand,
-            wtsd, wsd,
-            is_3bet, is_3bet_opp, is_cbet, cbet_opp, is_fold_to_cbet, fold_to_cbet_opp,
-            is_fold_to_3bet, fold_to_3bet_opp,
-            float(data.get('bb_size', 0.0)), (float(data.get('ev_adjusted')) if data.get('ev_adjusted') is not None and float(data.get('ev_adjusted')) != 0.0 else None)
-        ))
-        conn.commit()
+def update_hand_offsets_in_db(rows: List[Tuple[str, str, int, int]]):
+    """Сохраняет индекс раздач: [(hand_id, file_path, byte_offset, length)]."""
+    if not rows:
+        return
+    try:
+        submit_write(DB_NAME, lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO hand_offsets (hand_id, file_path, byte_offset, length) VALUES (?, ?, ?, ?)",
+            rows
+        ), "индекс раздач")
     except Exception as e:
-        print(f"Ошибка сохранения лога раздачи {hand_id}: {e}", file=sys.stderr)
+        print(f"❌ Ошибка записи индекса раздач: {e}", file=sys.stderr)
+
+def get_all_in_ev_candidates(player_name: str, pending_only: bool = False) -> List[Tuple[str, int, Optional[str], Optional[int], Optional[int], Optional[str]]]:
+    """
+    Раздачи игрока, для которых нужно пересчитать All-In EV:
+    уже помеченные как All-In, ожидающие фонового расчета, и старые записи,
+    где EV был посчитан до появления is_all_in (EV отличается от профита).
+    Ищет в основной базе и во всех месячных архивах журнала.
+    pending_only=True — только раздачи с ev_pending = 1, не досчитанные пулом до выхода
+    (они не архивируются, поэтому ищутся только в основной базе).
+    Возвращает [(hand_id, net_profit в центах, file_path, byte_offset, length, month)];
+    file_path = None, если раздачи нет в индексе hand_offsets; month — месяц архива
+    (None — основная база).
+    """
+    conn = None
+    try:
+        conn = get_connection(DB_NAME, readonly=True)
+        candidates = []
+        groups = [["my_hand_log"]] if pending_only else _hand_log_table_groups(conn, DB_NAME, None, None)
+        condition = "l.ev_pending = 1" if pending_only else """(
+                          l.is_all_in = 1
+                          OR l.ev_pending = 1
+                          OR (l.wtsd = 1 AND l.ev_std_err IS NULL AND l.ev_adjusted IS NOT NULL
+                              AND l.ev_adjusted != l.net_profit)
+                      )"""
+        for tables in groups:
+            for table in tables:
+                schema = table.split(".")[0] if "." in table else None
+                month = schema[len(ARCHIVE_SCHEMA_PREFIX):].replace("_", "-") if schema else None
+                rows = conn.execute(f"""
+                    SELECT l.hand_id, l.net_profit, o.file_path, o.byte_offset, o.length
+                    FROM {table} l
+                    LEFT JOIN main.hand_offsets o ON o.hand_id = l.hand_id
+                    WHERE l.player_name = ? AND {condition}
+                """, (player_name,)).fetchall()
+                candidates.extend((str(r[0]), int(r[1] or 0), r[2], r[3], r[4], month) for r in rows)
+        # Файлы читаются подряд, по возрастанию смещения
+        candidates.sort(key=lambda c: (c[2] is not None, c[2] or "", c[3] or 0))
+        return candidates
+    except Exception as e:
+        print(f"❌ Ошибка выборки раздач для пересчета EV: {e}")
+        return []
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
+
 # --- 4. ФУНКЦИЯ ПОЛУЧЕНИЯ СТАТИСТИКИ ---
 
-def get_stats_for_players(player_names: List[str], table_segment: str) -> Dict[str, Dict[str, Any]]:
-    """Извлекает и рассчитывает VPIP/PFR из динамической таблицы."""
+# Поле окна последних раздач -> колонка счетчиков сегмента с тем же смыслом
+RECENT_WINDOW_COUNTER_COLUMNS = {
+    "hands": "hands",
+    "vpip": "vpip_hands",
+    "pfr": "pfr_hands",
+    "3bet_opp": "_3bet_opportunities",
+    "3bet": "_3bet_successes",
+    "f3bet_opp": "_fold_to_3bet_opportunities",
+    "f3bet": "_fold_to_3bet_successes",
+    "cbet_flop_opp": "cbet_flop_opp",
+    "cbet_flop": "cbet_flop_succ",
+    "fcbet_flop_opp": "fcbet_flop_opp",
+    "fcbet_flop": "fcbet_flop_succ",
+    "wtsd": "wtsd_hands",
+    "wsd": "wsd_hands",
+    "af_bets_raises": "af_bets_raises",
+    "af_calls": "af_calls",
+}
+# Колонка счетчиков -> индекс в суммах окна (как _COUNTER_INDEX для счетчиков)
+_RECENT_WINDOW_INDEX = {
+    RECENT_WINDOW_COUNTER_COLUMNS[field]: i for i, field in enumerate(RECENT_WINDOW_FIELDS)
+    if field in RECENT_WINDOW_COUNTER_COLUMNS
+}
+
+
+def _format_opponent_stats(counters: array, index: Dict[str, int]) -> Dict[str, Any]:
+    """Проценты HUD из счетчиков; index — колонка SEGMENT_COUNTER_COLUMNS -> позиция в counters."""
+    hands = counters[index["hands"]]
+    vpip_hands = counters[index["vpip_hands"]]
+    pfr_hands = counters[index["pfr_hands"]]
+    o3bet = counters[index["_3bet_opportunities"]]
+    s3bet = counters[index["_3bet_successes"]]
+    of3bet = counters[index["_fold_to_3bet_opportunities"]]
+    sf3bet = counters[index["_fold_to_3bet_successes"]]
+    af_bets = counters[index["af_bets_raises"]]
+    af_calls = counters[index["af_calls"]]
+    cbet_op = counters[index["cbet_flop_opp"]]
+    cbet_sc = counters[index["cbet_flop_succ"]]
+    fcbet_op = counters[index["fcbet_flop_opp"]]
+    fcbet_sc = counters[index["fcbet_flop_succ"]]
+    wtsd_h = counters[index["wtsd_hands"]]
+    wsd_h = counters[index["wsd_hands"]]
+
+    vpip = (vpip_hands / hands * 100) if hands > 0 else 0.0
+    pfr = (pfr_hands / hands * 100) if hands > 0 else 0.0
+
+    # РАСЧЕТ НОВЫХ МЕТРИК
+    _3bet_percent = (s3bet / o3bet * 100) if o3bet > 0 else 0.0
+    f3bet_percent = (sf3bet / of3bet * 100) if of3bet > 0 else 0.0
+
+    cbet_percent = (cbet_sc / cbet_op * 100) if cbet_op > 0 else 0.0
+    fcbet_percent = (fcbet_sc / fcbet_op * 100) if fcbet_op > 0 else 0.0
+    wtsd_percent = (wtsd_h / hands * 100) if hands > 0 else 0.0 # WTSD % от всех рук
+    wsd_percent = (wsd_h / wtsd_h * 100) if wtsd_h > 0 else 0.0 # WSD % от рук, дошедших до вскрытия
+
+    # РАСЧЕТ AF (Aggression Factor)
+    # AF = (Bets + Raises) / Calls
+    if af_calls > 0:
+        af_val = af_bets / af_calls
+    elif af_bets > 0:
+        # Если коллов 0, а ставки были, AF математически бесконечен.
+        # Обычно отображают как высокое число или Inf.
+        af_val = 99.9
+    else:
+        af_val = 0.0
+
+    return {
+        'vpip': f"{vpip:.1f}",
+        'pfr': f"{pfr:.1f}",
+        '3bet': f"{_3bet_percent:.1f}",
+        'f3bet': f"{f3bet_percent:.1f}",
+        'cbet': f"{cbet_percent:.1f}",
+        'fcbet': f"{fcbet_percent:.1f}",
+        'wtsd': f"{wtsd_percent:.1f}",
+        'wsd': f"{wsd_percent:.1f}",
+        'af': f"{af_val:.1f}",
+        'hands': hands
+    }
+
+
+def get_stats_for_players(player_names: List[str], table_segment: str, scope: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Рассчитывает VPIP/PFR и остальные показатели из счетчиков в памяти (OpponentStatsStore).
+    В 'recent' — те же показатели за последние DB_RECENT_HANDS раздач (окно в той же памяти).
+    scope (по умолчанию HUD_STATS_SCOPE): "seats" и "all" — сумма по лимитам
+    (get_stats_for_players_across_segments), без 'recent'.
+    """
+    if not player_names:
+        return {}
+    return get_stats_for_tables({table_segment: player_names}, scope)[table_segment]
+
+def get_stats_for_tables(players_by_segment: Dict[str, List[str]], scope: Optional[str] = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    get_stats_for_players для всех открытых столов сразу: сегмент -> игроки.
+    Записи берутся из OpponentStatsCache; промахи всех сегментов читаются одним запросом,
+    при scope "all" сумма по лимитам — один запрос на всех игроков, при "seats" — по одному
+    на число мест. Игрок, сидящий за несколькими столами, считается один раз.
+    """
+    result: Dict[str, Dict[str, Dict[str, Any]]] = {segment: {} for segment in players_by_segment}
+    scope = scope or poker_globals.HUD_STATS_SCOPE
+    # Версия до чтения счетчиков: если игрок сыграл раздачу в процессе, запись не кешируется
+    version = _stats_cache.version()
+
+    by_seat_count: Dict[Optional[int], List[str]] = {}
+    by_segment: Dict[str, List[str]] = {}
+    for table_segment, player_names in players_by_segment.items():
+        if not player_names:
+            continue
+        match = LEGACY_SEGMENT_TABLE_RE.match(table_segment) if scope == "seats" else None
+        if scope == "all":
+            by_seat_count.setdefault(None, []).append(table_segment)
+        elif match:
+            by_seat_count.setdefault(int(match.group(2)), []).append(table_segment)
+        else:
+            by_segment[table_segment] = player_names
+
+    for seat_count, segments in by_seat_count.items():
+        scope_key = "all" if seat_count is None else f"seats:{seat_count}"
+        names = list({name for segment in segments for name in players_by_segment[segment]})
+        records, missing = _stats_cache.get_many(DB_NAME, scope_key, names)
+        if missing:
+            try:
+                counters_by_player = _opponent_stats.get_combined_counters(DB_NAME, missing, seat_count=seat_count)
+            except Exception as e:
+                print(f"❌ Ошибка при получении статистики по всем лимитам: {e}")
+                counters_by_player = None
+            if counters_by_player is not None:
+                loaded = {name: None for name in missing}
+                for name, counters in counters_by_player.items():
+                    if counters[_COUNTER_INDEX["hands"]] > 0:
+                        loaded[name] = _format_opponent_stats(counters, _COUNTER_INDEX)
+                _stats_cache.put_many(DB_NAME, scope_key, loaded, version)
+                records.update(loaded)
+        for segment in segments:
+            # Копии: вызывающий дописывает в записи свое (stack_bb)
+            result[segment] = {name: dict(records[name]) for name in players_by_segment[segment] if records.get(name)}
+
+    records_by_segment: Dict[str, Dict[str, Optional[Dict[str, Any]]]] = {}
+    missing_by_segment: Dict[str, List[str]] = {}
+    for table_segment, player_names in by_segment.items():
+        records, missing = _stats_cache.get_many(DB_NAME, table_segment, player_names)
+        records_by_segment[table_segment] = records
+        if missing:
+            missing_by_segment[table_segment] = missing
+
+    if missing_by_segment:
+        try:
+            counters_by_segment = _opponent_stats.get_counters_for_segments(DB_NAME, missing_by_segment)
+        except Exception as e:
+            print(f"❌ Ошибка при получении статистики из БД ('{', '.join(missing_by_segment)}'): {e}")
+            counters_by_segment = {}
+        for table_segment, counters_by_player in counters_by_segment.items():
+            loaded = {}
+            for name, (counters, window) in counters_by_player.items():
+                if counters[_COUNTER_INDEX["hands"]] <= 0:
+                    loaded[name] = None
+                    continue
+                record = loaded[name] = _format_opponent_stats(counters, _COUNTER_INDEX)
+                record['recent'] = _format_opponent_stats(window, _RECENT_WINDOW_INDEX)
+            _stats_cache.put_many(DB_NAME, table_segment, loaded, version)
+            records_by_segment[table_segment].update(loaded)
+
+    for table_segment, records in records_by_segment.items():
+        result[table_segment] = {name: dict(records[name]) for name in by_segment[table_segment] if records.get(name)}
+
+    return result
+
+def get_stats_for_players_across_segments(player_names: List[str], table_segments: Optional[List[str]] = None,
+                                          seat_count: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Показатели игроков, сложенные по лимитам: по всем (по умолчанию), по списку
+    table_segments или по всем столам на seat_count мест. Один запрос к player_stats.
+    """
     stats: Dict[str, Dict[str, Any]] = {}
     if not player_names:
         return stats
 
-    safe_table_name = table_segment.replace("'", "").replace(";", "").replace(" ", "")
-    placeholders = ','.join('?' for _ in player_names)
-
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        cursor.execute(f"""
-            SELECT player_name, hands, vpip_hands, pfr_hands,
-                   _3bet_opportunities, _3bet_successes,
-                   _fold_to_3bet_opportunities, _fold_to_3bet_successes,
-                   af_bets_raises, af_calls,
-                   cbet_flop_opp, cbet_flop_succ,
-                   fcbet_flop_opp, fcbet_flop_succ,
-                   wtsd_hands, wsd_hands
-            FROM {safe_table_name}
-            WHERE player_name IN ({placeholders})
-        """, player_names)
+        counters_by_player = _opponent_stats.get_combined_counters(DB_NAME, player_names, table_segments, seat_count)
+    except Exception as e:
+        print(f"❌ Ошибка при получении статистики по всем лимитам: {e}")
+        return stats
 
-        results = cursor.fetchall()
+    for name, counters in counters_by_player.items():
+        if counters[_COUNTER_INDEX["hands"]] <= 0:
+            continue
+        stats[name] = _format_opponent_stats(counters, _COUNTER_INDEX)
+    return stats
 
-        for (name, hands, vpip_hands, pfr_hands, o3bet, s3bet, of3bet, sf3bet, af_bets, af_calls,
-             cbet_op, cbet_sc, fcbet_op, fcbet_sc, wtsd_h, wsd_h) in results:
-            vpip = (vpip_hands / hands * 100) if hands > 0 else 0.0
-            pfr = (pfr_hands / hands * 100) if hands > 0 else 0.0
-
-            # РАСЧЕТ НОВЫХ МЕТРИК
-            _3bet_percent = (s3bet / o3bet * 100) if o3bet > 0 else 0.0
-            f3bet_percent = (sf3bet / of3bet * 100) if of3bet > 0 else 0.0
-
-            cbet_percent = (cbet_sc / cbet_op * 100) if cbet_op > 0 else 0.0
-            fcbet_percent = (fcbet_sc / fcbet_op * 100) if fcbet_op > 0 else 0.0
-            wtsd_percent = (wtsd_h / hands * 100) if hands > 0 else 0.0 # WTSD % от всех рук
-            wsd_percent = (wsd_h / wtsd_h * 100) if wtsd_h > 0 else 0.0 # WSD % от рук, дошедших до вскрытия
-
-            # РАСЧЕТ AF (Aggression Factor)
-            # AF = (Bets + Raises) / Calls
-            if af_calls > 0:
-                af_val = af_bets / af_calls
-            elif af_bets > 0:
-                # Если коллов 0, а ставки были, AF математически бесконечен.
-                # Обычно отображают как высокое число или Inf.
-                af_val = 99.9
-            else:
-                af_val = 0.0
-
-            stats[name] = {
-                'vpip': f"{vpip:.1f}",
-                'pfr': f"{pfr:.1f}",
-                '3bet': f"{_3bet_percent:.1f}",
-                'f3bet': f"{f3bet_percent:.1f}",
-                'cbet': f"{cbet_percent:.1f}",
-                'fcbet': f"{fcbet_percent:.1f}",
-                'wtsd': f"{wtsd_percent:.1f}",
-                'wsd': f"{wsd_percent:.1f}",
-                'af': f"{af_val:.1f}",
-                'hands': hands
-            }
 
-    except sqlite3.OperationalError as e:
-        # Игнорируем ошибку, если таблица еще не существует
-        if "no such table" in str(e):
-             return stats
-        raise e
+def get_player_hand_facts_counts(player_names: List[str], table_segment: Optional[str] = None,
+                                 min_time: Optional[datetime.datetime] = None, max_time: Optional[datetime.datetime] = None,
+                                 position: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Счетчики игроков из player_hand_facts за период и/или по позиции:
+    {игрок: {'hands', флаги PLAYER_HAND_FLAGS, 'af_bets_raises', 'af_calls', 'net_profit' (центы)}}.
+    table_segment=None — по всем лимитам. Незаписанные пачки HandBatchWriter не учитываются.
+    """
+    counts: Dict[str, Dict[str, int]] = {}
+    if not player_names:
+        return counts
+
+    where = [f"p.name IN ({', '.join('?' * len(player_names))})"]
+    params: List[Any] = list(player_names)
+    if table_segment:
+        segment_id = get_segment_id(table_segment)
+        if segment_id is None:
+            return counts
+        where.append("f.segment_id = ?")
+        params.append(segment_id)
+    if min_time:
+        where.append("f.time_logged >= ?")
+        params.append(_to_epoch(min_time))
+    if max_time:
+        where.append("f.time_logged <= ?")
+        params.append(_to_epoch(max_time))
+    if position and position.lower() != 'total':
+        where.append("f.position = ?")
+        params.append(_encode_hand_log_value('position', position.lower()))
+
+    fields = ["hands"] + [name for name, _ in PLAYER_HAND_FLAGS] + ["af_bets_raises", "af_calls", "net_profit"]
+    conn = None
+    try:
+        conn = get_connection(DB_NAME, readonly=True)
+        rows = conn.execute(f"""
+            SELECT p.name, COUNT(*),
+                {', '.join(f'SUM(f.flags >> {bit} & 1)' for bit in range(len(PLAYER_HAND_FLAGS)))},
+                SUM(f.af_bets_raises), SUM(f.af_calls), SUM(f.net_profit)
+            FROM players p JOIN player_hand_facts f ON f.player_id = p.player_id
+            WHERE {' AND '.join(where)}
+            GROUP BY p.name
+        """, params).fetchall()
+        for name, *values in rows:
+            counts[name] = dict(zip(fields, values))
     except Exception as e:
-        print(f"❌ Ошибка при получении статистики из БД ('{table_segment}'): {e}")
+        print(f"❌ Ошибка при получении фактов раздач игроков: {e}")
     finally:
         if conn:
-            conn.close()
-
-    return stats
+            release_connection(conn)
+    return counts
 
 # --- 4. ФУНКЦИЯ ПОЛУЧЕНИЯ ЛИЧНОЙ СТАТИСТИКИ ---
 
+def _full_days(min_time: Optional[datetime.datetime], max_time: Optional[datetime.datetime]) -> Tuple[Optional[datetime.date], Optional[datetime.date]]:
+    """
+    Первый и последний день, целиком попадающие в [min_time, max_time] (None — без границы).
+    time_logged хранится с точностью до секунды, поэтому max_time >= 23:59:59 закрывает день.
+    """
+    first_day = last_day = None
+    if min_time:
+        first_day = min_time.date()
+        if min_time != datetime.datetime.combine(first_day, datetime.time()):
+            first_day += datetime.timedelta(days=1)
+    if max_time:
+        last_day = max_time.date()
+        if max_time < datetime.datetime.combine(last_day, datetime.time(23, 59, 59)):
+            last_day -= datetime.timedelta(days=1)
+    return first_day, last_day
+
+
+def _extended_stats_query(player_name: str, segment_id: Optional[int], min_time: Optional[datetime.datetime], max_time: Optional[datetime.datetime],
+                          hand_log_tables: Optional[List[str]] = None) -> Tuple[str, list]:
+    """
+    Запрос для get_player_extended_stats: полные дни периода суммируются из my_daily_stats,
+    неполные крайние дни — из hand_log_tables (my_hand_log и подключенные архивы месяцев
+    крайних дней). Колонки результата в прежнем порядке (position — четвертая).
+    """
+    hand_log_tables = hand_log_tables or ["my_hand_log"]
+    columns = [col for col, _ in MY_DAILY_STATS_COLUMNS]
+    segment_filter = " AND segment_id = ?" if segment_id is not None else ""
+    segment_params = [segment_id] if segment_id is not None else []
+    raw_sums = ", ".join(f"SUM({expr}) AS {col}" for col, expr in zip(columns, _daily_value_exprs()))
+    parts = []
+    params: list = []
+
+    def add_raw(time_from, time_from_op, time_to, time_to_op):
+        for table in hand_log_tables:
+            query = f"SELECT position, {raw_sums} FROM {table} WHERE player_name = ?{segment_filter}"
+            params.extend([player_name, *segment_params])
+            if time_from:
+                query += f" AND time_logged {time_from_op} ?"
+                params.append(_to_epoch(time_from))
+            if time_to:
+                query += f" AND time_logged {time_to_op} ?"
+                params.append(_to_epoch(time_to))
+            parts.append(query + " GROUP BY position")
+
+    first_day, last_day = _full_days(min_time, max_time)
+    if first_day and last_day and first_day > last_day:
+        # Период короче суток: только my_hand_log
+        add_raw(min_time, ">=", max_time, "<=")
+    else:
+        query = f"SELECT position, {', '.join(columns)} FROM my_daily_stats WHERE player_name = ?{segment_filter}"
+        params.extend([player_name, *segment_params])
+        if min_time or max_time:
+            # Раздачи без времени не попадают ни в один период (как time_logged >= ? в SQL)
+            query += " AND day != ''"
+        if first_day:
+            query += " AND day >= ?"
+            params.append(first_day.isoformat())
+        if last_day:
+            query += " AND day <= ?"
+            params.append(last_day.isoformat())
+        parts.append(query)
+        if min_time and first_day != min_time.date():
+            add_raw(min_time, ">=", datetime.datetime.combine(first_day, datetime.time()), "<")
+        if max_time and last_day != max_time.date():
+            add_raw(datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time()), ">=", max_time, "<=")
+
+    outer = [f"SUM({col})" for col in columns]
+    outer.insert(3, "position")
+    query = f"SELECT {', '.join(outer)} FROM ({' UNION ALL '.join(parts)}) GROUP BY position HAVING SUM(total_hands) > 0"
+    return query, params
+
+
 def get_player_extended_stats(player_name: str, table_segment: str, min_time: Optional[datetime.datetime] = None, max_time: Optional[datetime.datetime] = None) -> Optional[Dict[str, Dict[str, Any]]]:
     """
-    Извлекает расширенную статистику для игрока из my_hand_log с фильтрацией по времени.
-    Агрегирует данные на лету.
+    Извлекает расширенную статистику для игрока с фильтрацией по времени
+    (и по сегменту, если table_segment не пуст). Полные дни берутся из дневных
+    агрегатов my_daily_stats, поэтому стоимость не зависит от числа раздач.
     """
     stats: Dict[str, Dict[str, Any]] = {}
 
+    conn = None
     try:
-        conn = sqlite3.connect(DB_NAME)
+        segment_id = get_segment_id(table_segment) if table_segment else None
+        conn = get_connection(DB_NAME, readonly=True)
         cursor = conn.cursor()
 
-        # Получение агрегированной статистики по сессии ("My Stats")
-        # Добавляем фильтр по времени
-        
-        query = """
-            SELECT 
-                COUNT(*) as total_hands,
-                SUM(is_pfr) as pfr_sum,
-                SUM(is_vpip) as vpip_sum,
-                position,
-                SUM(is_rfi) as rfi_sum,
-                SUM(rfi_opportunity) as rfi_opp_sum,
-                
-                -- New Steal Stats
-                SUM(facing_steal) as facing_steal_sum,
-                SUM(is_steal_fold) as steal_fold_sum,
-                SUM(is_steal_defend) as steal_call_sum,
-                SUM(is_steal_3bet) as steal_3bet_sum,
-                SUM(is_steal_attempt) as steal_att_sum,
-                SUM(steal_success) as steal_succ_sum,
-                
-                -- New BB vs Limp Stats
-                SUM(facing_limp) as facing_limp_sum,
-                SUM(is_limp_check) as limp_check_sum,
-                SUM(is_limp_iso) as limp_iso_sum,
-                
-                -- WTSD & Saw Flop
-                SUM(wtsd) as wtsd_sum,
-                SUM(wsd) as wsd_sum,
-                SUM(CASE WHEN final_street != 'preflop' OR wtsd = 1 THEN 1 ELSE 0 END) as saw_flop_sum,
-                
-                -- C-Bet & 3-Bet
-                SUM(is_3bet) as p3bet_sum,
-                SUM(is_3bet_opp) as p3bet_opp_sum,
-                SUM(is_cbet) as cbet_sum,
-                SUM(cbet_opp) as cbet_opp_sum,
-                SUM(is_fold_to_cbet) as fcbet_sum,
-                SUM(fold_to_cbet_opp) as fcbet_opp_sum,
-                
-                SUM(is_fold_to_3bet) as f3bet_sum,
-                SUM(fold_to_3bet_opp) as f3bet_opp_sum,
-                SUM(net_profit) as net_won_sum,
-                SUM(CASE WHEN wtsd > 0 THEN net_profit ELSE 0 END) as wsd_profit_sum,
-                SUM(CASE WHEN wtsd = 0 OR wtsd IS NULL THEN net_profit ELSE 0 END) as wnsd_profit_sum,
-                SUM(COALESCE(ev_adjusted, net_profit)) as ev_sum,
-                SUM(CASE WHEN bb_size > 0 THEN net_profit / bb_size ELSE 0 END) as bb_won_sum,
-                SUM(CASE WHEN wtsd > 0 AND bb_size > 0 THEN net_profit / bb_size ELSE 0 END) as wsd_bb_sum,
-                SUM(CASE WHEN (wtsd = 0 OR wtsd IS NULL) AND bb_size > 0 THEN net_profit / bb_size ELSE 0 END) as wnsd_bb_sum,
-                SUM(CASE WHEN bb_size > 0 THEN COALESCE(ev_adjusted, net_profit) / bb_size ELSE 0 END) as ev_bb_sum
-            
-            FROM my_hand_log 
-            WHERE player_name = ?
-        """
-        params = [player_name]
-        
-        if min_time:
-            query += " AND time_logged >= ?"
-            params.append(min_time)
-            
-        if max_time:
-            query += " AND time_logged <= ?"
-            params.append(max_time)
-                
-        query += " GROUP BY position"
-
+        # Сырые строки нужны только для крайних дней: подключаем архивы их месяцев
+        edge_archives = sorted({archive for edge in (min_time, max_time) if edge
+                                for archive in _archive_months(conn, edge, edge)})
+        hand_log_tables = ["my_hand_log"] + _attach_archives(conn, DB_NAME, edge_archives)
+        query, params = _extended_stats_query(player_name, segment_id, min_time, max_time, hand_log_tables)
         cursor.execute(query, params)
         results = cursor.fetchall()
         
@@ -1958,7 +2256,7 @@ def get_player_extended_stats(player_name: str, table_segment: str, min_time: Op
             cnt_hands = row[0]
             cnt_pfr = row[1]
             cnt_vpip = row[2]
-            pos = row[3].lower()
+            pos = _decode_hand_log_value('position', row[3]) or ''
             cnt_rfi = row[4]
             cnt_rfi_opp = row[5]
             
@@ -1985,10 +2283,11 @@ def get_player_extended_stats(player_name: str, table_segment: str, min_time: Op
             cnt_fcbet_opp = row[23]
             cnt_f3bet = row[24] # New Index
             cnt_f3bet_opp = row[25]
-            net_won_val = float(row[26]) if row[26] else 0.0
-            wsd_profit_val = float(row[27]) if row[27] else 0.0
-            wnsd_profit_val = float(row[28]) if row[28] else 0.0
-            ev_val = float(row[29]) if row[29] else 0.0
+            # Суммы в БД — центы, в статистике — доллары
+            net_won_val = row[26] / 100 if row[26] else 0.0
+            wsd_profit_val = row[27] / 100 if row[27] else 0.0
+            wnsd_profit_val = row[28] / 100 if row[28] else 0.0
+            ev_val = row[29] / 100 if row[29] else 0.0
             bb_won_val = float(row[30]) if row[30] else 0.0
             wsd_bb_val = float(row[31]) if row[31] else 0.0
             wnsd_bb_val = float(row[32]) if row[32] else 0.0
@@ -2142,7 +2441,7 @@ def get_player_extended_stats(player_name: str, table_segment: str, min_time: Op
         return None
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
     return stats
 
@@ -2154,7 +2453,7 @@ def get_chart_hands_data(player_name: str, stat_type: str, position: str, min_ti
     """
     data = {}
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection(DB_NAME, readonly=True)
         cursor = conn.cursor()
         
         col_map = {
@@ -2167,31 +2466,36 @@ def get_chart_hands_data(player_name: str, stat_type: str, position: str, min_ti
              # Fallback or error?
              return {}
              
-        query = f"SELECT normalized_hand, COUNT(*) FROM my_hand_log WHERE player_name = ? AND {target_col} = 1"
+        where = f"player_name = ? AND {target_col} = 1"
         params = [player_name]
         
         if position and position.lower() != 'total':
-            query += " AND position = ?"
-            params.append(position.lower())
+            where += " AND position = ?"
+            params.append(_encode_hand_log_value('position', position.lower()))
             
         if min_time:
-            query += " AND time_logged >= ?"
-            params.append(min_time)
+            where += " AND time_logged >= ?"
+            params.append(_to_epoch(min_time))
         if max_time:
-            query += " AND time_logged <= ?"
-            params.append(max_time)
+            where += " AND time_logged <= ?"
+            params.append(_to_epoch(max_time))
             
-        query += " GROUP BY normalized_hand"
-        
-        cursor.execute(query, params)
-        for hand, count in cursor.fetchall():
-            if hand:
-                data[hand] = count
+        # Основная таблица и архивы месяцев периода (группами подключенных архивов)
+        for tables in _hand_log_table_groups(conn, DB_NAME, min_time, max_time):
+            query = " UNION ALL ".join(
+                f"SELECT normalized_hand, COUNT(*) FROM {table} WHERE {where} GROUP BY normalized_hand"
+                for table in tables
+            )
+            cursor.execute(query, params * len(tables))
+            for code, count in cursor.fetchall():
+                hand = _decode_hand_log_value('normalized_hand', code)
+                if hand:
+                    data[hand] = data.get(hand, 0) + count
                 
     except Exception as e:
         print(f"Chart Query Error: {e}")
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
         
     return data
 
@@ -2205,25 +2509,40 @@ def get_player_hand_log_df(player_name: str, min_time: Optional[datetime.datetim
     import re
     
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection(DB_NAME, readonly=True)
         
         # Строим запрос
-        query = "SELECT * FROM my_hand_log WHERE player_name = ?"
+        where = "player_name = ?"
         params = [player_name]
         
         if min_time:
-            query += " AND time_logged >= ?"
-            params.append(min_time)
+            where += " AND time_logged >= ?"
+            params.append(_to_epoch(min_time))
         if max_time:
-            query += " AND time_logged <= ?"
-            params.append(max_time)
+            where += " AND time_logged <= ?"
+            params.append(_to_epoch(max_time))
             
-        query += " ORDER BY time_logged ASC"
-        
-        # Используем pandas read_sql
-        df = pd.read_sql_query(query, conn, params=params, parse_dates=['time_logged'])
+        # Основная таблица и архивы месяцев периода; колонки явно — их порядок
+        # в старой основной базе может отличаться от архивов
+        columns = ", ".join(_hand_log_columns(conn))
+        frames = []
+        for tables in _hand_log_table_groups(conn, DB_NAME, min_time, max_time):
+            query = " UNION ALL ".join(f"SELECT {columns} FROM {table} WHERE {where}" for table in tables)
+            query += " ORDER BY time_logged ASC"
+            
+            # Используем pandas read_sql
+            frames.append(pd.read_sql_query(query, conn, params=params * len(tables), parse_dates={'time_logged': 's'}))
+        # Пустые части не склеиваем: у них колонки object, и concat испортил бы типы
+        frames = [frame for frame in frames if not frame.empty] or frames[-1:]
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True).sort_values('time_logged', kind='stable', ignore_index=True)
         
-        # Пост-обработка
+        # Пост-обработка: суммы в БД — центы, графику нужны доллары; коды — обратно в строки
+        for col in HAND_LOG_MONEY_COLUMNS + ['ev_std_err']:
+            if col in df.columns:
+                df[col] = df[col] / 100
+        for col, dimension in HAND_LOG_CODED_COLUMNS.items():
+            if col in df.columns:
+                df[col] = df[col].map(dict(enumerate(HAND_LOG_DIMENSIONS[dimension])))
         if 'net_profit' in df.columns:
             df['net_won'] = df['net_profit'] # Alias for graph
             
@@ -2276,4 +2595,4 @@ def get_player_hand_log_df(player_name: str, min_time: Optional[datetime.datetim
         # traceback.print_exc()
         return pd.DataFrame() # Empty DF on error
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
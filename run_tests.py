@@ -1,34 +1,186 @@
 import os
+import random
+from array import array
 import shutil
 import sqlite3
+import datetime
 import pandas as pd
 from typing import List
 
 # Patch environment to use Test DB
 import poker_globals
 TEST_DB = 'test_poker_stats.db'
+# Та же история, загруженная быстрым путем (begin_bulk_load / finish_bulk_load)
+TEST_BULK_DB = 'test_poker_stats_bulk.db'
 poker_globals.DB_NAME = TEST_DB
 
 # Import after patching
 import poker_stats_db
+import db_schema
+import stats_store
+import db_bulk_load
+from db_connection import get_connection
 from poker_monitor import process_file_full_load
 
 TEST_HISTORY_DIR = 'test_history'
 
+def _unloaded_stats_for_tables(players_by_segment):
+    """get_stats_for_tables с пустой памятью (после записи счетчики игроков уже загружены)."""
+    poker_stats_db.flush_opponent_stats()
+    stats_store._opponent_stats.clear(TEST_DB)
+    stats_store._stats_cache.clear(TEST_DB)
+    return poker_stats_db.get_stats_for_tables(players_by_segment, "segment")
+
+def check_query_plans(cur):
+    """EXPLAIN QUERY PLAN для запросов Hero к my_hand_log: каждый должен идти по своему индексу."""
+    print("\n--- QUERY PLANS ---")
+    hero = poker_globals.MY_PLAYER_NAME
+    since = datetime.datetime.now() - datetime.timedelta(days=30)
+    segments = [row[0] for row in cur.execute("SELECT name FROM segments")]
+    checks = [
+        ("extended_stats", lambda: poker_stats_db.get_player_extended_stats(hero, "", min_time=since), "idx_hand_log_player_time", "my_hand_log"),
+        ("chart_vpip_co", lambda: poker_stats_db.get_chart_hands_data(hero, "vpip", "co", min_time=since), "idx_hand_log_chart_is_vpip", "my_hand_log"),
+        ("chart_rfi_total", lambda: poker_stats_db.get_chart_hands_data(hero, "rfi", "total"), "idx_hand_log_chart_is_rfi", "my_hand_log"),
+        ("hand_log_df", lambda: poker_stats_db.get_player_hand_log_df(hero, min_time=since), "idx_hand_log_player_time", "my_hand_log"),
+        ("stats_all_segments", lambda: poker_stats_db.get_stats_for_players_across_segments([hero]), "idx_player_stats_player", "player_stats"),
+        ("stats_all_tables", lambda: _unloaded_stats_for_tables({segment: [hero] for segment in segments}), "PRIMARY KEY", "player_stats"),
+    ]
+
+    # SQL с подставленными параметрами берем из trace callback соединения модуля
+    db_conn = get_connection(TEST_DB, readonly=True)
+    for name, run_query, expected_index, table in checks:
+        statements = []
+        db_conn.set_trace_callback(statements.append)
+        try:
+            run_query()
+        finally:
+            db_conn.set_trace_callback(None)
+        selects = [s for s in statements if s.lstrip().upper().startswith("SELECT") and table in s]
+        if not selects:
+            print(f"FAILURE: {name}: query not captured")
+            continue
+        cur.execute("EXPLAIN QUERY PLAN " + selects[-1])
+        plan = " | ".join(row[3] for row in cur.fetchall())
+        if expected_index in plan:
+            print(f"PASS: {name} uses {expected_index}")
+        else:
+            print(f"FAILURE: {name} does not use {expected_index}: {plan}")
+
+def _recent_window_sums(words: List[int]) -> List[int]:
+    """Суммы окна (порядок RECENT_WINDOW_FIELDS) прямым подсчетом по словам раздач."""
+    flag_count = len(db_schema.PLAYER_HAND_FLAGS)
+    return ([len(words)]
+            + [sum(1 for word in words if word >> bit & 1) for bit in range(flag_count)]
+            + [sum(word >> 16 & 0xFF for word in words), sum(word >> 24 for word in words)])
+
+def check_recent_hands(cur):
+    """Окна последних раздач: RecentHands против прямого подсчета, player_recent_hands против фактов."""
+    print("\n--- RECENT HANDS ---")
+    rng = random.Random(47)
+    flag_mask = (1 << len(db_schema.PLAYER_HAND_FLAGS)) - 1
+    size = 7
+    ring = stats_store.RecentHands(size)
+    history: List[int] = []
+    bad = 0
+    for _ in range(500):
+        word = rng.getrandbits(32) & (flag_mask | 0xFFFF0000)
+        ring.add(word)
+        history.append(word)
+        bad += list(ring.sums) != _recent_window_sums(history[-size:])
+    bad += list(stats_store.RecentHands(size, history).sums) != _recent_window_sums(history[-size:])
+    if bad:
+        print(f"FAILURE: RecentHands sums differ from brute force in {bad} steps")
+    else:
+        print("PASS: RecentHands sums match brute force")
+
+    # Окно в базе — последние DB_RECENT_HANDS фактов игрока (файлы грузятся по порядку раздач)
+    expected: dict = {}
+    for segment_id, player_id, word in cur.execute(f"""
+        SELECT segment_id, player_id, {db_schema.RECENT_HAND_WORD_SQL} FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY segment_id, player_id ORDER BY hand_id DESC) AS n
+            FROM player_hand_facts
+        )
+        WHERE n <= ?
+        ORDER BY segment_id, player_id, hand_id
+    """, (poker_globals.DB_RECENT_HANDS,)).fetchall():
+        expected.setdefault((segment_id, player_id), []).append(word)
+    stored = {}
+    for segment_id, player_id, blob in cur.execute("SELECT segment_id, player_id, words FROM player_recent_hands").fetchall():
+        words = array('I')
+        words.frombytes(blob)
+        stored[(segment_id, player_id)] = list(words)
+    diverged = {key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key)}
+
+    # Суммы окна в памяти (OpponentStatsStore) — прямым подсчетом по тем же фактам
+    players = cur.execute("""
+        SELECT g.name, p.name, s.segment_id, s.player_id FROM player_stats s
+        JOIN players p ON p.player_id = s.player_id JOIN segments g ON g.segment_id = s.segment_id
+    """).fetchall()
+    by_segment: dict = {}
+    for segment, name, segment_id, player_id in players:
+        by_segment.setdefault(segment, []).append((name, (segment_id, player_id)))
+    for segment, entries in by_segment.items():
+        counters = stats_store._opponent_stats.get_counters(TEST_DB, [name for name, _ in entries], segment)
+        for name, key in entries:
+            if list(counters[name][1]) != _recent_window_sums(expected.get(key, [])):
+                diverged.add(key)
+    if diverged:
+        print(f"FAILURE: recent-hand windows differ for {len(diverged)} (segment, player) pairs")
+    else:
+        print(f"PASS: recent-hand windows match the last {poker_globals.DB_RECENT_HANDS} facts ({len(players)} players)")
+
+def _table_contents(conn):
+    """Схема и строки всех таблиц базы (строки отсортированы по всем колонкам)."""
+    contents = {"schema": conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name").fetchall()}
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall():
+        columns = ", ".join(row[1] for row in conn.execute(f"PRAGMA table_info({name})"))
+        contents[name] = conn.execute(f"SELECT * FROM {name} ORDER BY {columns}").fetchall()
+    return contents
+
+def check_bulk_load(files: List[str]):
+    """Быстрая загрузка тех же файлов в TEST_BULK_DB: все таблицы должны совпасть с обычной загрузкой."""
+    print("\n--- BULK LOAD ---")
+    poker_stats_db.DB_NAME = TEST_BULK_DB
+    try:
+        poker_stats_db.remove_database_files()
+        poker_stats_db.setup_database()
+        if not db_bulk_load.begin_bulk_load(TEST_BULK_DB):
+            print("FAILURE: bulk load was not enabled")
+            return
+        for f in files:
+            process_file_full_load(f)
+        db_bulk_load.finish_bulk_load(TEST_BULK_DB)
+    finally:
+        poker_stats_db.DB_NAME = TEST_DB
+
+    expected_conn, bulk_conn = sqlite3.connect(TEST_DB), sqlite3.connect(TEST_BULK_DB)
+    expected, bulk = _table_contents(expected_conn), _table_contents(bulk_conn)
+    expected_conn.close()
+    bulk_conn.close()
+    diverged = [name for name in sorted(set(expected) | set(bulk)) if expected.get(name) != bulk.get(name)]
+    if diverged:
+        print(f"FAILURE: bulk load differs from incremental load in: {', '.join(diverged)}")
+    else:
+        print(f"PASS: bulk load matches incremental load ({len(expected) - 1} tables)")
+
 def run_full_test():
     print(f"=== RUNNING TEST SUITE on {TEST_DB} ===")
     
     # 1. CLEANUP
-    if os.path.exists(TEST_DB):
-        os.remove(TEST_DB)
-        print("Removed old test DB.")
+    for db_path in (TEST_DB, TEST_BULK_DB):
+        for path in (db_path, db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"Removed old {path}.")
         
     # 2. INITIALIZE
     print("Initializing DB...")
     poker_stats_db.setup_database()
     
     # 3. LOAD HISTORY
-    files = [os.path.join(TEST_HISTORY_DIR, f) for f in os.listdir(TEST_HISTORY_DIR) if f.endswith('.txt')]
+    # По порядку имен (дата в начале имени): раздачи идут в журнал в порядке hand_id
+    files = sorted(os.path.join(TEST_HISTORY_DIR, f) for f in os.listdir(TEST_HISTORY_DIR) if f.endswith('.txt'))
     print(f"Loading {len(files)} hand history files from {TEST_HISTORY_DIR}...")
     
     for f in files:
@@ -72,13 +224,17 @@ def run_full_test():
          print("WARNING: Found 0.0 EV values! (Should be converted to NULL)")
 
     # Check Divergence
-    cur.execute("SELECT hand_id, net_profit, ev_adjusted FROM my_hand_log WHERE ev_adjusted IS NOT NULL AND ABS(ev_adjusted - net_profit) > 0.01")
+    cur.execute("SELECT hand_id, net_profit, ev_adjusted FROM my_hand_log WHERE ev_adjusted IS NOT NULL AND ABS(ev_adjusted - net_profit) > 1")
     rows = cur.fetchall()
     print(f"Found {len(rows)} hands with EV divergence (Luck Factor).")
     for r in rows[:5]:
         print(f"  Hand {r[0]}: Net {r[1]}, EV {r[2]}")
-        
+
+    check_query_plans(cur)
+    check_recent_hands(cur)
+
     conn.close()
+    check_bulk_load(files)
     print("=== TEST COMPLETE ===")
 
 if __name__ == "__main__":
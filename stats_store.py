@@ -0,0 +1,610 @@
+# stats_store.py
+
+import datetime
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+from poker_globals import DB_STATS_FLUSH_MS, DB_STATS_STORE_MAX_PLAYERS, DB_RECENT_HANDS
+from poker_globals import DB_STATS_CACHE_MAX_PLAYERS, DB_STATS_CACHE_TTL_S
+from db_connection import get_connection, release_connection
+from db_writer import submit_write, wait_for_writes
+from db_schema import (
+    LEGACY_SEGMENT_TABLE_RE, PLAYER_STATS_UPSERT_SQL, RECENT_HAND_FLAG_BITS, RECENT_WINDOW_FIELDS,
+    SEGMENT_COUNTER_COLUMNS, _HAND_LOG_TZ, _SEGMENT_IDS, _player_hand_flags, _segment_delta, _to_epoch
+)
+
+# --- АГРЕГАТЫ ОППОНЕНТОВ В ПАМЯТИ ---
+# HUD читает статистику оппонентов сразу после того, как тот же поток ее записал.
+# Поэтому счетчики игроков за столом живут в памяти (массив на (база, сегмент, игрок)),
+# обновляются прямо из analyze_hand_for_stats, а в SQLite попадают отложенно:
+# накопленные дельты пишутся одной транзакцией раз в DB_STATS_FLUSH_MS
+# (flush_opponent_stats вызывают монитор, полная загрузка и выход из приложения).
+# Ключи и методы принимают файл базы (db_name): poker_stats_db передает DB_NAME.
+
+def _recent_hand_word(data: Dict[str, Any]) -> int:
+    """Слово раздачи для окна последних раздач (см. RECENT_HAND_WORD_SQL)."""
+    return (_player_hand_flags(data)
+            | min(data.get('af_bets_raises', 0), 255) << 16
+            | min(data.get('af_calls', 0), 255) << 24)
+
+
+class RecentHands:
+    """
+    Кольцевой буфер слов последних size раздач и суммы по окну (порядок RECENT_WINDOW_FIELDS).
+    Новая раздача вытесняет самую старую: суммы обновляются за O(1), без пересчета окна.
+    """
+    __slots__ = ("words", "head", "count", "sums")
+
+    def __init__(self, size: int, words: Optional[array] = None):
+        self.words = array('I', [0]) * size
+        self.head = 0   # куда пишется следующее слово
+        self.count = 0
+        self.sums = array('q', [0]) * len(RECENT_WINDOW_FIELDS)
+        for word in (words[-size:] if words else ()):
+            self.add(word)
+
+    def _apply(self, word: int, sign: int):
+        sums = self.sums
+        sums[0] += sign
+        flags = word & ((1 << RECENT_HAND_FLAG_BITS) - 1)
+        while flags:
+            low = flags & -flags
+            sums[low.bit_length()] += sign  # бит i -> sums[1 + i]
+            flags ^= low
+        sums[-2] += sign * ((word >> 16) & 0xFF)
+        sums[-1] += sign * (word >> 24)
+
+    def add(self, word: int):
+        if self.count == len(self.words):
+            self._apply(self.words[self.head], -1)
+        else:
+            self.count += 1
+        self.words[self.head] = word
+        self._apply(word, 1)
+        self.head = (self.head + 1) % len(self.words)
+
+
+def _merge_recent_hands(conn: sqlite3.Connection, rows: List[Tuple[int, str, array]]):
+    """Дописывает слова (segment_id, имя игрока, слова) в окна player_recent_hands."""
+    for segment_id, player_name, words in rows:
+        row = conn.execute("""
+            SELECT r.words FROM player_recent_hands r JOIN players p ON p.player_id = r.player_id
+            WHERE r.segment_id = ? AND p.name = ?
+        """, (segment_id, player_name)).fetchone()
+        merged = array('I')
+        if row:
+            merged.frombytes(row[0])
+        merged.extend(words)
+        del merged[:-DB_RECENT_HANDS]
+        conn.execute("""
+            INSERT OR REPLACE INTO player_recent_hands (segment_id, player_id, words)
+            VALUES (?, (SELECT player_id FROM players WHERE name = ?), ?)
+        """, (segment_id, player_name, merged.tobytes()))
+
+
+class OpponentStatsCache:
+    """
+    LRU-кеш готовых записей HUD (_format_opponent_stats): (база, область, игрок) -> запись
+    или None (раздач нет). Область — сегмент, "all" или "seats:<N>" (HUD_STATS_SCOPE).
+    Запись игрока сбрасывает OpponentStatsStore.add_hand (игрок сыграл раздачу); кроме того,
+    записи живут не дольше DB_STATS_CACHE_TTL_S, а сверх max_size вытесняются самые старые.
+    """
+
+    def __init__(self, max_size: int = DB_STATS_CACHE_MAX_PLAYERS, ttl_s: float = DB_STATS_CACHE_TTL_S):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        # Растет при каждом сбросе: запись, посчитанная до сброса, в кеш не кладется
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def get_many(self, db_name: str, scope_key: str, player_names: List[str]) -> Tuple[Dict[str, Optional[Dict[str, Any]]], List[str]]:
+        """Найденные записи (имя -> запись или None) и имена, которых в кеше нет."""
+        now = time.monotonic()
+        found: Dict[str, Optional[Dict[str, Any]]] = {}
+        missing = []
+        with self._lock:
+            for name in player_names:
+                key = (db_name, scope_key, name)
+                entry = self._entries.get(key)
+                if entry is None or entry[0] <= now:
+                    if entry is not None:
+                        del self._entries[key]
+                    missing.append(name)
+                    continue
+                self._entries.move_to_end(key)
+                found[name] = entry[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, db_name: str, scope_key: str, records: Dict[str, Optional[Dict[str, Any]]], version: int):
+        """Кладет записи, посчитанные после version() == version."""
+        expires = time.monotonic() + self.ttl_s
+        with self._lock:
+            if version != self._version:
+                return
+            for name, record in records.items():
+                key = (db_name, scope_key, name)
+                self._entries[key] = (expires, record)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, db_name: str, table_segment: str, player_names: List[str]):
+        """Игроки сыграли раздачу в сегменте: сбрасываем их записи сегмента и сумм по лимитам."""
+        scope_keys = [table_segment, "all"]
+        match = LEGACY_SEGMENT_TABLE_RE.match(table_segment)
+        if match:
+            scope_keys.append(f"seats:{int(match.group(2))}")
+        with self._lock:
+            self._version += 1
+            for name in player_names:
+                for scope_key in scope_keys:
+                    self._entries.pop((db_name, scope_key, name), None)
+
+    def clear(self, db_name: str):
+        with self._lock:
+            self._version += 1
+            for key in [key for key in self._entries if key[0] == db_name]:
+                del self._entries[key]
+
+    def get_info(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_stats_cache = OpponentStatsCache()
+
+
+def get_stats_cache_info() -> Dict[str, int]:
+    """Размер кеша записей HUD оппонентов и число попаданий и промахов."""
+    return _stats_cache.get_info()
+
+
+class OpponentStatsStore:
+    """
+    Счетчики = значение в БД + еще не записанные дельты.
+    _counters — только загруженные (сидящие за столами) игроки, _pending — дельты для записи.
+    Так же устроено окно последних раздач: _recent (загруженные) = окно в БД + _recent_pending.
+    Запись (flush) не держит блокировку, пока ждет поток записи: дельты уходят в _in_flight,
+    а их счетчики перед этим загружаются в память. До коммита БД может уже содержать
+    дельты или еще нет, поэтому такие ключи читаются только из памяти, не из БД.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()  # одна запись за раз
+        self._in_flight: Dict[Tuple[str, str, str], array] = {}  # дельты, ожидающие коммита
+        self._counters: Dict[Tuple[str, str, str], array] = {}  # (база, сегмент, игрок) -> счетчики
+        self._pending: Dict[Tuple[str, str, str], array] = {}   # (база, сегмент, игрок) -> дельты
+        self._recent: Dict[Tuple[str, str, str], RecentHands] = {}
+        self._recent_pending: Dict[Tuple[str, str, str], array] = {}  # слова раздач после записи
+        self._last_flush = time.perf_counter()
+
+    def add_hand(self, db_name: str, table_segment: str, stats_to_commit: Dict[str, Dict[str, Any]]):
+        """
+        Добавляет дельты одной раздачи (результат analyze_hand_for_stats). Сегмент должен
+        быть уже заведен в базе (get_segment_id), иначе раздача не учитывается.
+        """
+        if not stats_to_commit:
+            return
+        if (db_name, table_segment) not in _SEGMENT_IDS:
+            return
+        with self._lock:
+            for player_name, data in stats_to_commit.items():
+                key = (db_name, table_segment, player_name)
+                delta = [1, *_segment_delta(data)]
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = array('q', delta)
+                else:
+                    for i, value in enumerate(delta):
+                        pending[i] += value
+                counters = self._counters.get(key)
+                if counters is not None:
+                    for i, value in enumerate(delta):
+                        counters[i] += value
+
+                word = _recent_hand_word(data)
+                words = self._recent_pending.get(key)
+                if words is None:
+                    self._recent_pending[key] = array('I', [word])
+                else:
+                    words.append(word)
+                    # Для окна важны только последние DB_RECENT_HANDS (быстрая загрузка копит долго)
+                    if len(words) >= 2 * DB_RECENT_HANDS:
+                        del words[:-DB_RECENT_HANDS]
+                recent = self._recent.get(key)
+                if recent is not None:
+                    recent.add(word)
+            # Счетчики уже новые: записи HUD, посчитанные по старым, больше не годятся
+            _stats_cache.invalidate(db_name, table_segment, list(stats_to_commit))
+
+    def get_counters(self, db_name: str, player_names: List[str], table_segment: str) -> Dict[str, Tuple[array, array]]:
+        """
+        Счетчики игроков сегмента за все время и суммы окна последних раздач
+        (RECENT_WINDOW_FIELDS); незагруженные читаются из БД одним запросом.
+        """
+        return self.get_counters_for_segments(db_name, {table_segment: player_names})[table_segment]
+
+    def get_counters_for_segments(self, db_name: str, players_by_segment: Dict[str, List[str]]) -> Dict[str, Dict[str, Tuple[array, array]]]:
+        """get_counters для нескольких сегментов: незагруженные игроки всех сегментов — одним запросом."""
+        with self._lock:
+            missing = {}
+            for table_segment, player_names in players_by_segment.items():
+                names = [name for name in player_names if (db_name, table_segment, name) not in self._counters]
+                if names:
+                    missing[table_segment] = names
+            if missing:
+                self._load(db_name, missing)
+            result = {}
+            for table_segment, player_names in players_by_segment.items():
+                segment_result = result[table_segment] = {}
+                for name in player_names:
+                    key = (db_name, table_segment, name)
+                    segment_result[name] = (self._counters[key], self._recent[key].sums)
+            return result
+
+    def get_combined_counters(self, db_name: str, player_names: List[str], table_segments: Optional[List[str]] = None,
+                              seat_count: Optional[int] = None) -> Dict[str, array]:
+        """
+        Счетчики игроков, сложенные по сегментам: всем, списку table_segments или всем
+        с seat_count мест. Один запрос по индексу player_id; загруженные ключи берутся
+        из памяти (в ней уже и незаписанные дельты), остальные — БД плюс дельты.
+        """
+        where = [f"p.name IN ({', '.join('?' * len(player_names))})"]
+        params: List[Any] = list(player_names)
+        if table_segments is not None:
+            where.append(f"g.name IN ({', '.join('?' * len(table_segments))})")
+            params.extend(table_segments)
+        if seat_count is not None:
+            where.append("g.seat_count = ?")
+            params.append(seat_count)
+
+        def matches(table_segment: str) -> bool:
+            if table_segments is not None and table_segment not in table_segments:
+                return False
+            if seat_count is not None:
+                match = LEGACY_SEGMENT_TABLE_RE.match(table_segment)
+                return bool(match) and int(match.group(2)) == seat_count
+            return True
+
+        result: Dict[str, array] = {}
+
+        def add(name: str, values):
+            counters = result.setdefault(name, array('q', [0]) * len(SEGMENT_COUNTER_COLUMNS))
+            for i, value in enumerate(values):
+                counters[i] += int(value or 0)
+
+        with self._lock:
+            conn = None
+            try:
+                conn = get_connection(db_name, readonly=True)
+                rows = conn.execute(f"""
+                    SELECT p.name, g.name, {', '.join(f's.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+                    FROM players p
+                    JOIN player_stats s ON s.player_id = p.player_id
+                    JOIN segments g ON g.segment_id = s.segment_id
+                    WHERE {' AND '.join(where)}
+                """, params).fetchall()
+            finally:
+                if conn:
+                    release_connection(conn)
+
+            seen = set()
+            for name, table_segment, *values in rows:
+                key = (db_name, table_segment, name)
+                seen.add(key)
+                loaded = self._counters.get(key)
+                if loaded is not None:
+                    add(name, loaded)
+                    continue
+                add(name, values)
+                pending = self._pending.get(key)
+                if pending is not None:
+                    add(name, pending)
+
+            # Ключи, которых в БД еще нет
+            names = set(player_names)
+            for store in (self._counters, self._pending):
+                for key, values in store.items():
+                    key_db_name, table_segment, name = key
+                    if key in seen or key_db_name != db_name or name not in names or not matches(table_segment):
+                        continue
+                    seen.add(key)
+                    add(name, values)
+            return result
+
+    def _load(self, db_name: str, missing: Dict[str, List[str]]):
+        # Один запрос на все сегменты: лишние пары (сегмент, игрок) из него просто не берем
+        segments = list(missing)
+        names = list({name for player_names in missing.values() for name in player_names})
+        conn = None
+        try:
+            conn = get_connection(db_name, readonly=True)
+            rows = {(row[0], row[1]): row[2:] for row in conn.execute(f"""
+                SELECT g.name, p.name, r.words, {', '.join(f's.{col}' for col in SEGMENT_COUNTER_COLUMNS)}
+                FROM players p
+                JOIN player_stats s ON s.player_id = p.player_id
+                JOIN segments g ON g.segment_id = s.segment_id
+                LEFT JOIN player_recent_hands r ON r.segment_id = s.segment_id AND r.player_id = s.player_id
+                WHERE g.name IN ({', '.join('?' * len(segments))}) AND p.name IN ({', '.join('?' * len(names))})
+            """, [*segments, *names])}
+        finally:
+            if conn:
+                release_connection(conn)
+
+        for table_segment, player_names in missing.items():
+            for name in player_names:
+                self._load_player(db_name, table_segment, name, rows.get((table_segment, name)))
+
+    def _load_player(self, db_name: str, table_segment: str, name: str, row: Optional[tuple]):
+        key = (db_name, table_segment, name)
+        blob, *values = row or (None, *[0] * len(SEGMENT_COUNTER_COLUMNS))
+        counters = array('q', (int(v or 0) for v in values))
+        pending = self._pending.get(key)
+        if pending is not None:
+            for i, value in enumerate(pending):
+                counters[i] += value
+        self._counters[key] = counters
+
+        words = array('I')
+        if blob:
+            words.frombytes(blob)
+        words.extend(self._recent_pending.get(key, ()))
+        self._recent[key] = RecentHands(DB_RECENT_HANDS, words)
+
+    def flush(self, only_if_due: bool = False) -> int:
+        """
+        Пишет накопленные дельты в БД (одна транзакция на базу). Возвращает число игроков.
+        Блокировка счетчиков держится только до постановки записи: читатели не ждут поток записи.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                if only_if_due and (time.perf_counter() - self._last_flush) * 1000 < DB_STATS_FLUSH_MS:
+                    return 0
+                # Пока запись не закоммичена, ключи читаются только из памяти (см. get_combined_counters)
+                missing: Dict[str, Dict[str, List[str]]] = {}
+                for key in self._pending:
+                    if key not in self._counters:
+                        db_name, table_segment, player_name = key
+                        missing.setdefault(db_name, {}).setdefault(table_segment, []).append(player_name)
+                for db_name, segments in missing.items():
+                    self._load(db_name, segments)
+                self._in_flight, self._pending = self._pending, {}
+                recent_in_flight, self._recent_pending = self._recent_pending, {}
+
+            by_db: Dict[str, list] = {}
+            for key, delta in self._in_flight.items():
+                by_db.setdefault(key[0], []).append((key, delta))
+
+            written = 0
+            failed = []
+            for db_name, items in by_db.items():
+                rows = [(_SEGMENT_IDS[(db_name, table_segment)], player_name, *delta)
+                        for (_, table_segment, player_name), delta in items]
+                recent_rows = [(row[0], row[1], recent_in_flight[key])
+                               for row, (key, _) in zip(rows, items) if key in recent_in_flight]
+
+                def write(conn, rows=rows, recent_rows=recent_rows):
+                    conn.executemany("INSERT OR IGNORE INTO players (name) VALUES (?)",
+                                     [(row[1],) for row in rows])
+                    conn.executemany(PLAYER_STATS_UPSERT_SQL, rows)
+                    _merge_recent_hands(conn, recent_rows)
+
+                try:
+                    submit_write(db_name, write, "статистика оппонентов", wait=True)
+                except Exception as e:
+                    print(f"❌ Ошибка записи статистики оппонентов в БД: {e}")
+                    failed.extend(items)
+                    continue
+                written += len(items)
+
+            with self._lock:
+                # Незаписанные дельты возвращаются в _pending (перед новыми) до следующего сброса
+                for key, delta in failed:
+                    pending = self._pending.get(key)
+                    if pending is not None:
+                        for i, value in enumerate(pending):
+                            delta[i] += value
+                    self._pending[key] = delta
+                    words = recent_in_flight.get(key)
+                    if words is not None:
+                        words.extend(self._recent_pending.get(key, ()))
+                        self._recent_pending[key] = words
+                self._in_flight = {}
+                self._last_flush = time.perf_counter()
+                # Кеш ограничен: после записи все счетчики можно перечитать из БД
+                if len(self._counters) > DB_STATS_STORE_MAX_PLAYERS and not self._pending:
+                    self._counters.clear()
+                    self._recent.clear()
+            return written
+
+    def get_pending(self, db_name: str) -> List[Tuple[Tuple[str, str, str], array, array]]:
+        """Незаписанные дельты и слова окна базы в порядке появления игроков (для finish_bulk_load)."""
+        with self._lock:
+            return [(key, delta, self._recent_pending.get(key, array('I')))
+                    for key, delta in self._pending.items() if key[0] == db_name]
+
+    def discard_pending(self, keys: List[Tuple[str, str, str]]):
+        """Забывает дельты, записанные в БД в обход flush."""
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                self._recent_pending.pop(key, None)
+
+    def clear(self, db_name: str):
+        """Забывает счетчики и дельты базы (после удаления ее файлов)."""
+        with self._lock:
+            for store in (self._counters, self._pending, self._recent, self._recent_pending):
+                for key in [key for key in store if key[0] == db_name]:
+                    del store[key]
+
+
+_opponent_stats = OpponentStatsStore()
+
+
+# --- СЕССИОННАЯ СТАТИСТИКА HERO В ПАМЯТИ ---
+# HUD Hero показывает несколько процентов за сессию (с полуночи дня раздачи).
+# Вместо агрегирующего запроса на каждую пачку счетчики по дням один раз читаются
+# из my_daily_stats, а дальше обновляются строками Hero прямо из HandBatchWriter.
+
+class HeroSessionStats:
+    """
+    Счетчики HUD Hero по дням: (база, игрок) -> {день: массив HERO_SESSION_COLUMNS}.
+    В памяти ведутся только дни начиная с _loaded_from: более ранние дни при
+    необходимости дочитываются из БД (строки в них уже записаны HandBatchWriter).
+    Когда сессия переходит на следующий день, прошлые дни из памяти удаляются.
+    _seen_hands — hand_id Hero по тем же дням (из my_hand_log при загрузке и из add_row):
+    повторно записанная раздача (файл перечитан, INSERT OR REPLACE) в my_daily_stats
+    не удваивается триггером замены, значит не должна удваиваться и здесь.
+    Раздачи архивных месяцев (archive_hand_log) повторно не пишутся и в набор не читаются.
+    """
+
+    # Колонки my_daily_stats, из которых собирается HUD Hero
+    HERO_SESSION_COLUMNS = [
+        "total_hands", "vpip_sum", "pfr_sum", "p3bet_sum", "p3bet_opp_sum",
+        "cbet_sum", "cbet_opp_sum", "fcbet_sum", "fcbet_opp_sum",
+        "wtsd_sum", "wsd_sum", "saw_flop_sum",
+    ]
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._days: Dict[Tuple[str, str], Dict[datetime.date, array]] = {}
+        self._loaded_from: Dict[Tuple[str, str], datetime.date] = {}
+        self._seen_hands: Dict[Tuple[str, str], Dict[datetime.date, set]] = {}
+
+    @staticmethod
+    def _row_delta(data: Dict[str, Any]) -> List[int]:
+        """Вклад строки analyze_player_stats (те же правила, что MY_DAILY_STATS_COLUMNS)."""
+        wtsd = int(data.get('wtsd', 0) or 0)
+        return [
+            1,
+            int(data.get('is_vpip', 0) or 0),
+            int(data.get('is_pfr', 0) or 0),
+            int(data.get('is_3bet_pre', 0) or 0),
+            int(data.get('is_3bet_opp_pre', 0) or 0),
+            int(data.get('cbet_flop_succ', 0) or 0),
+            int(data.get('cbet_flop_opp', 0) or 0),
+            int(data.get('fcbet_flop_succ', 0) or 0),
+            int(data.get('fcbet_flop_opp', 0) or 0),
+            wtsd,
+            int(data.get('wsd', 0) or 0),
+            1 if data.get('final_street', '') != 'preflop' or wtsd == 1 else 0,
+        ]
+
+    def add_row(self, db_name: str, data: Dict[str, Any]):
+        """Учитывает строку my_hand_log Hero (раздача, уже учтенная в памяти, не считается дважды)."""
+        time_logged = data.get('time_logged')
+        if not isinstance(time_logged, datetime.datetime):
+            return
+        key = (db_name, data.get('player_name', ""))
+        with self._lock:
+            loaded_from = self._loaded_from.get(key)
+            day = time_logged.date()
+            if loaded_from is None or day < loaded_from:
+                return
+            seen = self._seen_hands[key].setdefault(day, set())
+            hand_id = str(data.get('hand_id'))
+            if hand_id in seen:
+                return
+            seen.add(hand_id)
+            counters = self._days[key].get(day)
+            if counters is None:
+                counters = self._days[key][day] = array('q', [0] * len(self.HERO_SESSION_COLUMNS))
+            for i, value in enumerate(self._row_delta(data)):
+                counters[i] += value
+
+    def _load(self, key: Tuple[str, str], from_day: datetime.date, to_day: Optional[datetime.date]):
+        """Дочитывает дни [from_day, to_day) из my_daily_stats базы key[0]."""
+        # Строки, поставленные в очередь записи до загрузки, должны попасть в агрегат
+        wait_for_writes(key[0])
+        conn = None
+        try:
+            conn = get_connection(key[0], readonly=True)
+            query = (f"SELECT day, {', '.join(f'SUM({col})' for col in self.HERO_SESSION_COLUMNS)} "
+                     "FROM my_daily_stats WHERE player_name = ? AND day >= ?")
+            params = [key[1], from_day.isoformat()]
+            if to_day:
+                query += " AND day < ?"
+                params.append(to_day.isoformat())
+            days = self._days.setdefault(key, {})
+            for day, *values in conn.execute(query + " GROUP BY day", params):
+                days[datetime.date.fromisoformat(day)] = array('q', values)
+
+            # Раздачи этих дней уже в агрегате: их повторная запись не должна считаться
+            query = "SELECT hand_id, time_logged FROM my_hand_log WHERE player_name = ? AND time_logged >= ?"
+            params = [key[1], _to_epoch(datetime.datetime.combine(from_day, datetime.time.min))]
+            if to_day:
+                query += " AND time_logged < ?"
+                params.append(_to_epoch(datetime.datetime.combine(to_day, datetime.time.min)))
+            seen = self._seen_hands.setdefault(key, {})
+            for hand_id, time_logged in conn.execute(query, params):
+                day = datetime.datetime.fromtimestamp(time_logged, _HAND_LOG_TZ).date()
+                seen.setdefault(day, set()).add(str(hand_id))
+        finally:
+            if conn:
+                release_connection(conn)
+
+    def get_hud_stats(self, db_name: str, player_name: str, min_time: datetime.datetime) -> Dict[str, Any]:
+        """Статистика для HUD Hero с начала дня min_time (пустой словарь, если раздач нет)."""
+        key = (db_name, player_name)
+        from_day = min_time.date()
+        with self._lock:
+            loaded_from = self._loaded_from.get(key)
+            if loaded_from is None or from_day < loaded_from:
+                self._load(key, from_day, loaded_from)
+                self._loaded_from[key] = from_day
+            elif from_day > loaded_from:
+                # Сессия началась позже: прошлые дни не нужны (при запросе дочитаются из БД)
+                for store in (self._days[key], self._seen_hands[key]):
+                    for day in [day for day in store if day < from_day]:
+                        del store[day]
+                self._loaded_from[key] = from_day
+            totals = [0] * len(self.HERO_SESSION_COLUMNS)
+            for day, counters in self._days[key].items():
+                if day >= from_day:
+                    for i, value in enumerate(counters):
+                        totals[i] += value
+
+        (hands, vpip, pfr, p3bet, p3bet_opp, cbet, cbet_opp,
+         fcbet, fcbet_opp, wtsd, wsd, saw_flop) = totals
+        if not hands:
+            return {}
+
+        def calc_pct(num, den):
+            return f"{round((num / den) * 100, 1)}" if den > 0 else "0.0"
+
+        return {
+            'hands': hands,
+            'vpip': calc_pct(vpip, hands),
+            'pfr': calc_pct(pfr, hands),
+            '3bet': calc_pct(p3bet, p3bet_opp),
+            'f3bet': '0.0',
+            'cbet': calc_pct(cbet, cbet_opp),
+            'fcbet': calc_pct(fcbet, fcbet_opp),
+            'wtsd': calc_pct(wtsd, saw_flop),
+            'wsd': calc_pct(wsd, wtsd),
+            'af': '0.0'
+        }
+
+    def clear(self, db_name: str):
+        with self._lock:
+            for store in (self._days, self._loaded_from, self._seen_hands):
+                for key in [k for k in store if k[0] == db_name]:
+                    del store[key]
+
+
+_hero_session = HeroSessionStats()
@@ -0,0 +1,71 @@
+# table_stats_service.py
+
+import threading
+from typing import Any, Dict, List, Set
+from poker_globals import MY_PLAYER_NAME, StatUpdateData
+from poker_stats_db import get_stats_for_tables
+
+# --- СТАТИСТИКА ОППОНЕНТОВ ДЛЯ ВСЕХ ОТКРЫТЫХ СТОЛОВ ---
+# Монитор за один проход по файлам собирает обновленные столы (без статистики оппонентов)
+# и отдает их в refresh(). Тот читает игроков всех затронутых столов одним вызовом
+# get_stats_for_tables и раздает каждому столу его часть. Затронуты обновленные столы и
+# открытые столы, где сидит кто-то из сыгравших (его счетчики изменились). Hero сидит
+# за всеми столами, поэтому его раздачи другие столы не обновляют.
+
+
+def _merge_table_stats(seat_map: Dict[str, int], stats: Dict[str, Dict[str, Any]],
+                       extras: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Часть статистики одного стола. extras — данные из самой раздачи: стек в BB
+    (только для игроков со статистикой) и готовая статистика Hero (с 'hands').
+    """
+    # Копии: записи одного сегмента общие для всех его столов
+    table_stats = {name: dict(stats[name]) for name in seat_map if name in stats}
+    for name, extra in extras.items():
+        if 'hands' in extra:
+            table_stats[name] = extra
+        elif name in table_stats:
+            table_stats[name].update(extra)
+    return table_stats
+
+
+class TableStatsService:
+    """Открытые столы монитора (файл -> последние данные) и пакетное чтение статистики для них."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: Dict[str, StatUpdateData] = {}
+
+    def forget_table(self, file_path: str):
+        """Стол закрыт (HUD удален): его игроков больше не читаем."""
+        with self._lock:
+            self._tables.pop(file_path, None)
+
+    def open_tables(self) -> int:
+        with self._lock:
+            return len(self._tables)
+
+    def refresh(self, updates: List[StatUpdateData]) -> List[StatUpdateData]:
+        """
+        Запоминает обновленные столы и возвращает данные для HUD всех затронутых столов:
+        (file_path, seat_map, table_title_part, table_segment, table_stats).
+        """
+        if not updates:
+            return []
+        with self._lock:
+            for data in updates:
+                self._tables[data[0]] = data
+            played: Set[str] = {name for data in updates for name in data[1] if name != MY_PLAYER_NAME}
+            updated = {data[0] for data in updates}
+            tables = [data for file_path, data in self._tables.items()
+                      if file_path in updated or not played.isdisjoint(data[1])]
+
+        players_by_segment: Dict[str, Set[str]] = {}
+        for _, seat_map, _, table_segment, _ in tables:
+            players_by_segment.setdefault(table_segment, set()).update(seat_map)
+        stats_by_segment = get_stats_for_tables(
+            {segment: list(names) for segment, names in players_by_segment.items()})
+
+        return [(file_path, seat_map, table_title_part, table_segment,
+                 _merge_table_stats(seat_map, stats_by_segment.get(table_segment, {}), extras))
+                for file_path, seat_map, table_title_part, table_segment, extras in tables]